@@ -47,6 +47,23 @@ function setup() {
 
   # Enable playground mode with: OTHER_ENV='-e PLAYGROUND=60' for 60 minutes reset interval
   # Carefull! This will periodically delete files in the notebook folders
+  #
+  # Rendered notes are cached in /tmp/notesntodos-cache inside the docker. Disable with:
+  # OTHER_ENV='-e CACHE_DIR=' or mount a volume at CACHE_DIR to keep the cache between dockers
+  #
+  # Render notes in parallel when loading notebooks with: OTHER_ENV='-e LOAD_PROCESSES=4'
+  # or only render notes when first requested with: OTHER_ENV='-e LAZY_RENDER=1'
+  #
+  # Flush saved notes to disk before confirming the save with: OTHER_ENV='-e FSYNC=1'
+  #
+  # Serve from an asyncio event loop instead of threads with: OTHER_ENV='-e SERVER_MODE=asyncio'
+  # This also makes browsers update when notes are changed elsewhere
+  #
+  # Serve from multiple worker processes sharing the loaded notes with: OTHER_ENV='-e WORKERS=4'
+  #
+  # Notebooks are loaded when first requested. With a single worker, unload notebooks unused for
+  # an hour with: OTHER_ENV='-e EVICT_IDLE=3600'
+  # or load them all before starting, making worker restarts fast, with: OTHER_ENV='-e PRELOAD=1'
   OTHER_ENV=
 }
 
@@ -0,0 +1,307 @@
+"""
+asgi.py - Serving the Notes'n'Todos WSGI app from an asyncio event loop
+
+MIT license - see LICENSE file in Notes'n'Todos project root
+
+AsgiApp adapts a WSGI app, like the Bottle app made by server.py, to ASGI so it can be served
+by an asyncio server such as uvicorn:
+
+- Request bodies are received and responses are sent by the event loop, so idle connections
+  and slow clients don't occupy a thread
+
+- The WSGI app runs in a thread pool, since handling a request may be CPU bound, for example
+  when rendering notes. Streamed responses are also iterated in the thread pool
+
+- Long-lived streams, such as the event streams of events.py, are served by async stream 
+  handlers in the event loop, bypassing the WSGI app. They are ended when the client 
+  disconnects or the worker stops
+
+AsgiWorker is the uvicorn worker for gunicorn serving AsgiApp.
+
+pip installs required:
+  uvicorn
+
+Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
+"""
+
+import io
+import sys
+import asyncio
+import concurrent.futures
+from uvicorn.main import Server
+from uvicorn.workers import UvicornWorker
+from gunicorn.arbiter import Arbiter
+
+def makeEnviron(scope, body):
+    """ Make WSGI environ for the HTTP request of ASGI scope with body """
+    environ = {
+        "REQUEST_METHOD" : scope["method"],
+        # WSGI strings are bytes decoded as latin-1
+        "SCRIPT_NAME" : scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO" : scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING" : scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL" : "HTTP/%s" % scope.get("http_version", "1.1"),
+        "CONTENT_LENGTH" : str(len(body)),
+        "wsgi.version" : (1, 0),
+        "wsgi.url_scheme" : scope.get("scheme", "http"),
+        "wsgi.input" : io.BytesIO(body),
+        "wsgi.errors" : sys.stderr,
+        "wsgi.multithread" : True,
+        "wsgi.multiprocess" : False,
+        "wsgi.run_once" : False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for (name, value) in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else "HTTP_" + name
+        value = value.decode("latin-1")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+class AsgiApp:
+    def __init__(self, wsgi_app, threads = 4, stream_handlers = None):
+        # stream_handlers is a map from request path to an async function (scope, send) that
+        # sends a streamed response until cancelled
+        self.WsgiApp = wsgi_app
+        self.StreamHandlers = stream_handlers or {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._streams = set() # Tasks of the stream handlers running
+
+    def stop(self):
+        """ End the streams, must be called from the event loop """
+        for task in self._streams:
+            task.cancel()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            handler = self.StreamHandlers.get(scope["path"])
+            if handler is None:
+                await self._handleHttp(scope, receive, send)
+            else:
+                await self._handleStream(handler, scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self._handleLifespan(receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope: " + scope["type"])
+
+    async def _handleLifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type" : "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type" : "lifespan.shutdown.complete"})
+                return
+
+    async def _handleStream(self, handler, scope, receive, send):
+        started = []
+
+        async def sendStream(message):
+            started.append(True)
+            await send(message)
+
+        async def waitDisconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        stream = asyncio.ensure_future(handler(scope, sendStream))
+        disconnect = asyncio.ensure_future(waitDisconnect())
+        self._streams.add(stream)
+        try:
+            await asyncio.wait([stream, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._streams.discard(stream)
+            disconnected = disconnect.done()
+            stream.cancel()
+            disconnect.cancel()
+            await asyncio.wait([stream, disconnect])
+        if not disconnected and len(started) > 0:
+            # Ended by stop, complete the response
+            await send({"type" : "http.response.body", "body" : b""})
+        if not stream.cancelled() and stream.exception() is not None:
+            raise stream.exception()
+
+    async def _handleHttp(self, scope, receive, send):
+        # Receive the whole body before occupying a thread with the request
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        environ = makeEnviron(scope, b"".join(body))
+
+        loop = asyncio.get_event_loop()
+        started = []
+        written = []
+
+        def startResponse(status, headers, exc_info = None):
+            started[:] = [status, headers]
+            return written.append
+
+        def runApp():
+            # Call the app and get the first chunk, as start_response may be called when the
+            # response is first iterated
+            result = self.WsgiApp(environ, startResponse)
+            iterator = iter(result)
+            return (result, iterator, next(iterator, None))
+
+        (result, iterator, chunk) = await loop.run_in_executor(self._executor, runApp)
+        try:
+            (status, headers) = started
+            await send({"type" : "http.response.start",
+                        "status" : int(status.split(" ", 1)[0]),
+                        "headers" : [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                     for (name, value) in headers]})
+            for data in written:
+                await send({"type" : "http.response.body", "body" : data, "more_body" : True})
+
+            # Lists are sent as they are, other iterables may block and are iterated in threads
+            in_thread = not isinstance(result, (list, tuple))
+            while chunk is not None:
+                await send({"type" : "http.response.body", "body" : chunk, "more_body" : True})
+                if in_thread:
+                    chunk = await loop.run_in_executor(self._executor, next, iterator, None)
+                else:
+                    chunk = next(iterator, None)
+            await send({"type" : "http.response.body", "body" : b""})
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self._executor, result.close)
+
+class AsgiWorker(UvicornWorker):
+    """ uvicorn worker for gunicorn, stopping the streams of AsgiApp when exiting. uvicorn waits
+    for all responses to complete before exiting, which streams otherwise never do """
+
+    async def _serve(self):
+        self.config.app = self.wsgi
+        server = Server(config=self.config)
+        handle_exit = server.handle_exit
+
+        def handleExit(sig, frame):
+            self.wsgi.stop()
+            handle_exit(sig, frame)
+
+        # The exit handler is installed as signal handler when serving
+        server.handle_exit = handleExit
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+# ------
+
+def testAsgiApp():
+    import json
+    from bottle import Bottle, request, response
+
+    app = Bottle()
+
+    @app.get("/hello/<name>")
+    def hello(name):
+        return {"name" : name, "q" : request.query.getunicode("q", default="")}
+
+    @app.post("/echo")
+    def echo():
+        return {"json" : request.json, "header" : request.get_header("X-Test")}
+
+    @app.get("/stream")
+    def stream():
+        def generate():
+            for i in range(3):
+                yield ("%d;" % i).encode("utf-8")
+        return generate()
+
+    asgi_app = AsgiApp(app)
+
+    def call(path, query = b"", method = "GET", body = b"", headers = []):
+        scope = {"type" : "http", "method" : method, "path" : path, "query_string" : query,
+                 "headers" : headers, "http_version" : "1.1"}
+        messages = [{"type" : "http.request", "body" : body[:2], "more_body" : True},
+                    {"type" : "http.request", "body" : body[2:], "more_body" : False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi_app(scope, receive, send))
+        assert(sent[0]["type"] == "http.response.start")
+        assert(sent[-1].get("more_body", False) == False)
+        return (sent[0]["status"], dict(sent[0]["headers"]),
+                b"".join(m.get("body", b"") for m in sent[1:]))
+
+    (status, headers, body) = call("/hello/Bjørn", b"q=%C3%A6")
+    assert(status == 200)
+    assert(headers[b"content-type"] == b"application/json")
+    assert(json.loads(body) == {"name" : "Bjørn", "q" : "æ"})
+
+    (status, headers, body) = call("/echo", method="POST", body=b'{"a": 1}',
+                                   headers=[(b"content-type", b"application/json"),
+                                            (b"x-test", b"yes")])
+    assert(json.loads(body) == {"json" : {"a" : 1}, "header" : "yes"})
+
+    (status, headers, body) = call("/stream")
+    assert(status == 200 and body == b"0;1;2;")
+
+    (status, headers, body) = call("/missing")
+    assert(status == 404)
+
+def testAsgiStreams():
+    async def countStream(scope, send):
+        await send({"type" : "http.response.start", "status" : 200, "headers" : []})
+        i = 0
+        while True:
+            await send({"type" : "http.response.body", "body" : b"%d;" % i, "more_body" : True})
+            i += 1
+            await asyncio.sleep(0.01)
+
+    asgi_app = AsgiApp(None, stream_handlers={"/count" : countStream})
+    scope = {"type" : "http", "method" : "GET", "path" : "/count", "query_string" : b"",
+             "headers" : []}
+
+    async def run(stop):
+        sent = []
+        disconnected = asyncio.Event()
+
+        async def receive():
+            if len(sent) == 0:
+                return {"type" : "http.request", "body" : b"", "more_body" : False}
+            await disconnected.wait()
+            return {"type" : "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        task = asyncio.ensure_future(asgi_app(scope, receive, send))
+        await asyncio.sleep(0.05)
+        if stop:
+            asgi_app.stop()
+        else:
+            disconnected.set()
+        await asyncio.wait_for(task, 1)
+        assert(len(asgi_app._streams) == 0)
+        return sent
+
+    # Stopping completes the response, while a disconnect just ends the stream
+    sent = asyncio.run(run(True))
+    assert(sent[0]["status"] == 200 and sent[1]["body"] == b"0;")
+    assert(sent[-1] == {"type" : "http.response.body", "body" : b""})
+    sent = asyncio.run(run(False))
+    assert(len(sent) > 2 and sent[-1]["more_body"] == True)
+
+def testsRun():
+    testAsgiApp()
+    testAsgiStreams()
@@ -5,142 +5,457 @@ MIT license - see LICENSE file in Notes'n'Todos project root
 
 DirWatcher was made for Notes'n'Todos and features:
 
-- Lazy reporting of file changes. When changes happens to the dir, some time is waited
-  before reporting. The intension is to collect multiple simultaneous file operations
-  into one report
+- Lazy reporting of file changes. When changes happen to the dir, the report waits until 
+  no changes came for a quiet period, or at most a maximum wait during a burst of changes.
+  The intension is to collect multiple simultaneous file operations into one report
 
-- The watcher logic runs in a python thread
+- All DirWatchers of a process share one WatchService, which owns one inotify instance and 
+  one python thread. The thread sleeps in epoll until inotify has events, a report is due or 
+  the watchers change. Thus reports are made as soon as the quiet period expires, and stopping
+  is immediate. The thread runs while any DirWatcher is running
 
 - A callback is called from the thread with file change reports
 
 - Ignoring changes to certain files is supported, with timeout, such that changes made
-  by the main program can be ignored
+  by the main program can be ignored. A file changed while ignored is reported with 
+  IGNORE_END_OPERATION when the ignoring ends, as it may also have been changed by others
+
+- If inotify drops events, as when too many changes come at once, all watchers get an 
+  (OVERFLOW_OPERATION, "") report, meaning any file may have changed
 
 Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
 """
 
-import inotify.adapters
+import inotify.calls
 import inotify.constants
+import os
+import select
+import struct
 import threading
 import queue
 import time
+import traceback
+
+# Header of each inotify event: watch descriptor, mask, cookie and length of the name following 
+# it, which is padded with NULs
+EVENT_HEADER = struct.Struct("iIII")
+
+# Only care about events that change files:
+WATCH_OPERATIONS = [
+    (inotify.constants.IN_CLOSE_WRITE, "IN_CLOSE_WRITE"),
+    (inotify.constants.IN_MOVED_FROM, "IN_MOVED_FROM"),
+    (inotify.constants.IN_MOVED_TO, "IN_MOVED_TO"),
+    (inotify.constants.IN_DELETE, "IN_DELETE"),
+    (inotify.constants.IN_DELETE_SELF, "IN_DELETE_SELF")]
+
+# Reported to all watchers when inotify dropped events
+OVERFLOW_OPERATION = "IN_Q_OVERFLOW"
+
+# Reported for a file changed while ignored, when the ignoring ends
+IGNORE_END_OPERATION = "IGNORE_END"
+
+WATCH_MASK = 0
+for (bit, name) in WATCH_OPERATIONS:
+    WATCH_MASK |= bit
+
+def readEvents(fd):
+    """ Read the available events of non-blocking inotify fd as a list of (wd, mask, filename) """
+    data = b""
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+        if len(chunk) == 0:
+            break
+        data += chunk
+
+    events = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        filename = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+        offset += length
+        events.append((wd, mask, filename))
+    return events
+
+class WatchService:
+    """ One inotify instance and thread dispatching the events of all DirWatchers """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._inotifyFd = inotify.calls.inotify_init()
+        os.set_blocking(self._inotifyFd, False)
+        # Writing to the wakeup pipe wakes the thread from epoll
+        (self._wakeupRead, self._wakeupWrite) = os.pipe()
+        os.set_blocking(self._wakeupRead, False)
+        self._epoll = select.epoll()
+        self._epoll.register(self._inotifyFd, select.EPOLLIN)
+        self._epoll.register(self._wakeupRead, select.EPOLLIN)
+
+        self._lock = threading.Lock()
+        self._watchers = {} # Map from watch descriptor to list of DirWatchers
+        self._stopping = [] # DirWatchers to remove by the thread
+        self._thread = None
+
+    def getThread(self):
+        return self._thread
+
+    def add(self, watcher):
+        with self._lock:
+            # Watching the same path again gives the same watch descriptor
+            wd = inotify.calls.inotify_add_watch(self._inotifyFd, os.fsencode(watcher._path), 
+                                                 WATCH_MASK)
+            self._watchers.setdefault(wd, []).append(watcher)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._task, daemon=False)
+                self._thread.start()
+        return wd
+
+    def remove(self, watcher):
+        with self._lock:
+            self._stopping.append(watcher)
+        os.write(self._wakeupWrite, b"x")
 
-class DirWatcher:
-    def __init__(self, path, report_wait_s, callback):
-        self._inotify = inotify.adapters.Inotify(block_duration_s = 1.0)
+    # Task Thread 
+    # ===========
+
+    def _removeStopping(self):
+        # Remove the stopped watchers, returns False if no watchers remain (holding the lock)
+        for watcher in self._stopping:
+            watchers = self._watchers.get(watcher._wd, [])
+            if watcher in watchers:
+                watchers.remove(watcher)
+                if len(watchers) == 0:
+                    del self._watchers[watcher._wd]
+                    try:
+                        inotify.calls.inotify_rm_watch(self._inotifyFd, watcher._wd)
+                    except inotify.calls.InotifyError:
+                        # The watch is gone already if the dir was deleted
+                        pass
+            print("DirWatcher for: %s stops" % watcher._path)
+            watcher._stoppedEvent.set()
+        self._stopping = []
+        if len(self._watchers) == 0:
+            self._thread = None
+            return False
+        return True
 
-        # Only care about events that change files:
-        self._inotify.add_watch(path, mask=
-            inotify.constants.IN_CLOSE_WRITE |
-            inotify.constants.IN_MOVED_FROM |
-            inotify.constants.IN_MOVED_TO |
-            inotify.constants.IN_DELETE |
-            inotify.constants.IN_DELETE_SELF)
+    def _task(self):
+        print("DirWatcher thread starts")
+
+        while True:
+            with self._lock:
+                if not self._removeStopping():
+                    break
+                dues = [watcher._operationsDue() for w in self._watchers.values() for watcher in w]
+                dues += [watcher._ignoresDue() for w in self._watchers.values() for watcher in w]
+                dues = [due for due in dues if due is not None]
+
+            timeout = -1 if len(dues) == 0 else max(0, min(dues) - time.monotonic())
+            ready = [fd for (fd, event) in self._epoll.poll(timeout)]
+            if self._wakeupRead in ready:
+                # Watchers were stopped, they are removed above
+                try:
+                    os.read(self._wakeupRead, 4096)
+                except BlockingIOError:
+                    pass
+
+            # Taken after polling, so events of watchers added meanwhile are dispatched
+            with self._lock:
+                watchers = {wd:list(w) for (wd, w) in self._watchers.items()}
+
+            if self._inotifyFd in ready:
+                time_now = time.monotonic()
+                for (wd, mask, filename) in readEvents(self._inotifyFd):
+                    if mask & inotify.constants.IN_Q_OVERFLOW:
+                        print("DirWatcher missed changes")
+                        for w in watchers.values():
+                            for watcher in w:
+                                watcher._operationAdd(OVERFLOW_OPERATION, "", time_now)
+                    for watcher in watchers.get(wd, []):
+                        watcher._eventAdd(mask, filename, time_now)
+
+            # Check if operations are ready to be called back
+            time_now = time.monotonic()
+            for w in watchers.values():
+                for watcher in w:
+                    watcher._ignoresRemoveTimedOut(time_now)
+                    op_files = watcher._operationsGet(time_now)
+                    if len(op_files) > 0 and not watcher._stopRequested:
+                        # A failing callback must not stop the watching of the others
+                        try:
+                            watcher._callback(op_files)
+                        except Exception:
+                            traceback.print_exc()
+
+        print("DirWatcher thread stops")
+
+_service = None
+_serviceLock = threading.Lock()
+
+def getWatchService():
+    """ Get the WatchService of this process. A forked process gets its own """
+    global _service
+    with _serviceLock:
+        if _service is None or _service._pid != os.getpid():
+            _service = WatchService()
+        return _service
 
+class DirWatcher:
+    def __init__(self, path, report_wait_s, callback, max_wait_s = None):
+        # Changes are reported when no more changes came for report_wait_s, or at latest 
+        # max_wait_s after the first change if given
         self._reportWait = report_wait_s
+        self._maxWait = max_wait_s
         self._path = path
         self._callback = callback
-        
-        self._stopEvent = threading.Event()
         self._ignoreQueue = queue.Queue()
+        self._operationInit()
+        self._ignoresInit()
+        self._stopLock = threading.Lock()
+        self._stopRequested = False
+        self._stoppedEvent = threading.Event()
 
-        self._thread = threading.Thread(target=self._task, daemon=False)
-        self._thread.start()
+        print("DirWatcher for: %s starts" % path)
+        self._service = getWatchService()
+        self._wd = self._service.add(self)
 
     def stop(self):
-        self._stopEvent.set()
+        with self._stopLock:
+            if not self._stopRequested:
+                self._stopRequested = True
+                self._service.remove(self)
 
     def join(self):
-        self._thread.join()
+        # When returning, the callback is not called anymore
+        self._stoppedEvent.wait()
 
     def isRunning(self):
-        return self._thread.is_alive()
+        return not self._stoppedEvent.is_set()
 
     def addIgnore(self, filename, timeout_s):
         self._ignoreQueue.put((filename, time.monotonic() + timeout_s))
     
-    # Task Thread 
-    # ===========
+    # Called from the WatchService thread 
+    # ===================================
 
     # --- Ignore management
 
     def _ignoresInit(self):
         self._ignores = {} # Map from filename to timeout_seconds
+        self._ignoredChanged = set() # Ignored filenames that changed while ignored
 
     def _ignoresAdd(self, filename, timeout):
         self._ignores[filename] = timeout
 
     def _ignoresRemoveTimedOut(self, time_now):
+        for (filename, timeout) in self._ignores.items():
+            if time_now >= timeout and filename in self._ignoredChanged:
+                self._ignoredChanged.remove(filename)
+                self._operationAdd(IGNORE_END_OPERATION, filename, time_now)
         self._ignores = { filename:timeout for (filename,timeout) in self._ignores.items() 
                                              if time_now < timeout }
 
     def _ignoresCheck(self, filename):
         return filename in self._ignores
 
+    def _ignoresDue(self):
+        # Time when an ignoring of a changed file ends, or None if there is none
+        dues = [self._ignores[filename] for filename in self._ignoredChanged]
+        return min(dues) if len(dues) > 0 else None
+
     # --- Registerering operations with lazy dispatch:
 
     def _operationInit(self):
         # A set is used here to ensure no duplicate operation+filename pairs:
         self._operations = set()
-        self._operationTime = None
+        self._operationTime = None # Time of the latest operation
+        self._firstOperationTime = None # Time of the first operation not reported
 
     def _operationAdd(self, operation, filename, time_now):
         self._operations.add(operation + "," + filename)
         self._operationTime = time_now
-
-    def _operationsGet(self, time_threshold):
+        if self._firstOperationTime is None:
+            self._firstOperationTime = time_now
+
+    def _operationsDue(self):
+        # Time when the operations must be reported, or None if there are none
+        if self._operationTime is None:
+            return None
+        due = self._operationTime + self._reportWait
+        if self._maxWait is not None:
+            due = min(due, self._firstOperationTime + self._maxWait)
+        return due
+
+    def _operationsGet(self, time_now):
         ret = []
-        if (not self._operationTime is None and
-                 (time_threshold - self._operationTime) > 0):
+        due = self._operationsDue()
+        if due is not None and time_now >= due:
             for op_file in self._operations:
                 ret.append(tuple(op_file.split(",", 1)))
-            self._operations.clear()
-            self._operationTime = None
+            self._operationInit()
         return ret
 
-    # --- Task
-
-    def _task(self):
-        print("DirWatcher thread for: %s starts" % self._path)
-
-        self._operationInit()
-        self._ignoresInit()
-
-        for event in self._inotify.event_gen():
-            time_now = time.monotonic()
+    def _eventAdd(self, mask, filename, time_now):
+        # Stuff is happening, now we need to make sure ignores are up to date
+        while not self._ignoreQueue.empty():
+            (ignore_filename, ignore_timeout) = self._ignoreQueue.get()
+            self._ignoresAdd(ignore_filename, ignore_timeout)
 
-            if event is None:
-                # Check if operations are ready to be called back
-                op_files = self._operationsGet(time_now - self._reportWait)
-                if len(op_files) > 0:
-                    self._callback(op_files)
-            else:
-                # Stuff is happening, now we need to make sure ignores are up to date
-                while not self._ignoreQueue.empty():
-                    (filename, timeout) = self._ignoreQueue.get()
-                    self._ignoresAdd(filename, timeout)
-                
-                self._ignoresRemoveTimedOut(time_now)
+        self._ignoresRemoveTimedOut(time_now)
 
-                # Look at event
-                (header, type_names, watch_path, filename) = event
+        if len(filename) > 0:
+            if self._ignoresCheck(filename):
+                self._ignoredChanged.add(filename)
+                return
+            for (bit, op_name) in WATCH_OPERATIONS:
+                if mask & bit:
+                    self._operationAdd(op_name, filename, time_now)
 
-                # print("type_names: %s filename: %s" % (type_names, filename))
+# ----
 
-                if len(filename) > 0:
-                    if not self._ignoresCheck(filename):
-                        for op_name in type_names:
-                            self._operationAdd(op_name, filename, time_now)
+def testsRun():
+    _testIgnoreTiming()
+    _testAdaptiveReporting()
+    _testSharedService()
+    _testOverflow()
 
-            if self._stopEvent.is_set():
-                break
+def _testOverflow():
+    import os
+    reports = {"a" : [], "b" : []}
+    overflows = {"a" : threading.Event(), "b" : threading.Event()}
+    for name in reports:
+        os.makedirs("/tmp/dw_test4/" + name, exist_ok=True)
+    writes_done = threading.Event()
+
+    def callback(name, ops):
+        reports[name].append(ops)
+        if (OVERFLOW_OPERATION, "") in ops:
+            overflows[name].set()
+
+    # Keep the thread busy in a callback of b until too many changes came to a
+    def slowCallback(ops):
+        callback("b", ops)
+        writes_done.wait(60)
+
+    dw_a = DirWatcher("/tmp/dw_test4/a", 0.1, lambda ops: callback("a", ops))
+    dw_b = DirWatcher("/tmp/dw_test4/b", 0.1, slowCallback)
+    thread = dw_b._service.getThread()
+    try:
+        with open("/tmp/dw_test4/b/b.md", "w") as f:
+            f.write("b")
+        time.sleep(0.3)
+        with open("/proc/sys/fs/inotify/max_queued_events") as f:
+            max_events = int(f.read())
+        for i in range(max_events + 100):
+            with open("/tmp/dw_test4/a/%d.md" % i, "w") as f:
+                f.write("a")
+        writes_done.set()
+
+        # Both are told about the overflow
+        for name in reports:
+            assert(overflows[name].wait(10))
+    finally:
+        writes_done.set()
+        dw_a.stop()
+        dw_b.stop()
+        dw_a.join()
+        dw_b.join()
+        thread.join(5)
+        os.system("rm -r /tmp/dw_test4")
+    assert(not thread.is_alive())
+
+def _testSharedService():
+    import os
+    reports = {"a" : [], "b" : []}
+    for name in reports:
+        os.makedirs("/tmp/dw_test3/" + name, exist_ok=True)
+    threads = threading.active_count()
+
+    # Watchers of each dir have their own debouncing, but share one thread
+    dw_a = DirWatcher("/tmp/dw_test3/a", 0.1, lambda ops: reports["a"].append(ops))
+    dw_b = DirWatcher("/tmp/dw_test3/b", 0.5, lambda ops: reports["b"].append(ops))
+    dw_b2 = DirWatcher("/tmp/dw_test3/b", 0.1, lambda ops: 1 / 0)
+    assert(threading.active_count() == threads + 1)
+    assert(dw_a._service is dw_b._service)
+
+    for name in reports:
+        with open("/tmp/dw_test3/%s/%s.md" % (name, name), "w") as f:
+            f.write(name)
+    time.sleep(0.3)
+    assert(reports == {"a" : [[('IN_CLOSE_WRITE', 'a.md')]], "b" : []})
+    time.sleep(0.4)
+    assert(reports["b"] == [[('IN_CLOSE_WRITE', 'b.md')]])
+
+    # Stopping one watcher of a dir keeps watching it for the other
+    dw_a.stop()
+    dw_b2.stop()
+    dw_a.join()
+    dw_b2.join()
+    assert(not dw_a.isRunning() and dw_b.isRunning())
+    os.unlink("/tmp/dw_test3/a/a.md")
+    os.unlink("/tmp/dw_test3/b/b.md")
+    time.sleep(0.7)
+    assert(len(reports["a"]) == 1)
+    assert(reports["b"][1] == [('IN_DELETE', 'b.md')])
+
+    # The thread ends with the last watcher, and starts again with a new one
+    thread = dw_b._service.getThread()
+    dw_b.stop()
+    dw_b.join()
+    thread.join(1)
+    assert(not thread.is_alive())
+    dw_a = DirWatcher("/tmp/dw_test3/a", 0.1, lambda ops: reports["a"].append(ops))
+    with open("/tmp/dw_test3/a/a.md", "w") as f:
+        f.write("a")
+    time.sleep(0.3)
+    assert(reports["a"][1] == [('IN_CLOSE_WRITE', 'a.md')])
+    dw_a.stop()
+    dw_a.join()
+
+    os.system("rm -r /tmp/dw_test3")
+
+def _testAdaptiveReporting():
+    import os
+    reports = [] # (time, operations)
 
-        print("DirWatcher thread for: %s stops" % self._path)
+    os.makedirs("/tmp/dw_test2", exist_ok=True)
+    dw = DirWatcher('/tmp/dw_test2', 0.2, lambda ops: reports.append((time.monotonic(), ops)), 0.6)
 
-# ----
+    # A single change is reported when the quiet period expires
+    start = time.monotonic()
+    with open("/tmp/dw_test2/a.md", "w") as f:
+        f.write("a")
+    time.sleep(0.5)
+    assert(len(reports) == 1)
+    assert(reports[0][1] == [('IN_CLOSE_WRITE', 'a.md')])
+    assert(0.2 <= reports[0][0] - start < 0.35)
+
+    # A burst of changes is reported at the maximum wait, without waiting for the burst to end
+    start = time.monotonic()
+    for i in range(15):
+        with open("/tmp/dw_test2/b%d.md" % i, "w") as f:
+            f.write("b")
+        time.sleep(0.1)
+    time.sleep(0.4)
+    burst = reports[1:]
+    assert(len(burst) >= 2)
+    assert(0.6 <= burst[0][0] - start < 0.8)
+    assert(sorted(filename for (t, ops) in burst for (op, filename) in ops) == 
+           sorted("b%d.md" % i for i in range(15)))
+
+    # Stopping is immediate
+    start = time.monotonic()
+    dw.stop()
+    dw.join()
+    assert(time.monotonic() - start < 0.1)
+    assert(not dw.isRunning())
 
-def testsRun():
-    _testIgnoreTiming()
+    for filename in os.listdir("/tmp/dw_test2"):
+        os.unlink("/tmp/dw_test2/" + filename)
+    os.rmdir("/tmp/dw_test2")
 
 def _testIgnoreTiming():
     import copy
@@ -163,7 +478,7 @@ def _testIgnoreTiming():
 
     os.system("mkdir -p /tmp/dw_test")
 
-    dw = DirWatcher('/tmp/dw_test', 3, testCallback)
+    dw = DirWatcher('/tmp/dw_test', 1, testCallback)
     time.sleep(0.5)
     os.system("touch /tmp/dw_test/ignore.not")
     dw.addIgnore("ignore.2", 2)
@@ -171,29 +486,37 @@ def _testIgnoreTiming():
     dw.addIgnore("ignore.5", 5)
     os.system("touch /tmp/dw_test/ignore.5")
 
-    # Expect no callback after 2 secs, at least 3 seconds must pass
-    time.sleep(2)
+    # Expect no callback before 1 sec passed
+    time.sleep(0.5)
     assert_eq(callback_count, 0)
 
     # Now expect the ignore.not to be reported in callback
-    time.sleep(2)
+    time.sleep(1)
     assert_eq(callback_count, 1)
     assert_eq(callback_ops, [('IN_CLOSE_WRITE', 'ignore.not')])
 
+    # Now the ignoring of ignore.2 has ended, and it's reported as changed while ignored
+    time.sleep(1.5)
+    assert_eq(callback_count, 2)
+    assert_eq(callback_ops, [(IGNORE_END_OPERATION, 'ignore.2')])
+
     # Now ignore.2 should be reported
     os.system("touch /tmp/dw_test/ignore.2")
     os.system("touch /tmp/dw_test/ignore.5")
-    time.sleep(2)
-    assert_eq(callback_count, 1)
-    time.sleep(2)
-    assert_eq(callback_count, 2)
+    time.sleep(1.5)
+    assert_eq(callback_count, 3)
     assert_eq(callback_ops, [('IN_CLOSE_WRITE', 'ignore.2')])
 
+    # The ignoring of ignore.5 has ended
+    time.sleep(2)
+    assert_eq(callback_count, 4)
+    assert_eq(callback_ops, [(IGNORE_END_OPERATION, 'ignore.5')])
+
     # Now ignore.2 and ignore.5 should be reported
     os.system("touch /tmp/dw_test/ignore.2")
     os.system("touch /tmp/dw_test/ignore.5")
-    time.sleep(4)
-    assert_eq(callback_count, 3)
+    time.sleep(1.5)
+    assert_eq(callback_count, 5)
 
     try:
         assert_eq(callback_ops, [('IN_CLOSE_WRITE', 'ignore.2'), ('IN_CLOSE_WRITE', 'ignore.5')])
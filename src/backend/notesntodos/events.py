@@ -0,0 +1,251 @@
+"""
+events.py - Server-Sent Events of note collection changes for Notes'n'Todos
+
+MIT license - see LICENSE file in Notes'n'Todos project root
+
+The api/events stream of a notebook tells browsers when notes change, whether by a save from
+another browser or by an external edit picked up by DirWatcher, so they can fetch the changes
+with api/changes. The events are lightweight:
+
+  event: changed   data: {"fullname": ..., "instance": ..., "generation": ...}
+  event: removed   data: {"fullname": ..., "instance": ..., "generation": ...}
+  event: tags      data: {"tags": [...], "instance": ..., "generation": ...}
+  event: resync    data: {"instance": ..., "generation": ...}
+
+The generation is that of the collection after the change. The id of each event is
+"instance-generation", so a reconnecting browser continues where it left off.
+
+Event streams are served natively by AsgiApp, see asgi.py, where an idle stream is a waiting
+coroutine rather than a thread. The streams wait on a ChangeNotifier, which is notified from
+the thread publishing a change of the collection.
+
+Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
+"""
+
+import json
+import asyncio
+import threading
+import urllib.parse
+
+# Seconds between comments sent to keep idle streams open through proxies
+HEARTBEAT_S = 20
+
+# Milliseconds browsers wait before reconnecting a closed stream
+RETRY_MS = 3000
+
+class ChangeNotifier:
+    """ Wakes up coroutines waiting for a change. notify may be called from any thread """
+
+    def __init__(self):
+        self._count = 0 # Number of notifications so far
+        self._waiters = {} # Map from event loop to set of futures waiting in it
+        self._lock = threading.Lock()
+
+    def getCount(self):
+        return self._count
+
+    def notify(self):
+        with self._lock:
+            self._count += 1
+            waiters = self._waiters
+            self._waiters = {}
+        for (loop, futures) in waiters.items():
+            loop.call_soon_threadsafe(self._wake, futures)
+
+    @staticmethod
+    def _wake(futures):
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, count, timeout):
+        """ Wait until notified after count was returned by getCount, or timeout. Returns True
+        if notified """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._count != count:
+                return True
+            self._waiters.setdefault(loop, set()).add(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                futures = self._waiters.get(loop)
+                if futures is not None:
+                    futures.discard(future)
+                    if len(futures) == 0:
+                        del self._waiters[loop]
+
+def formatEvent(event, data, event_id = None):
+    lines = [] if event_id is None else ["id: " + event_id]
+    lines += ["event: " + event, "data: " + json.dumps(data)]
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+def makeEvents(instance_id, snapshot, since, tags):
+    """ Make the events of the changes in snapshot since generation since, where the tags were
+    tags. Returns a list of (event, data) """
+    state = {"instance" : instance_id, "generation" : snapshot.Generation}
+    changes = snapshot.getChanges(since)
+    if changes is None:
+        return [("resync", state)]
+
+    (notes, deleted) = changes
+    events = [("changed", dict(state, fullname=note.getFullname())) for (index, note) in notes]
+    events += [("removed", dict(state, fullname=fullname)) for fullname in deleted]
+    new_tags = snapshot.getAllTags()
+    if new_tags != tags:
+        events.append(("tags", dict(state, tags=new_tags)))
+    return events
+
+def parseEventState(scope):
+    """ Get (instance, generation) to stream events from, by the Last-Event-ID header of a
+    reconnecting browser, or by the instance and since query parameters. Returns None if not
+    given """
+    for (name, value) in scope.get("headers", []):
+        if name.lower() == b"last-event-id":
+            try:
+                (instance, generation) = value.decode("latin-1").rsplit("-", 1)
+                return (instance, int(generation))
+            except ValueError:
+                return None
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    try:
+        return (query["instance"][0], int(query["since"][0]))
+    except (KeyError, ValueError):
+        return None
+
+async def streamEvents(note_col, notifier, scope, send):
+    """ Stream the events of note_col over the ASGI HTTP connection of scope, until cancelled """
+    await send({"type" : "http.response.start", "status" : 200,
+                "headers" : [(b"content-type", b"text/event-stream"),
+                             (b"cache-control", b"no-cache"),
+                             # Tell nginx to not buffer the stream
+                             (b"x-accel-buffering", b"no")]})
+    await send({"type" : "http.response.body", "body" : b"retry: %d\n\n" % RETRY_MS,
+                "more_body" : True})
+
+    count = notifier.getCount()
+    snapshot = note_col.getSnapshot()
+    instance_id = note_col.InstanceId
+    tags = snapshot.getAllTags()
+    generation = snapshot.Generation
+    state = parseEventState(scope)
+    if state is not None:
+        if state[0] != instance_id:
+            # Other instance of the collection, so the browser must reload
+            generation = -1
+        else:
+            generation = state[1]
+
+    while True:
+        if snapshot.Generation != generation or note_col.InstanceId != instance_id:
+            if note_col.InstanceId != instance_id:
+                instance_id = note_col.InstanceId
+                generation = -1
+            event_id = "%s-%d" % (instance_id, snapshot.Generation)
+            events = makeEvents(instance_id, snapshot, generation, tags)
+            body = b"".join(formatEvent(event, data, event_id if i == len(events) - 1 else None)
+                            for i, (event, data) in enumerate(events))
+            if len(body) > 0:
+                await send({"type" : "http.response.body", "body" : body, "more_body" : True})
+            generation = snapshot.Generation
+            tags = snapshot.getAllTags()
+        elif not await notifier.wait(count, HEARTBEAT_S):
+            await send({"type" : "http.response.body", "body" : b": ping\n\n", "more_body" : True})
+        count = notifier.getCount()
+        snapshot = note_col.getSnapshot()
+
+# ------
+
+def testChangeNotifier():
+    notifier = ChangeNotifier()
+
+    async def run():
+        count = notifier.getCount()
+        # Times out without notification, returns at once if notified since count
+        assert(not await notifier.wait(count, 0.01))
+        notifier.notify()
+        assert(await notifier.wait(count, 0.01))
+
+        # Notified from another thread
+        count = notifier.getCount()
+        timer = threading.Timer(0.05, notifier.notify)
+        timer.start()
+        assert(await notifier.wait(count, 5))
+        timer.join()
+        assert(notifier._waiters == {})
+
+    asyncio.run(run())
+
+def testStreamEvents():
+    import tempfile
+    from .notes import Note, NoteCollection
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        notifier = ChangeNotifier()
+        note_col.setPublishCallback(lambda snapshot: notifier.notify())
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A"))
+        start = note_col.InstanceId, note_col.Generation
+
+        def parse(body):
+            events = []
+            for block in body.decode("utf-8").split("\n\n"):
+                fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+                if "event" in fields:
+                    events.append((fields["event"], json.loads(fields["data"]), fields.get("id")))
+            return events
+
+        async def run(scope, change):
+            sent = []
+            async def send(message):
+                sent.append(message)
+
+            task = asyncio.ensure_future(streamEvents(note_col, notifier, scope, send))
+            await asyncio.sleep(0.05)
+            await asyncio.get_event_loop().run_in_executor(None, change)
+            await asyncio.sleep(0.05)
+            task.cancel()
+            assert(sent[0]["status"] == 200)
+            return parse(b"".join(m.get("body", b"") for m in sent[1:]))
+
+        def change():
+            note_col.addNote(Note.Parse("date: 2021-01-01\nname: B\ntags: x"), "2021-01-01 A")
+            note_col.addNote(Note.Parse("date: 2021-01-02\nname: C"))
+
+        scope = {"headers" : [], "query_string" : b""}
+        events = asyncio.run(run(scope, change))
+        generation = note_col.Generation
+        assert([(e, d.get("fullname"), d.get("tags")) for (e, d, i) in events] ==
+               [("changed", "2021-01-01 B", None), ("removed", "2021-01-01 A", None),
+                ("tags", None, ["x"]), ("changed", "2021-01-02 C", None)] or
+               [(e, d.get("fullname"), d.get("tags")) for (e, d, i) in events] ==
+               [("changed", "2021-01-02 C", None), ("changed", "2021-01-01 B", None),
+                ("removed", "2021-01-01 A", None), ("tags", None, ["x"])])
+        assert(events[-1][2] == "%s-%d" % (note_col.InstanceId, generation))
+        assert(events[-1][1]["generation"] == generation)
+
+        # Reconnecting with Last-Event-ID gets the changes missed meanwhile
+        scope = {"headers" : [(b"Last-Event-ID", events[-1][2].encode("latin-1"))],
+                 "query_string" : b""}
+        events = asyncio.run(run(scope, lambda: None))
+        assert(events == [])
+        note_col.addNote(None, "2021-01-02 C")
+        events = asyncio.run(run(scope, lambda: None))
+        assert([(e, d.get("fullname")) for (e, d, i) in events] == [("removed", "2021-01-02 C")])
+
+        # Streaming from another instance or an unknown generation requires a resync
+        scope = {"headers" : [], "query_string" : b"instance=other&since=1"}
+        events = asyncio.run(run(scope, lambda: None))
+        assert([e for (e, d, i) in events] == ["resync"])
+        scope = {"headers" : [], "query_string" : ("instance=%s&since=%d" % start).encode()}
+        events = asyncio.run(run(scope, lambda: None))
+        assert(sorted(d.get("fullname") for (e, d, i) in events if e != "tags") ==
+               ["2021-01-01 A", "2021-01-01 B", "2021-01-02 C"])
+
+def testsRun():
+    testChangeNotifier()
+    testStreamEvents()
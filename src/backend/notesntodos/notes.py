@@ -20,9 +20,16 @@ Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
 
 import os
 import re
+import json
+import hashlib
+import threading
+import uuid
+import concurrent.futures
+import multiprocessing
 from datetime import datetime
 import markdown
 import urllib
+from .searchindex import SearchIndex
 from .onchange_tasklist import OnChangeTlExtension
 
 
@@ -34,6 +41,17 @@ MARKDOWN_EXTENSIONS = [OnChangeTlExtension(onchange_code="nnt.checkClick(this,%d
     'pymdownx.saneheaders', 'pymdownx.magiclink', 'fenced_code', 'tables', 'def_list', 'sane_lists']
 MARKDOWN_EXTCONFIG = {}
 
+# Increment when changing how notes are rendered, to invalidate render caches
+RENDER_VERSION = 2
+
+# Number of changes a collection keeps track of for getChanges, at least
+CHANGE_LOG_SIZE = 1000
+
+# Fewer notes to render than this are rendered serially, as starting the rendering processes 
+# takes longer. Starting a process that imports markdown takes about 200 ms, while a note renders
+# in about 3 ms
+PARALLEL_RENDER_MIN_NOTES = 200
+
 # ----- Note system -----
 
 """
@@ -95,66 +113,122 @@ def assembleDate(date, date_index):
     else:
         return date
 
+# Creating a Markdown instance registers all extensions and compiles their patterns, which
+# is costly compared to converting a typical note. Each thread keeps its own instance since
+# a Markdown instance holds state of the conversion in progress.
+_markdownEngines = threading.local()
+
+def getMarkdownEngine():
+    md = getattr(_markdownEngines, "md", None)
+    if md is None:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTCONFIG)
+        _markdownEngines.md = md
+    return md
+
+def convertMarkdown(src):
+    md = getMarkdownEngine()
+    try:
+        return md.convert(src)
+    finally:
+        md.reset()
+
 MatchHyperLinkRe = re.compile('<a (.*?)>')
 
 def makeLinksNoReferrer(html):
     return MatchHyperLinkRe.sub(r'<a \1 rel="noreferrer">', html)
 
 
-def makeHtml(src):
-    # Remove the tags:<...> lines from note
-    no_tags = FindTagsRe.sub("", src, count=1)
-    html = markdown.markdown(no_tags,
-        extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTCONFIG)
-    return makeLinksNoReferrer(html)
-
 # ------ 
 
-
 MdCheckCandidateRe = re.compile('\[[ xX]\] ')
-HtmlCheckTokenRe = re.compile(re.escape('<span class="task-list-indicator"></span></label> ') + '¤(\d\d\d)д¤')
+MdUncheckedCandidateRe = re.compile('\[ \] ')
+CheckTokenRe = re.compile('¤(\d+)д¤')
+HtmlCheckTokenRe = re.compile(re.escape('<span class="task-list-indicator"></span></label> ') + CheckTokenRe.pattern)
 
 class TokenMaker:
-    def __init__(self):
+    def __init__(self, src = ""):
         self.count = 0
         self.offsets = []
+        # Tokens end with a mark that isn't found in src, so the text of the note is never 
+        # taken for a token
+        self.mark = "д"
+        while self.mark + "¤" in src:
+            self.mark += "д"
+        if self.mark == "д":
+            self.tokenRe = CheckTokenRe
+            self.htmlTokenRe = HtmlCheckTokenRe
+        else:
+            self.tokenRe = re.compile('¤(\d+)' + self.mark + '¤')
+            self.htmlTokenRe = re.compile(re.escape('<span class="task-list-indicator"></span></label> ') + self.tokenRe.pattern)
     def makeToken(self, match):
         # Record offset to the next character after [ to get the space, x or X of the check
         self.offsets.append(match.start() + 1)
         # Return the match appended with numbered token
-        ret = '%s¤%03dд¤' % (match.group(0), self.count)
+        ret = '%s¤%03d%s¤' % (match.group(0), self.count, self.mark)
         self.count += 1
         return ret
 
-def findCheckOffsets(s):
-    """ Find the text offset of each task list item in the src.
-    There is no easy and elegant way to do this. This approach uses extra tokens in the md src"""
-    
-    # First step is to insert numbered tokens at each check box candidate
-    tm = TokenMaker()
-    tokenized_src = MdCheckCandidateRe.sub(tm.makeToken, s)
+FindTagsRe = re.compile("^tags:(.*)$", flags=re.MULTILINE)
+
+# Regex to find unchecked task list items generated by markdown. First group is the index
+# from the parameter to the javascript function. Second group is the task text, until end 
+# paragraph or end list tag. 
+FindUncheckedHtmlRe = re.compile(",(\d+)" + re.escape(')"/><span class="task-list-indicator"></span></label>') + "(.*?)\</(p\>|li\>)")
+
+def findTodos(html):
+    """ Find the unchecked task list items in html as a list of (text, index) """
+    todos = []
+    for match in FindUncheckedHtmlRe.finditer(html):
+        try:
+            index = int(match.group(1))
+        except:
+            index = -1
+        todos.append((match.group(2).strip(), index))
+    return todos
+
+def renderNote(src):
+    """ Convert note src to HTML with a single markdown conversion. Returns (html, check_offsets, todos)
+    where check_offsets holds the text offset in src of each task list item.
     
-    # Convert markdown to html
-    html = markdown.markdown(tokenized_src, 
-                extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTCONFIG)
+    There is no easy and elegant way to find the offsets. This approach inserts numbered tokens
+    after each check box candidate in the src. The token following each check box in the HTML 
+    tells what offset in src lead to the check box, after which all tokens are removed again"""
+
+    tm = TokenMaker(src)
+    tokenized_src = MdCheckCandidateRe.sub(tm.makeToken, src)
+
+    # Remove the tags:<...> line from note
+    no_tags = FindTagsRe.sub("", tokenized_src, count=1)
+    html = convertMarkdown(no_tags)
 
-    # Go through the resulting check boxes and from the token index we know what offset in src
-    # lead to the check box:
     offsets = []
-    for match in HtmlCheckTokenRe.finditer(html):
+    for match in tm.htmlTokenRe.finditer(html):
         offsets.append(tm.offsets[int(match.group(1))])
-    
-    return offsets        
-    
+
+    html = makeLinksNoReferrer(tm.tokenRe.sub("", html))
+    return (html, offsets, findTodos(html))
+
+def makeHtml(src):
+    return renderNote(src)[0]
+
+def findCheckOffsets(s):
+    """ Find the text offset of each task list item in the src """
+    return renderNote(s)[1]
 
 # ------
 
-FindTagsRe = re.compile("^tags:(.*)$", flags=re.MULTILINE)
+def makeTempFilename(filename):
+    # Name of the temporary file used when saving filename. It's hidden and without the note
+    # file extension, so it's not taken for a note
+    return ".%s.tmp" % filename
 
-# Regex to find unchecked task list items generated by markdown. First group is the index
-# from the parameter to the javascript function. Second group is the task text, until end 
-# paragraph or end list tag. 
-FindUncheckedHtmlRe = re.compile(",(\d+)" + re.escape(')"/><span class="task-list-indicator"></span></label>') + "(.*?)\</(p\>|li\>)")
+def fsyncDir(path):
+    # Flush directory entries of path to disk, making renames and deletions durable
+    fd = os.open(path if len(path) > 0 else ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 class Note:
     def __init__(self):
@@ -162,15 +236,27 @@ class Note:
         self.Name = ""
         self.Date = ""
         self.DateIndex = 0
-        self.Todos = []
         self.Note = ""
+        self.CacheKey = None
+        self.FileStat = None # makeFileStat of the file when loaded or saved
+        self.SortKey = None # Set by NoteCollection from getSortingName when added
+        self._renderCache = None
+        self._rendered = None
+        self._jsonCache = {} # Serialized getNoteObj per (src, todos, html)
+        self._jsonFullname = None # Fullname that _jsonCache was made for
 
     @staticmethod
-    def load(path, filename):
+    def load(path, filename, render_cache = None, render = True):
         ret = Note()
-        ret._load(path, filename)
+        ret._load(path, filename, render_cache, render)
         return ret
         
+    @staticmethod
+    def makeFileStat(stat):
+        # The status change time can't be set by programs, so a file replaced or modified with 
+        # its modification time preserved, as by sync tools, is still told apart
+        return (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino)
+
     @staticmethod
     def Parse(note_text):
         if len(note_text) == 0:
@@ -179,6 +265,29 @@ class Note:
         ret._parse(note_text)
         return ret
 
+    # Html, CheckOffsets and Todos come from rendering the note, which is done on first use 
+    # unless the note was rendered when loaded
+
+    @property
+    def Html(self):
+        return self.getRendered()[0]
+
+    @property
+    def Todos(self):
+        return self.getRendered()[2]
+
+    @property
+    def CheckOffsets(self):
+        # The check offsets must refer to FullSrc, which has the date and name lines in front
+        prefix_len = len(self.FullSrc) - len(self.Note)
+        return [x + prefix_len for x in self.getRendered()[1]]
+
+    @property
+    def FullSrc(self):
+        return "date: %s\nname: %s\n%s" % (
+                assembleDate(self.Date, self.DateIndex),
+                 self.Name, self.Note)
+
     def getFullname(self):
         date = assembleDate(self.Date, self.DateIndex)
         if len(self.Name) > 0:
@@ -206,37 +315,77 @@ class Note:
             ret['html'] = self.Html
         return ret
 
-    def Save(self, filename):
-        with open(filename, "w") as file:
-            file.write(self.Note)
+    def getNoteJson(self, src=False, todos=False, html=False):
+        """ Get getNoteObj serialized as JSON, cached per field combination """
+        fullname = self.getFullname()
+        if fullname != self._jsonFullname:
+            # Date index was changed after serializing
+            self._jsonCache = {}
+            self._jsonFullname = fullname
+        key = (src, todos, html)
+        ret = self._jsonCache.get(key)
+        if ret is None:
+            ret = json.dumps(self.getNoteObj(src=src, todos=todos, html=html))
+            self._jsonCache[key] = ret
+        return ret
 
-    def _setNote(self, src):
-        self.Note = src
-        self.Html = makeHtml(src)
-        self.FullSrc = "date: %s\nname: %s\n%s" % (
-                assembleDate(self.Date, self.DateIndex),
-                 self.Name, self.Note)
+    def Save(self, filename, fsync = False):
+        """ Save the note to filename, replacing it atomically through a temporary file. With 
+        fsync, the file and directory are flushed to disk before returning """
+        (path, name) = os.path.split(filename)
+        tmp_filename = os.path.join(path, makeTempFilename(name))
         try:
-            self.CheckOffsets = findCheckOffsets(self.FullSrc)
+            with open(tmp_filename, "w") as file:
+                file.write(self.Note)
+                file.flush()
+                if fsync:
+                    os.fsync(file.fileno())
+                os.replace(tmp_filename, filename)
+                # Taken after renaming, which changes the status change time
+                stat = os.fstat(file.fileno())
         except:
-            self.CheckOffsets = []
-            
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+        self.FileStat = Note.makeFileStat(stat)
+        if fsync:
+            fsyncDir(path)
+
+    def mayHaveTodos(self):
+        # Checks the source only, the note is rendered when the todos are needed
+        return MdUncheckedCandidateRe.search(self.Note) is not None
+
+    def isRendered(self):
+        return self._rendered is not None
+
+    def getRendered(self):
+        """ Get (html, check_offsets, todos) as returned by renderNote, rendering if needed """
+        if self._rendered is None:
+            self._setRendered(renderNote(self.Note))
+        return self._rendered
+
+    def setRenderCache(self, render_cache, key):
+        # Store the rendering in render_cache with key, now or when rendered
+        self._renderCache = render_cache
+        self.CacheKey = key
+        if self._rendered is not None:
+            render_cache.put(self.getFilename(), key, self._rendered)
+
+    def _setRendered(self, rendered):
+        self._rendered = rendered
+        if self._renderCache is not None:
+            self._renderCache.put(self.getFilename(), self.CacheKey, rendered)
+
+    def _setNote(self, src):
+        self.Note = src
+        self._jsonCache = {}
         tags_match = FindTagsRe.search(src)
         if tags_match:
             self.Tags = set([x.strip() for x in tags_match.group(1).split(",")])
             if "" in self.Tags:
                 self.Tags.remove("")
-
-        # Identify unchecked todos
-        self.Todos = []
-        for match in FindUncheckedHtmlRe.finditer(self.Html):
-            try:
-                index = int(match.group(1))
-            except:
-                index = -1
-            self.Todos.append((match.group(2).strip(), index))
         
-    def _load(self, path, filename):
+    def _load(self, path, filename, render_cache, render):
         # Derive Name, Date, DateIndex from the filename:
         if not filename.endswith("." + FILE_EXTENSION):
             raise ValueError("Filename has wrong extension")
@@ -248,10 +397,20 @@ class Note:
         if filename != self.getFilename():
             raise ValueError("Filename fails validation")
 
-        # Set note body from file contents:
+        # Set note body from file contents, taking the rendering from the render cache if it has it:
         with open(path + filename) as file:
-            self._setNote(file.read())
-    
+            src = file.read()
+            stat = os.fstat(file.fileno())
+
+        self._setNote(src)
+        self.FileStat = Note.makeFileStat(stat)
+        if render_cache is not None:
+            self.CacheKey = RenderCache.makeKey(stat, src)
+            self._rendered = render_cache.get(filename, self.CacheKey)
+            self._renderCache = render_cache
+        if render:
+            self.getRendered()
+
     def _parse(self, note_src):
         # Derive Name, Date, DateIndex from note_src:
         self.Date = ""
@@ -274,119 +433,733 @@ class Note:
         # Set note body from filtered note_src:
         self._setNote("\n".join(filtered_lines))
 
+class RenderCache:
+    """ Persistent cache of rendered notes, stored as a single JSON file per notebook.
+
+    Entries are keyed by filename, and only used if the modification time, size and content hash
+    of the file, and the renderer stamp of the cache file, are unchanged """
+
+    def __init__(self, cache_filename):
+        self.Filename = cache_filename
+        self._entries = {}
+        self._dirty = False
+        # Notes may be rendered on first use from any thread, thus entries are updated with a lock
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def makeStamp():
+        # Identify the renderer, any change in version or config will invalidate the cache
+        extensions = [x if isinstance(x, str) else "%s%s" % (type(x).__name__, sorted(x.getConfigs().items()))
+                        for x in MARKDOWN_EXTENSIONS]
+        return "%d %s %s %s" % (RENDER_VERSION, markdown.__version__, extensions, 
+                                sorted(MARKDOWN_EXTCONFIG.items()))
+
+    @staticmethod
+    def makeKey(stat, src):
+        return [stat.st_mtime_ns, stat.st_size, hashlib.sha1(src.encode("utf-8")).hexdigest()]
+
+    def load(self):
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(self.Filename) as file:
+                obj = json.load(file)
+            if obj.get("stamp") == RenderCache.makeStamp():
+                self._entries = obj["notes"]
+            else:
+                print("Render cache: %s is outdated" % self.Filename)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Couldn't load render cache %s: %s" % (self.Filename, str(e)))
+        return len(self._entries)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        try:
+            # Write to a temporary file and replace, so a crash can't leave a truncated cache
+            tmp_filename = self.Filename + ".tmp"
+            with open(tmp_filename, "w") as file:
+                json.dump({"stamp" : RenderCache.makeStamp(), "notes" : entries}, file,
+                          separators=(',', ':'))
+            os.replace(tmp_filename, self.Filename)
+        except Exception as e:
+            print("Couldn't save render cache %s: %s" % (self.Filename, str(e)))
+
+    def get(self, filename, key):
+        entry = self._entries.get(filename)
+        if entry is None or entry[0] != key:
+            return None
+        (html, check_offsets, todos) = entry[1:]
+        return (html, check_offsets, [tuple(x) for x in todos])
+
+    def put(self, filename, key, rendered):
+        with self._lock:
+            self._entries[filename] = [key] + list(rendered)
+            self._dirty = True
+
+    def remove(self, filename):
+        with self._lock:
+            if self._entries.pop(filename, None) is not None:
+                self._dirty = True
+
+    def keep(self, filenames):
+        # Remove entries of all files not in filenames
+        with self._lock:
+            removed = set(self._entries.keys()) - set(filenames)
+            for filename in removed:
+                del self._entries[filename]
+            if len(removed) > 0:
+                self._dirty = True
+
+def bisectDescending(keys, key):
+    """ Like bisect.bisect_left, but for keys sorted in descending order: Returns the first 
+    position where keys[i] <= key """
+    lo = 0
+    hi = len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] > key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def bisectDescendingRight(keys, key):
+    """ Like bisect.bisect_right, but for keys sorted in descending order: Returns the first 
+    position where keys[i] < key """
+    lo = 0
+    hi = len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] >= key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class NoteSnapshot:
+    """ The notes of a collection in sorted order, newest first, with indexes for fast lookups.
+
+    A published snapshot is never changed, so it can be read without locking. NoteCollection 
+    makes changes to an unpublished copy, which is then published in place of the old one """
+
+    def __init__(self):
+        self.Notes = []
+        # Generation is incremented on every change of the collection
+        self.Generation = 0
+        self._sortKeys = [] # SortKey of each note in Notes, in the same descending order
+        self._byFullname = {}
+        self._byFilename = {}
+        self._dateIndexes = {} # Map from date to set of DateIndex in use
+        self._tagIndex = {} # Map from tag to set of notes, "" maps to notes without tags
+        self._todoNotes = [] # Notes that may have unchecked todos, in the same order as Notes
+        self._todoSortKeys = [] # SortKey of each note in _todoNotes
+        self._ownedSets = set() # (index, key) of the sets in indexes that are not shared
+        self._changes = [] # (generation, fullname) of the latest changes, oldest first
+        self._changesStart = 0 # Generation the changes are logged from
+
+    def _copy(self):
+        # The sets of the indexes are shared with the copy until _changeSet is called for them
+        ret = NoteSnapshot()
+        ret.Notes = list(self.Notes)
+        ret.Generation = self.Generation
+        ret._sortKeys = list(self._sortKeys)
+        ret._byFullname = dict(self._byFullname)
+        ret._byFilename = dict(self._byFilename)
+        ret._dateIndexes = dict(self._dateIndexes)
+        ret._tagIndex = dict(self._tagIndex)
+        ret._todoNotes = list(self._todoNotes)
+        ret._todoSortKeys = list(self._todoSortKeys)
+        ret._changes = list(self._changes)
+        ret._changesStart = self._changesStart
+        return ret
+
+    def _changeSet(self, index, name, key):
+        # Get the set of key in index for changing it, copying it first if it may be shared
+        ret = index.get(key)
+        if ret is None or (name, key) not in self._ownedSets:
+            ret = set() if ret is None else set(ret)
+            index[key] = ret
+            self._ownedSets.add((name, key))
+        return ret
+
+    def _sort(self):
+        self.Notes.sort(key=lambda note: note.SortKey, reverse=True)
+        self._sortKeys = [note.SortKey for note in self.Notes]
+        self._todoNotes = [note for note in self.Notes if note.mayHaveTodos()]
+        self._todoSortKeys = [note.SortKey for note in self._todoNotes]
+
+    def _logChange(self, note):
+        self.Generation += 1
+        self._changes.append((self.Generation, note.getFullname()))
+        if len(self._changes) > 2 * CHANGE_LOG_SIZE:
+            # Drop the oldest changes, not on every change as that's slow
+            self._changesStart = self._changes[-CHANGE_LOG_SIZE - 1][0]
+            del self._changes[:-CHANGE_LOG_SIZE]
+
+    def _clearChanges(self):
+        # Start logging changes from the current generation
+        self._changes = []
+        self._changesStart = self.Generation
+
+    def _add(self, note, ordered):
+        self._logChange(note)
+        note.SortKey = note.getSortingName()
+        if ordered:
+            i = bisectDescending(self._sortKeys, note.SortKey)
+            self.Notes.insert(i, note)
+            self._sortKeys.insert(i, note.SortKey)
+            if note.mayHaveTodos():
+                i = bisectDescending(self._todoSortKeys, note.SortKey)
+                self._todoNotes.insert(i, note)
+                self._todoSortKeys.insert(i, note.SortKey)
+        else:
+            self.Notes.append(note)
+            self._sortKeys.append(note.SortKey)
+        for tag in (note.Tags if len(note.Tags) > 0 else [""]):
+            self._changeSet(self._tagIndex, "tag", tag).add(note)
+        self._byFullname[note.getFullname()] = note
+        self._byFilename[note.getFilename()] = note
+        self._changeSet(self._dateIndexes, "date", note.Date).add(note.DateIndex)
+
+    def _remove(self, note):
+        self._logChange(note)
+        i = bisectDescending(self._sortKeys, note.SortKey)
+        while self.Notes[i] is not note:
+            i += 1
+        del self.Notes[i]
+        del self._sortKeys[i]
+        i = bisectDescending(self._todoSortKeys, note.SortKey)
+        while i < len(self._todoNotes) and self._todoNotes[i] is not note:
+            i += 1
+        if i < len(self._todoNotes):
+            del self._todoNotes[i]
+            del self._todoSortKeys[i]
+        for tag in (note.Tags if len(note.Tags) > 0 else [""]):
+            tag_notes = self._changeSet(self._tagIndex, "tag", tag)
+            tag_notes.discard(note)
+            if len(tag_notes) == 0:
+                del self._tagIndex[tag]
+        del self._byFullname[note.getFullname()]
+        del self._byFilename[note.getFilename()]
+        date_indexes = self._changeSet(self._dateIndexes, "date", note.Date)
+        date_indexes.discard(note.DateIndex)
+        if len(date_indexes) == 0:
+            del self._dateIndexes[note.Date]
+
+    def _matchTags(self, tags_filter):
+        matches = set()
+        for tag in tags_filter:
+            matches.update(self._tagIndex.get(tag, ()))
+        return matches
+
+    def findFromFilename(self, filename):
+        return self._byFilename.get(filename)
+
+    def findFromFullname(self, fullname):
+        return self._byFullname.get(fullname)
+
+    def findNextDateIndex(self, date):
+        date_indexes = self._dateIndexes.get(date)
+        return max(date_indexes) + 1 if date_indexes else 0
+
+    def findDate(self, date, date_index):
+        return date_index in self._dateIndexes.get(date, ())
+
+    def getNotes(self, tags_filter = None):
+        """Get notes in sorted order. With tags_filter, only notes with at least one of the tags
+        are returned, where the tag "" matches notes without tags"""
+        if tags_filter is None:
+            return list(self.Notes)
+        return sorted(self._matchTags(tags_filter), key=lambda note: note.SortKey, reverse=True)
+    
+    def getNotesPage(self, tags_filter = None, limit = None, before = None, after = None, 
+                     date_from = None, date_to = None):
+        """Get a page of notes in sorted order, newest first. Returns (notes, next_cursor).
+
+        tags_filter     Set of tags as for getNotes, or None
+        limit           Maximum number of notes to return, or None for no limit
+        before, after   Cursors, only notes sorting before (older) or after (newer) the cursor
+        date_from       Only notes with this date (YYYY-MM-DD) or later
+        date_to         Only notes with this date or earlier
+
+        next_cursor is the cursor to use as before for getting the next page, or None if there 
+        are no more notes"""
+        if limit is not None and limit < 1:
+            raise ValueError("Invalid limit: %d" % limit)
+
+        # Find the range of notes in the ordered index. Sort keys start with the date followed
+        # by ".", so keys of date_to are all less than date_to + "/"
+        start = 0
+        end = len(self.Notes)
+        if before is not None:
+            start = max(start, bisectDescendingRight(self._sortKeys, before))
+        if date_to is not None:
+            start = max(start, bisectDescendingRight(self._sortKeys, date_to + "/"))
+        if after is not None:
+            end = min(end, bisectDescending(self._sortKeys, after))
+        if date_from is not None:
+            end = min(end, bisectDescendingRight(self._sortKeys, date_from))
+
+        matches = None if tags_filter is None else self._matchTags(tags_filter)
+        notes = []
+        for i in range(start, end):
+            note = self.Notes[i]
+            if matches is None or note in matches:
+                if limit is not None and len(notes) >= limit:
+                    return (notes, notes[-1].SortKey)
+                notes.append(note)
+        return (notes, None)
+
+    def getTodos(self, tags_filter = None, limit = None):
+        """Get unchecked todos of all notes as a list of (note, text, index), newest note first. 
+        text is the HTML of the todo and index is its checkbox index in the note. tags_filter is as
+        for getNotes, and limit is the maximum number of todos to return"""
+        matches = None if tags_filter is None else self._matchTags(tags_filter)
+        ret = []
+        for note in self._todoNotes:
+            if matches is None or note in matches:
+                for (text, index) in note.Todos:
+                    if limit is not None and len(ret) >= limit:
+                        return ret
+                    ret.append((note, text, index))
+        return ret
+
+    def getChanges(self, since):
+        """Get the changes made after generation since as (notes, deleted), or None if they are
+        no longer known. notes is a list of (index, note) of added or replaced notes, newest first,
+        where index is the position in Notes. deleted is a list of fullnames of deleted notes"""
+        if since < self._changesStart or since > self.Generation:
+            return None
+        i = len(self._changes)
+        while i > 0 and self._changes[i - 1][0] > since:
+            i -= 1
+        notes = []
+        deleted = []
+        for fullname in set(fullname for (generation, fullname) in self._changes[i:]):
+            note = self._byFullname.get(fullname)
+            if note is None:
+                deleted.append(fullname)
+            else:
+                index = bisectDescending(self._sortKeys, note.SortKey)
+                while self.Notes[index] is not note:
+                    index += 1
+                notes.append((index, note))
+        notes.sort(key=lambda x: x[0])
+        return (notes, sorted(deleted))
+
+    def getNote(self, full_name):
+        return self._byFullname.get(full_name)
+
+    def getAllTags(self):
+        return sorted(tag for tag in self._tagIndex.keys() if tag != "")
+
+    def getTagCount(self, tag):
+        # Number of notes with tag, or notes without tags if tag is ""
+        return len(self._tagIndex.get(tag, ()))
+
 class NoteCollection:
-    def __init__(self, path):
+    """ The notes of a notebook directory.
+    
+    Changing the collection, and reading it through the methods of NoteCollection, must be done
+    by one thread at a time. Other threads can read the collection without locking through the 
+    snapshot returned by getSnapshot """
+
+    def __init__(self, path, cache_filename = None, load_processes = 0, lazy = False, 
+                 fsync = False):
         # Path must end with "/"
+        # With load_processes > 1, loadAll renders notes in parallel in that many processes
+        # With lazy = True, notes are not rendered when loaded, but on first use
+        # With fsync = True, saved and deleted notes are flushed to disk before the collection 
+        # is updated
         self.Path = path
-        self.Notes = []
-        self.AllTags = set()
+        self.LoadProcesses = load_processes
+        self.Lazy = lazy
+        self.Fsync = fsync
         self.PreFileChangeCallback = None
+        self.PublishCallback = None
+        self.RenderCache = None if cache_filename is None else RenderCache(cache_filename)
+        # Together with the generation, InstanceId identifies the state of the collection, also 
+        # across restarts
+        self.InstanceId = uuid.uuid4().hex[:8]
+        self._snapshot = NoteSnapshot() # Published snapshot
+        self._draft = None # Unpublished copy of the snapshot with changes
+        self._searchIndex = None # Full-text index of note names and sources, made on first search
+        self._writeLock = threading.Lock() # Held by addNotes while writing and updating
+
+    @property
+    def Notes(self):
+        return self._current().Notes
+
+    @property
+    def Generation(self):
+        return self._current().Generation
+
+    def getSnapshot(self):
+        """ Get the current state of the collection, which can be read without locking """
+        return self._snapshot
+
+    def _current(self):
+        return self._snapshot if self._draft is None else self._draft
+
+    def _edit(self):
+        # Get the unpublished copy for making changes, copying the published snapshot if needed
+        if self._draft is None:
+            self._draft = self._snapshot._copy()
+        return self._draft
+
+    def _publish(self):
+        # Publish the changes made. Replacing the reference is atomic, so readers get either the 
+        # old or the new snapshot
+        if self._draft is not None:
+            self._snapshot = self._draft
+            self._draft = None
+            if self.PublishCallback:
+                self.PublishCallback(self._snapshot)
 
     def setPreFileChangeCallback(self, prefilechange_callback):
         self.PreFileChangeCallback = prefilechange_callback
 
+    def setPublishCallback(self, publish_callback):
+        # publish_callback is called with the new snapshot whenever one is published
+        self.PublishCallback = publish_callback
+
     def sortNotes(self):
-        def sortFunc(e):
-            return e.getSortingName()        
-        self.Notes.sort(key=sortFunc, reverse=True)
+        self._edit()._sort()
 
-    def _add(self, note):
-        self.Notes.append(note)
-        self.AllTags.update(note.Tags)
+    def _add(self, note, ordered = True):
+        # Insert note in sorted position, or append it if ordered is False and sortNotes is 
+        # called afterwards
+        self._edit()._add(note, ordered)
+        if self._searchIndex is not None:
+            self._searchIndex.add(note, note.Name + "\n" + note.Note)
 
     def _remove(self, note):
-        self.Notes.remove(note)
-        # This might have removed a tag, no other way than to gather tags again
-        self.AllTags = set()
-        for note in self.Notes:
-            self.AllTags.update(note.Tags)
+        self._edit()._remove(note)
+        if self._searchIndex is not None:
+            self._searchIndex.remove(note)
 
     def loadAll(self):
-        self.Notes = []
+        # Start from an empty snapshot, continuing the generation count
+        self._draft = NoteSnapshot()
+        self._draft.Generation = self._snapshot.Generation + 1
+        self._searchIndex = None
+        if self.RenderCache:
+            self.RenderCache.load()
     
+        # Read all notes, leaving the ones not found in the render cache for rendering below
+        loaded = []
         for filename in os.listdir(self.Path):
             if filename.endswith("." + FILE_EXTENSION):
                 try:
-                    note = Note.load(self.Path, filename)
-                    self._add(note)
+                    loaded.append(Note.load(self.Path, filename, self.RenderCache, render=False))
                 except Exception as e:
                     print("Couldn't load note %s: %s" % (filename, str(e)))
 
+        pending = [] if self.Lazy else [note for note in loaded if not note.isRendered()]
+        if self.LoadProcesses > 1 and len(pending) >= max(PARALLEL_RENDER_MIN_NOTES, 2):
+            self._renderParallel(pending)
+        else:
+            for note in pending:
+                self._renderNote(note)
+
+        filenames = []
+        for note in loaded:
+            if self.Lazy or note.isRendered():
+                self._add(note, ordered=False)
+                filenames.append(note.getFilename())
+
         self.sortNotes()
+        # Clients must reload everything after a reload
+        self._draft._clearChanges()
+        self._publish()
+        if self.RenderCache:
+            self.RenderCache.keep(filenames)
+            self.RenderCache.save()
         return len(self.Notes)
 
-    def findFromFilename(self, filename):
-        for note in self.Notes:
-            if note.getFilename() == filename:
-                return note
-        return None
+    def _renderNote(self, note, future = None):
+        # Render note, or take the rendering from the future of a parallel rendering
+        try:
+            if future is None:
+                note.getRendered()
+            else:
+                note._setRendered(future.result())
+        except Exception as e:
+            print("Couldn't load note %s: %s" % (note.getFilename(), str(e)))
+
+    def _renderParallel(self, notes):
+        # Rendering is CPU bound pure python, so processes are used to get around the GIL. They
+        # are spawned, as forking a process with more threads, as a worker loading a notebook on
+        # first request, can deadlock the child on locks held by the other threads
+        with concurrent.futures.ProcessPoolExecutor(
+                self.LoadProcesses, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(renderNote, note.Note) for note in notes]
+            for note, future in zip(notes, futures):
+                self._renderNote(note, future)
+
+    def saveCache(self):
+        if self.RenderCache:
+            self.RenderCache.save()
+
+    def reloadFile(self, filename):
+        """Bring the note stored in filename up to date with the file on disk. The file may have
+        been added, modified or deleted. Returns True if the collection changed"""
+        try:
+            return self._reloadFile(filename)
+        finally:
+            self._publish()
 
-    def findFromFullname(self, fullname):
-        for note in self.Notes:
-            if note.getFullname() == fullname:
-                return note
-        return None
+    def _reloadFile(self, filename):
+        if not filename.endswith("." + FILE_EXTENSION):
+            return False
 
-    def findNextDateIndex(self, date):
-        i = -1
-        for note in self.Notes:
-            if note.Date == date and note.DateIndex > i:
-                i = note.DateIndex
-        return i + 1
+        changed = False
+        old_note = self.findFromFilename(filename)
+        if old_note is not None:
+            self._remove(old_note)
+            changed = True
 
-    def findDate(self, date, date_index):
-        for note in self.Notes:
-            if note.Date == date and note.DateIndex  == date_index:
-                return True
-        return False
+        if os.path.isfile(self.Path + filename):
+            try:
+                note = Note.load(self.Path, filename, self.RenderCache, render=not self.Lazy)
+                self._add(note)
+                changed = True
+            except Exception as e:
+                print("Couldn't load note %s: %s" % (filename, str(e)))
+        elif self.RenderCache:
+            self.RenderCache.remove(filename)
+
+        return changed
+
+    def applyFileChanges(self, changes):
+        """Apply a list of (operation, filename) file changes as reported by DirWatcher, 
+        reloading only the affected notes. Returns the number of files that changed the collection"""
+
+        # The operations arrive unordered, and a rename is reported as an IN_MOVED_FROM and 
+        # IN_MOVED_TO pair. Whatever happened, the state of each file on disk is what matters:
+        filenames = set(filename for (operation, filename) in changes)
+        count = 0
+        try:
+            for filename in filenames:
+                if self._reloadFile(filename):
+                    count += 1
+        finally:
+            # All changes are published together
+            self._publish()
+        return count
+
+    def reloadModified(self):
+        """Bring the collection up to date with the files added, modified or deleted since the 
+        notes were loaded, without being reported by DirWatcher. Returns the number of files that
+        changed the collection"""
+        on_disk = set()
+        filenames = set()
+        for entry in os.scandir(self.Path):
+            if entry.name.endswith("." + FILE_EXTENSION) and entry.is_file():
+                on_disk.add(entry.name)
+                if self._isFileModified(entry.name, entry.stat()):
+                    filenames.add(entry.name)
+        # Deleted files
+        filenames.update(note.getFilename() for note in self.Notes 
+                         if note.getFilename() not in on_disk)
+        return self.applyFileChanges([("", filename) for filename in filenames])
+
+    def findModifiedFiles(self, filenames):
+        """Get the filenames among filenames whose files were added, modified or deleted since 
+        the notes were loaded from or saved to them"""
+        modified = []
+        for filename in filenames:
+            try:
+                stat = os.stat(self.Path + filename)
+            except FileNotFoundError:
+                stat = None
+            if self._isFileModified(filename, stat):
+                modified.append(filename)
+        return modified
+
+    def _isFileModified(self, filename, stat):
+        # Check the file against the note loaded from or saved to it, stat is None if the file 
+        # doesn't exist
+        note = self.findFromFilename(filename)
+        if note is None or stat is None:
+            return (note is None) != (stat is None)
+        return note.FileStat != Note.makeFileStat(stat)
+
+    def renewInstance(self):
+        """Make the collection a new instance, as for a new process serving it. Clients will 
+        load all notes again"""
+        self.InstanceId = uuid.uuid4().hex[:8]
 
     def addNote(self, note, old_fullname = None):
-        # Check if we need to replace an old note
-        if not old_fullname is None:
-            rm_note = self.findFromFullname(old_fullname)
-            if rm_note != None:
-                self._remove(rm_note)
-                try:
-                    note_fn = rm_note.getFilename()
-                    if self.PreFileChangeCallback:
-                        self.PreFileChangeCallback(note_fn)
-                    os.unlink(self.Path + note_fn)
-                except Exception as e:
-                    #raise Exception("Failed to delete note: %s, %s" % (old_fullname, str(e)))
-                    print("Failed to delete note: %s, %s" % (old_fullname, str(e)))
-        
-        # Adding a None note is equivalent to deleting it
-        if not note is None:
-            if self.findDate(note.Date, note.DateIndex):
-                note.DateIndex = self.findNextDateIndex(note.Date)
+        """Add note, replacing the note with old_fullname if given. Adding a None note is 
+        equivalent to deleting it"""
+        self.addNotes([(note, old_fullname)])
 
-            # Add new note and save it
+    def addNotes(self, changes, lock = None):
+        """Add a list of (note, old_fullname) as with addNote, writing the notes to disk first and
+        then updating the collection with all of them at once. 
+        
+        If lock is given, it's only held while updating the collection, not while writing. The
+        caller must not hold it. Concurrent calls of addNotes write one at a time"""
+        with self._writeLock:
+            done = []
+            try:
+                self._writeNotes(self._planNotes(changes), done)
+            finally:
+                # Whatever was written is applied, so the collection stays in line with the disk
+                if lock is None:
+                    self._applyNotes(done)
+                else:
+                    with lock:
+                        self._applyNotes(done)
+
+    def _planNotes(self, changes):
+        # Find the notes to remove and the date indexes of the notes to add, from the published 
+        # snapshot as it's not changed by writes while the write lock is held. Returns a list 
+        # of (note, rm_note) where either may be None
+        snapshot = self._snapshot
+        added = {} # Map from fullname to notes added by the changes
+        removed = set()
+        reserved = set()
+        plan = []
+        for (note, old_fullname) in changes:
+            rm_note = None
+            if old_fullname is not None:
+                rm_note = added.pop(old_fullname, None) or snapshot.findFromFullname(old_fullname)
+                if rm_note in removed:
+                    rm_note = None
+                if rm_note is not None:
+                    removed.add(rm_note)
+            if note is not None:
+                # Date indexes in use, not counting removed notes and counting added notes
+                taken = set(snapshot._dateIndexes.get(note.Date, ()))
+                taken.difference_update(x.DateIndex for x in removed if x.Date == note.Date)
+                taken.update(index for (date, index) in reserved if date == note.Date)
+                if note.DateIndex in taken:
+                    note.DateIndex = max(taken) + 1
+                reserved.add((note.Date, note.DateIndex))
+                added[note.getFullname()] = note
+            plan.append((note, rm_note))
+        return plan
+
+    def _writeNotes(self, plan, done):
+        # Write the new notes before deleting the replaced ones, so a failure never loses a note.
+        # Each (note, rm_note) is appended to done when written
+        removed = set(rm_note for (note, rm_note) in plan)
+        kept = set(note.getFilename() for (note, rm_note) in plan 
+                   if note is not None and note not in removed)
+        for (note, rm_note) in plan:
+            if note is None:
+                continue
+            note_fn = note.getFilename()
+            if self.PreFileChangeCallback:
+                self.PreFileChangeCallback(note_fn)
+                self.PreFileChangeCallback(makeTempFilename(note_fn))
+            try:
+                note.Save(self.Path + note_fn, self.Fsync)
+                if self.RenderCache:
+                    key = RenderCache.makeKey(os.stat(self.Path + note_fn), note.Note)
+                    note.setRenderCache(self.RenderCache, key)
+            except Exception as e:
+                raise Exception("Failed save note: %s" % str(e))
+            done.append((note, None))
+
+        for (note, rm_note) in plan:
+            if rm_note is None:
+                continue
+            done.append((None, rm_note))
+            note_fn = rm_note.getFilename()
+            if note_fn in kept:
+                # Replaced by a written note
+                continue
             try:
-                note_fn = note.getFilename()
                 if self.PreFileChangeCallback:
                     self.PreFileChangeCallback(note_fn)
-                note.Save(self.Path + note_fn)
-                self._add(note)
+                os.unlink(self.Path + note_fn)
+                if self.Fsync:
+                    fsyncDir(self.Path)
+                if self.RenderCache:
+                    self.RenderCache.remove(note_fn)
             except Exception as e:
-                raise Exception("Failed save note: %s" % str(e))
-            self.sortNotes()
+                print("Failed to delete note: %s, %s" % (rm_note.getFullname(), str(e)))
+
+    def _applyNotes(self, done):
+        # Apply written (note, None) and deleted (None, rm_note) to the collection, as one change
+        try:
+            for (note, rm_note) in done:
+                if rm_note is not None:
+                    if self.findFromFilename(rm_note.getFilename()) is rm_note:
+                        self._remove(rm_note)
+                else:
+                    # A note loaded from the file meanwhile, or the replaced note with the same
+                    # name, was overwritten
+                    old_note = self.findFromFilename(note.getFilename())
+                    if old_note is not None:
+                        self._remove(old_note)
+                    self._add(note)
+        finally:
+            self._publish()
+
+    def searchNotes(self, query, tags_filter = None, limit = None):
+        """Get notes matching the full-text query, best match first. See searchindex.py for the
+        query syntax. tags_filter is as for getNotes"""
+        if self._searchIndex is None:
+            # Indexing all notes takes time, so it's done when needed and then kept up to date 
+            # by _add and _remove
+            self._searchIndex = SearchIndex()
+            for note in self.Notes:
+                self._searchIndex.add(note, note.Name + "\n" + note.Note)
+        results = self._searchIndex.search(query)
+        if tags_filter is not None:
+            matches = self._current()._matchTags(tags_filter)
+            results = [(score, note) for (score, note) in results if note in matches]
+        # Equal scores are ordered newest first
+        results.sort(key=lambda r: (r[0], r[1].SortKey), reverse=True)
+        if limit is not None:
+            results = results[:limit]
+        return [note for (score, note) in results]
+
+    # Reading methods, see NoteSnapshot
+
+    def findFromFilename(self, filename):
+        return self._current().findFromFilename(filename)
+
+    def findFromFullname(self, fullname):
+        return self._current().findFromFullname(fullname)
+
+    def findNextDateIndex(self, date):
+        return self._current().findNextDateIndex(date)
+
+    def findDate(self, date, date_index):
+        return self._current().findDate(date, date_index)
 
     def getNotes(self, tags_filter = None):
-        ret = []
-        for note in self.Notes:
-            if tags_filter is None or (len(note.Tags & tags_filter) > 0):
-                # No filter or at least one tag match
-                ret.append(note)
-        return ret
-    
+        return self._current().getNotes(tags_filter)
+
+    def getNotesPage(self, tags_filter = None, limit = None, before = None, after = None, 
+                     date_from = None, date_to = None):
+        return self._current().getNotesPage(tags_filter, limit, before, after, date_from, date_to)
+
+    def getTodos(self, tags_filter = None, limit = None):
+        return self._current().getTodos(tags_filter, limit)
+
+    def getChanges(self, since):
+        return self._current().getChanges(since)
+
     def getNote(self, full_name):
-        for note in self.Notes:
-            if note.getFullname() == full_name:
-                return note
-        return None
+        return self._current().getNote(full_name)
 
     def getAllTags(self):
-        return sorted(self.AllTags)
+        return self._current().getAllTags()
+
+    def getTagCount(self, tag):
+        return self._current().getTagCount(tag)
 
 # ---- Tests
 
@@ -424,8 +1197,545 @@ def testMakeNoreferrerLinks():
     html = makeHtml(src)
     assert(' <a href="http://www.link.test" rel="noreferrer">www.link.test</a>' in html)
 
+def testRenderNoteMatchesTwoPass():
+    # Compare single pass rendering with the previous implementation, which converted the note
+    # once for the HTML and once more with tokens in FullSrc for finding the check offsets
+    def twoPassRender(note):
+        html = markdown.markdown(FindTagsRe.sub("", note.Note, count=1),
+            extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTCONFIG)
+        html = makeLinksNoReferrer(html)
+        tm = TokenMaker()
+        tokenized_html = markdown.markdown(MdCheckCandidateRe.sub(tm.makeToken, note.FullSrc), 
+            extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTCONFIG)
+        offsets = [tm.offsets[int(m.group(1))] for m in HtmlCheckTokenRe.finditer(tokenized_html)]
+        return (html, offsets, findTodos(html))
+
+    # The previous implementation is only valid as reference when the date and name lines of 
+    # FullSrc don't run into the note body, so each note starts with a blank line or a paragraph
+    corpus = [
+        "tags: A project, Markdown demo\n\nA table:\n\n| A | B |\n| --- | --- |\n| [ ] x | [x] y |\n\n"
+            "- [ ] Analyse the idea\n\n### First phase\n\n- [ ] Do this\n- [ ] Then do that\n",
+        "\n- [ ] This is some text\n   - [x] some more text [ ] a false check\n* - [X] and a final check\n"
+            "- [x ] this is not a check",
+        "Intro\n\n- [ ] check with www.link.test\n- [ ] https://example.com/x?y=1\n- [x] _em_ and **strong**",
+        "tags: a\n\n1. [ ] Numbered\n2. [x] Done\n\n    - [ ] Indented code [ ] here\n\n"
+            "```\n- [ ] fenced\n```\n\nInline `[ ] code` and [x] text\n\n- [ ]\n- [ ] \n",
+        "\n- [ ] Check1\n- [ ] Check2\n- [ ] Check3\n\n- [ ] Check4\n\n"
+            "Term\n:   [ ] definition\n\n> - [ ] quoted\n\n- item\n\n    [ ] sub paragraph",
+        "\nNo checks at all, [link](http://x.test) and <b>html</b>\n",
+    ]
+
+    for src in corpus:
+        note = Note.Parse(src)
+        (html, offsets, todos) = twoPassRender(note)
+        assert(note.Html == html)
+        assert(note.CheckOffsets == offsets)
+        assert(note.Todos == todos)
+        for offset in note.CheckOffsets:
+            assert(note.FullSrc[offset] in " xX")
+
+    # Text looking like a token is kept
+    src = "- [ ] Check ¤000д¤ and ¤1дд¤\n- [x] Done"
+    (html, offsets, todos) = renderNote(src)
+    assert("Check ¤000д¤ and ¤1дд¤" in html)
+    assert(offsets == [3, src.index("[x]") + 1])
+    assert(todos[0][0].endswith("Check ¤000д¤ and ¤1дд¤"))
+
+def testCheckOffsetsAfterHeader():
+    # A task list starting right after the tags line must map every check box to the src
+    note = Note.Parse("name: Test\ntags: a\n- [ ] one\n- [x] two\n\n- [ ] three")
+    assert(len(note.CheckOffsets) == 3)
+    assert([note.FullSrc[x] for x in note.CheckOffsets] == [" ", "x", " "])
+    assert(note.Todos == [("one", 0), ("three", 2)])
+
+def testMarkdownEngineThreads():
+    # Each thread must get its own engine, and the engines must give the same results
+    srcs = ["- [ ] Item %d\n\n| A | B |\n| --- | --- |\n| %d | www.link.test |" % (i, i) for i in range(20)]
+    expected = [renderNote(src) for src in srcs]
+    results = {}
+    engines = set()
+    def convertAll(thread_no):
+        engines.add(id(getMarkdownEngine()))
+        for i in range(len(srcs)):
+            results[(thread_no, i)] = renderNote(srcs[i])
+    threads = [threading.Thread(target=convertAll, args=(x,)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(len(engines) == 4)
+    for (thread_no, i), result in results.items():
+        assert(result == expected[i])
+
+def testRenderCache():
+    import tempfile
+    global renderNote
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        cache_filename = tmp + "/render.cache"
+        def writeFile(filename, text):
+            with open(path + filename, "w") as file:
+                file.write(text)
+
+        writeFile("2021-01-01 First.md", "tags: a\n\n- [ ] Todo www.link.test\n- [x] Done")
+        writeFile("2021-01-02 Second.md", "tags: b\nText")
+        note_col = NoteCollection(path, cache_filename)
+        assert(note_col.loadAll() == 2)
+        assert(os.path.isfile(cache_filename))
+        expected = [n.getNoteObj(src=True, todos=True, html=True) for n in note_col.getNotes()]
+
+        real_render_note = renderNote
+        rendered = []
+        def countingRenderNote(src):
+            rendered.append(src)
+            return real_render_note(src)
+        renderNote = countingRenderNote
+        try:
+            # Nothing should be rendered when loading from a warm cache
+            note_col = NoteCollection(path, cache_filename)
+            assert(note_col.loadAll() == 2)
+            assert(rendered == [])
+            assert([n.getNoteObj(src=True, todos=True, html=True) for n in note_col.getNotes()] == expected)
+
+            # Only the changed note is rendered, and the removed note is dropped from the cache
+            writeFile("2021-01-02 Second.md", "tags: b\nChanged")
+            os.unlink(path + "2021-01-01 First.md")
+            note_col = NoteCollection(path, cache_filename)
+            assert(note_col.loadAll() == 1)
+            assert(rendered == ["tags: b\nChanged"])
+            assert(list(note_col.RenderCache._entries.keys()) == ["2021-01-02 Second.md"])
+        finally:
+            renderNote = real_render_note
+
+def testParallelLoadAll():
+    import tempfile
+    global PARALLEL_RENDER_MIN_NOTES
+    min_notes = PARALLEL_RENDER_MIN_NOTES
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        for i in range(20):
+            with open(path + "2021-01-%02d Note %d.md" % (i + 1, i), "w") as file:
+                file.write("tags: t%d\n\n- [ ] Todo %d\n- [x] Done www.link.test" % (i % 3, i))
+        with open(path + "Not a date.md", "w") as file:
+            file.write("Not loaded")
+
+        serial = NoteCollection(path)
+        assert(serial.loadAll() == 20)
+        parallel = NoteCollection(path, tmp + "/render.cache", load_processes=4)
+        try:
+            PARALLEL_RENDER_MIN_NOTES = 0
+            assert(parallel.loadAll() == 20)
+        finally:
+            PARALLEL_RENDER_MIN_NOTES = min_notes
+        for a, b in zip(serial.getNotes(), parallel.getNotes()):
+            assert(a.getNoteObj(src=True, todos=True, html=True) == b.getNoteObj(src=True, todos=True, html=True))
+        assert(len(parallel.RenderCache._entries) == 20)
+
+def testLazyLoadAll():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        with open(path + "2021-01-01 First.md", "w") as file:
+            file.write("tags: a, b\n\n- [ ] Todo\n- [x] Done")
+        with open(path + "2021-01-02.md", "w") as file:
+            file.write("No tags")
+
+        note_col = NoteCollection(path, tmp + "/render.cache", lazy=True)
+        assert(note_col.loadAll() == 2)
+        assert(note_col.getAllTags() == ["a", "b"])
+        note = note_col.getNote("2021-01-01 First")
+        assert(not note.isRendered())
+        assert(note.getNoteObj()["tags"] == ["a", "b"])
+        assert(not note.isRendered())
+
+        # Rendered and cached on first use
+        obj = note.getNoteObj(src=True, todos=True, html=True)
+        assert(note.isRendered())
+        assert(obj["todos"] == [("Todo", 0)])
+        assert([obj["src"][x] for x in obj["check_offsets"]] == [" ", "x"])
+        assert(list(note_col.RenderCache._entries.keys()) == ["2021-01-01 First.md"])
+
+def testIndexes():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A/B"))
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: Other"))
+        note_col.addNote(Note.Parse("date: 2021-01-02"))
+        assert(note_col.findFromFullname("2021-01-01 A/B").Name == "A/B")
+        assert(note_col.findFromFilename("2021-01-01 A%2FB.md").Name == "A/B")
+        assert(note_col.getNote("2021-01-01.1 Other").DateIndex == 1)
+        assert(note_col.findDate("2021-01-01", 1))
+        assert(not note_col.findDate("2021-01-03", 0))
+        assert(note_col.findNextDateIndex("2021-01-01") == 2)
+        assert(note_col.findNextDateIndex("2021-01-03") == 0)
+
+        # Replace and delete notes, each change increments the generation
+        generation = note_col.Generation
+        note_col.addNote(Note.Parse("date: 2021-01-05\nname: Moved"), "2021-01-01 A/B")
+        assert(note_col.Generation > generation)
+        generation = note_col.Generation
+        note_col.addNote(None, "2021-01-02")
+        assert(note_col.Generation > generation)
+        assert(note_col.findFromFullname("2021-01-01 A/B") is None)
+        assert(note_col.findFromFilename("2021-01-01 A%2FB.md") is None)
+        assert(note_col.getNote("2021-01-05 Moved").Name == "Moved")
+        assert(not note_col.findDate("2021-01-02", 0))
+        assert(note_col.findNextDateIndex("2021-01-01") == 2)
+        assert(note_col.findNextDateIndex("2021-01-02") == 0)
+        assert(sorted(note_col.getSnapshot()._byFilename.keys()) == sorted(os.listdir(tmp)))
+
+def testSnapshots():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A\ntags: x"))
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: B\ntags: x\n\n- [ ] Todo"))
+        snapshot = note_col.getSnapshot()
+
+        # Changes are made to a copy, leaving the old snapshot as it was
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: C\ntags: x, y"))
+        note_col.addNote(None, "2021-01-02 B")
+        assert([n.getFullname() for n in snapshot.Notes] == ["2021-01-02 B", "2021-01-01 A"])
+        assert(snapshot.getTagCount("x") == 2)
+        assert(snapshot.getAllTags() == ["x"])
+        assert(not snapshot.findDate("2021-01-01", 1))
+        assert(len(snapshot.getTodos()) == 1)
+        assert(snapshot.Generation < note_col.getSnapshot().Generation)
+
+        snapshot = note_col.getSnapshot()
+        assert([n.getFullname() for n in snapshot.Notes] == ["2021-01-01.1 C", "2021-01-01 A"])
+        assert(snapshot.getTagCount("x") == 2)
+        assert(snapshot.getAllTags() == ["x", "y"])
+        assert(snapshot.findDate("2021-01-01", 1))
+        assert(len(snapshot.getTodos()) == 0)
+
+def testGetChanges():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A"))
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: B"))
+        note_col.addNote(Note.Parse("date: 2021-01-03\nname: C"))
+        since = note_col.Generation
+        assert(note_col.getChanges(since) == ([], []))
+
+        def changes(since):
+            (notes, deleted) = note_col.getChanges(since)
+            return ([(index, note.getFullname()) for (index, note) in notes], deleted)
+
+        # Replacing, renaming and deleting, with only the latest state of each note reported
+        note_col.addNote(Note.Parse("date: 2021-01-03\nname: C\n\nNew text"), "2021-01-03 C")
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: B2"), "2021-01-02 B")
+        note_col.addNote(Note.Parse("date: 2021-01-04\nname: D"))
+        note_col.addNote(None, "2021-01-04 D")
+        note_col.addNote(None, "2021-01-01 A")
+        assert(changes(since) == ([(0, "2021-01-03 C"), (1, "2021-01-02 B2")], 
+                                  ["2021-01-01 A", "2021-01-02 B", "2021-01-04 D"]))
+        assert(changes(note_col.Generation - 1) == ([], ["2021-01-01 A"]))
+
+        # Unknown generations and old changes require a reload
+        assert(note_col.getChanges(note_col.Generation + 1) is None)
+        for i in range(CHANGE_LOG_SIZE):
+            note_col.addNote(Note.Parse("date: 2021-01-04\nname: D\n\n%d" % i), 
+                             None if i == 0 else "2021-01-04 D")
+        assert(note_col.getChanges(since) is None)
+        assert(changes(note_col.Generation - CHANGE_LOG_SIZE) == ([(0, "2021-01-04 D")], []))
+        note_col.loadAll()
+        assert(note_col.getChanges(note_col.Generation - 1) is None)
+        assert(note_col.getChanges(note_col.Generation) == ([], []))
+
+def testAddNotes():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/", fsync=True)
+        ignored = []
+        note_col.setPreFileChangeCallback(ignored.append)
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A\n\nOld"))
+
+        class CountingLock:
+            count = 0
+            def __enter__(self):
+                self.count += 1
+            def __exit__(self, *args):
+                pass
+
+        # A batch replacing a note, adding two notes of the same date and deleting one
+        lock = CountingLock()
+        note_col.addNotes([(Note.Parse("date: 2021-01-01\nname: A\n\nNew"), "2021-01-01 A"),
+                           (Note.Parse("date: 2021-01-02\nname: B"), None),
+                           (Note.Parse("date: 2021-01-02\nname: C"), None),
+                           (None, "2021-01-02 B")], lock)
+        assert(lock.count == 1)
+        assert([n.getFullname() for n in note_col.Notes] == ["2021-01-02.1 C", "2021-01-01 A"])
+        assert(note_col.getNote("2021-01-01 A").Note == "\nNew")
+        assert(sorted(os.listdir(tmp)) == ["2021-01-01 A.md", "2021-01-02.1 C.md"])
+        assert(makeTempFilename("2021-01-02.1 C.md") in ignored)
+
+        # A failing write leaves the note on disk and in the collection
+        note = Note.Parse("date: 2021-01-03\nname: D")
+        note.Note = None
+        try:
+            note_col.addNote(note, "2021-01-01 A")
+            assert(False)
+        except Exception:
+            pass
+        assert(note_col.getNote("2021-01-01 A").Note == "\nNew")
+        assert(sorted(os.listdir(tmp)) == ["2021-01-01 A.md", "2021-01-02.1 C.md"])
+
+def testNoteJson():
+    note = Note.Parse("date: 2021-01-01\nname: A\ntags: b, a\n\n- [ ] Todo")
+    for (src, todos, html) in [(False, False, False), (True, True, True), (False, True, False)]:
+        js = note.getNoteJson(src=src, todos=todos, html=html)
+        assert(js == json.dumps(note.getNoteObj(src=src, todos=todos, html=html)))
+        assert(note.getNoteJson(src=src, todos=todos, html=html) is js)
+    # A changed date index must not be served from the cache
+    note.DateIndex = 1
+    assert(json.loads(note.getNoteJson(src=True))["fullname"] == "2021-01-01.1 A")
+    assert(json.loads(note.getNoteJson(src=True))["src"].startswith("date: 2021-01-01.1\n"))
+
+def testTagIndex():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        note_col.addNote(Note.Parse("date: 2021-01-01\ntags: a, b"))
+        note_col.addNote(Note.Parse("date: 2021-01-02\ntags: b"))
+        note_col.addNote(Note.Parse("date: 2021-01-03\nNo tags"))
+        assert(note_col.getAllTags() == ["a", "b"])
+        assert(note_col.getTagCount("b") == 2)
+        assert(note_col.getTagCount("") == 1)
+
+        def fullnames(tags_filter):
+            return [n.getFullname() for n in note_col.getNotes(tags_filter)]
+        assert(fullnames(None) == ["2021-01-03", "2021-01-02", "2021-01-01"])
+        assert(fullnames({"a"}) == ["2021-01-01"])
+        assert(fullnames({"a", "b"}) == ["2021-01-02", "2021-01-01"])
+        assert(fullnames({""}) == ["2021-01-03"])
+        assert(fullnames({"", "a"}) == ["2021-01-03", "2021-01-01"])
+        assert(fullnames({"c"}) == [])
+
+        # Removing the last note with a tag removes the tag
+        note_col.addNote(Note.Parse("date: 2021-01-01\ntags: b, c"), "2021-01-01")
+        assert(note_col.getAllTags() == ["b", "c"])
+        assert(note_col.getTagCount("b") == 2)
+        note_col.addNote(None, "2021-01-03")
+        assert(note_col.getTagCount("") == 0)
+        assert(fullnames({""}) == [])
+
+def testOrderedInsertion():
+    import random
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        rnd = random.Random(1)
+        for i in range(100):
+            note = Note.Parse("date: 2021-%02d-%02d\nname: %s" % (rnd.randint(1, 12), rnd.randint(1, 28), 
+                                                                 rnd.choice(["a", "b", "", "c d"])))
+            if rnd.random() < 0.3 and len(note_col.Notes) > 0:
+                note_col.addNote(note, rnd.choice(note_col.Notes).getFullname())
+            else:
+                note_col.addNote(note)
+            names = [n.getSortingName() for n in note_col.Notes]
+            assert(names == sorted(names, reverse=True))
+            assert(note_col.getSnapshot()._sortKeys == names)
+
+def testGetNotesPage():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        for day in range(1, 11):
+            note_col.addNote(Note.Parse("date: 2021-01-%02d\ntags: %s" % (day, "even" if day % 2 == 0 else "odd")))
+        note_col.addNote(Note.Parse("date: 2021-01-05\nname: Second"))
+
+        def fullnames(notes):
+            return [n.getFullname() for n in notes]
+
+        # Paging through all notes
+        (notes, cursor) = note_col.getNotesPage(limit=4)
+        assert(fullnames(notes) == ["2021-01-10", "2021-01-09", "2021-01-08", "2021-01-07"])
+        (notes, cursor) = note_col.getNotesPage(limit=4, before=cursor)
+        assert(fullnames(notes) == ["2021-01-06", "2021-01-05.1 Second", "2021-01-05", "2021-01-04"])
+        (notes, cursor) = note_col.getNotesPage(limit=4, before=cursor)
+        assert(fullnames(notes) == ["2021-01-03", "2021-01-02", "2021-01-01"])
+        assert(cursor is None)
+
+        # Exact page size gives no cursor, newer notes with after
+        (notes, cursor) = note_col.getNotesPage(limit=11)
+        assert(len(notes) == 11 and cursor is None)
+        (notes, cursor) = note_col.getNotesPage(after=note_col.getNote("2021-01-08").SortKey)
+        assert(fullnames(notes) == ["2021-01-10", "2021-01-09"])
+
+        # Date range and tags
+        (notes, cursor) = note_col.getNotesPage(date_from="2021-01-04", date_to="2021-01-05")
+        assert(fullnames(notes) == ["2021-01-05.1 Second", "2021-01-05", "2021-01-04"])
+        (notes, cursor) = note_col.getNotesPage({"even"}, limit=2, date_to="2021-01-09")
+        assert(fullnames(notes) == ["2021-01-08", "2021-01-06"])
+        (notes, cursor) = note_col.getNotesPage({"even", ""}, limit=2, before=cursor)
+        assert(fullnames(notes) == ["2021-01-05.1 Second", "2021-01-04"])
+        (notes, cursor) = note_col.getNotesPage(date_from="2021-02-01")
+        assert(notes == [] and cursor is None)
+
+        # A page must have room for a note
+        try:
+            note_col.getNotesPage(limit=0)
+            assert(False)
+        except ValueError:
+            pass
+
+def testGetTodos():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(tmp + "/2021-01-01 Old.md", "w") as f:
+            f.write("tags: home\n\n- [ ] Paint\n- [x] Clean\n- [ ] Fix door")
+        with open(tmp + "/2021-01-03 Done.md", "w") as f:
+            f.write("- [x] All done")
+        note_col = NoteCollection(tmp + "/", lazy=True)
+        note_col.loadAll()
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: Work\ntags: job\n\n- [ ] Report"))
+        note_col.addNote(Note.Parse("date: 2021-01-04\n\n`[ ] ` is not a todo"))
+
+        def todos(**kwargs):
+            return [(n.getFullname(), text, index) for (n, text, index) in note_col.getTodos(**kwargs)]
+
+        assert(todos() == [("2021-01-02 Work", "Report", 0), ("2021-01-01 Old", "Paint", 0), 
+                           ("2021-01-01 Old", "Fix door", 2)])
+        assert(todos(limit=2) == [("2021-01-02 Work", "Report", 0), ("2021-01-01 Old", "Paint", 0)])
+        assert(todos(tags_filter={"home"}) == [("2021-01-01 Old", "Paint", 0), 
+                                               ("2021-01-01 Old", "Fix door", 2)])
+
+        # Checking off and deleting notes updates the todos
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: Work\n\n- [x] Report"), "2021-01-02 Work")
+        note_col.addNote(None, "2021-01-01 Old")
+        assert(todos() == [])
+        note_col.addNote(Note.Parse("date: 2021-01-03\nname: New\n\n- [ ] New"))
+        assert(todos() == [("2021-01-03.1 New", "New", 0)])
+
+def testSearchNotes():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = NoteCollection(tmp + "/")
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: Shopping\ntags: home\n\n- [ ] Buy milk"))
+        note_col.addNote(Note.Parse("date: 2021-01-02\nname: Work\ntags: job\n\nMilk the milky way, milk"))
+        note_col.addNote(Note.Parse("date: 2021-01-03\n\nNothing here"))
+
+        def fullnames(notes):
+            return [n.getFullname() for n in notes]
+
+        assert(fullnames(note_col.searchNotes("milk")) == ["2021-01-02 Work", "2021-01-01 Shopping"])
+        assert(fullnames(note_col.searchNotes("milk", tags_filter={"home"})) == ["2021-01-01 Shopping"])
+        assert(fullnames(note_col.searchNotes("milk", limit=1)) == ["2021-01-02 Work"])
+        assert(fullnames(note_col.searchNotes("shopping")) == ["2021-01-01 Shopping"])
+        assert(fullnames(note_col.searchNotes('"buy milk"')) == ["2021-01-01 Shopping"])
+        assert(fullnames(note_col.searchNotes("mil*")) == ["2021-01-02 Work", "2021-01-01 Shopping"])
+
+        # The index follows replaced and deleted notes
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: Shopping\n\n- [ ] Buy bread"), 
+                         "2021-01-01 Shopping")
+        assert(fullnames(note_col.searchNotes("milk")) == ["2021-01-02 Work"])
+        assert(fullnames(note_col.searchNotes("bread")) == ["2021-01-01 Shopping"])
+        note_col.addNote(None, "2021-01-02 Work")
+        assert(note_col.searchNotes("milk") == [])
+
+def testApplyFileChanges():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        def writeFile(filename, text):
+            with open(path + filename, "w") as file:
+                file.write(text)
+
+        writeFile("2021-01-01 First.md", "tags: a\n- [ ] Todo")
+        writeFile("2021-01-02 Second.md", "tags: b\nText")
+        note_col = NoteCollection(path)
+        assert(note_col.loadAll() == 2)
+
+        # Modify, add and irrelevant file
+        writeFile("2021-01-01 First.md", "tags: c\nNo todos")
+        writeFile("2021-01-03.md", "Third")
+        writeFile("readme.txt", "Not a note")
+        changes = [("IN_CLOSE_WRITE", "2021-01-01 First.md"), ("IN_CLOSE_WRITE", "2021-01-03.md"),
+                   ("IN_CLOSE_WRITE", "readme.txt")]
+        assert(note_col.applyFileChanges(changes) == 2)
+        assert([n.getFullname() for n in note_col.getNotes()] == 
+               ["2021-01-03", "2021-01-02 Second", "2021-01-01 First"])
+        assert(note_col.getNote("2021-01-01 First").Todos == [])
+        assert(note_col.getAllTags() == ["b", "c"])
+
+        # Rename and delete
+        os.rename(path + "2021-01-02 Second.md", path + "2021-01-04 Renamed.md")
+        os.unlink(path + "2021-01-03.md")
+        changes = [("IN_MOVED_TO", "2021-01-04 Renamed.md"), ("IN_DELETE", "2021-01-03.md"),
+                   ("IN_MOVED_FROM", "2021-01-02 Second.md")]
+        assert(note_col.applyFileChanges(changes) == 3)
+        assert([n.getFullname() for n in note_col.getNotes()] == 
+               ["2021-01-04 Renamed", "2021-01-01 First"])
+
+def testReloadModified():
+    import tempfile
+    import time
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        def writeFile(filename, text, age = 0):
+            with open(path + filename, "w") as file:
+                file.write(text)
+            os.utime(path + filename, (time.time() - age, time.time() - age))
+
+        writeFile("2021-01-01 First.md", "One", 10)
+        writeFile("2021-01-02 Second.md", "Two", 10)
+        writeFile("2021-01-03 Third.md", "Three", 10)
+        note_col = NoteCollection(path)
+        assert(note_col.loadAll() == 3)
+        assert(note_col.reloadModified() == 0)
+
+        # Changes made unnoticed, such as while forking a process, including an old file added
+        # and a file synced with the size and modification time kept
+        writeFile("2021-01-01 First.md", "Changed")
+        os.unlink(path + "2021-01-02 Second.md")
+        writeFile("2021-01-04 Old.md", "Old", 10)
+        writeFile("readme.txt", "Not a note")
+        stat = os.stat(path + "2021-01-03 Third.md")
+        writeFile("2021-01-03 Third.md", "Synced")
+        os.truncate(path + "2021-01-03 Third.md", stat.st_size)
+        os.utime(path + "2021-01-03 Third.md", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert(note_col.reloadModified() == 4)
+        assert([n.getFullname() for n in note_col.getNotes()] == 
+               ["2021-01-04 Old", "2021-01-03 Third", "2021-01-01 First"])
+        assert(note_col.getNote("2021-01-01 First").Note == "Changed")
+        assert(note_col.getNote("2021-01-03 Third").Note == "Synce")
+
+        # Notes saved by the collection are up to date
+        note_col.addNote(Note.Parse("date: 2021-01-05\nname: Saved"))
+        assert(note_col.reloadModified() == 0)
+        filenames = ["2021-01-05 Saved.md", "2021-01-02 Second.md", "2021-01-06 New.md"]
+        assert(note_col.findModifiedFiles(filenames) == [])
+        writeFile("2021-01-05 Saved.md", "Changed after saving")
+        writeFile("2021-01-06 New.md", "New")
+        assert(note_col.findModifiedFiles(filenames) == ["2021-01-05 Saved.md", "2021-01-06 New.md"])
+
+        instance_id = note_col.InstanceId
+        note_col.renewInstance()
+        assert(note_col.InstanceId != instance_id)
+
 def testsRun():
     testFindCheckOffsets()
     testFindUncheckedHtmlRe()
     testFindUncheckedHtmlRe2()
     testMakeNoreferrerLinks()
+    testRenderNoteMatchesTwoPass()
+    testCheckOffsetsAfterHeader()
+    testMarkdownEngineThreads()
+    testRenderCache()
+    testParallelLoadAll()
+    testLazyLoadAll()
+    testIndexes()
+    testSnapshots()
+    testGetChanges()
+    testAddNotes()
+    testNoteJson()
+    testTagIndex()
+    testOrderedInsertion()
+    testGetNotesPage()
+    testGetTodos()
+    testSearchNotes()
+    testApplyFileChanges()
+    testReloadModified()
@@ -0,0 +1,218 @@
+"""
+notestore.py - Note store file shared by processes serving the same notebook
+
+MIT license - see LICENSE file in Notes'n'Todos project root
+
+The process owning a NoteCollection writes each published snapshot to a store file with
+StoreWriter. Other processes map the store file into memory with NoteStore and read the notes
+from there, without loading or rendering them themselves.
+
+The store file is replaced atomically on every change. It holds:
+
+- A header line and the length of the index
+- The index as JSON, with the properties of each note and the location of its data
+- The data: The rendered note and its source as JSON fragments, which are joined into the
+  JSON of getNoteObj without decoding them
+
+Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
+"""
+
+import os
+import json
+import mmap
+import struct
+import weakref
+import threading
+from .notes import NoteSnapshot, encodeFilename, assembleDate, FILE_EXTENSION
+
+STORE_HEADER = b"notesntodos store 1\n"
+STORE_LENGTH = struct.Struct("<Q")
+
+# Data fragments of each note, in this order
+FRAGMENT_BASE = 0
+FRAGMENT_TODOS = 1
+FRAGMENT_SRC = 2
+FRAGMENT_CHECK_OFFSETS = 3
+FRAGMENT_HTML = 4
+
+def makeFragments(note):
+    """ Make the JSON fragments of note, getNoteObj(...) can be assembled from these """
+    base = json.dumps(note.getNoteObj())
+    return [x.encode("utf-8") for x in (base[:-1], json.dumps(note.Todos), json.dumps(note.FullSrc),
+                                        json.dumps(note.CheckOffsets), json.dumps(note.Html))]
+
+class StoreWriter:
+    def __init__(self, filename):
+        self.Filename = filename
+        # Notes are replaced rather than changed, so their fragments can be kept until dropped
+        self._fragments = weakref.WeakKeyDictionary()
+
+    def write(self, instance_id, snapshot):
+        """ Write snapshot to the store file, replacing it atomically """
+        notes = []
+        data = []
+        offset = 0
+        for note in snapshot.Notes:
+            fragments = self._fragments.get(note)
+            if fragments is None:
+                fragments = makeFragments(note)
+                self._fragments[note] = fragments
+            locations = []
+            for fragment in fragments:
+                locations += [offset, len(fragment)]
+                offset += len(fragment)
+            data += fragments
+            notes.append([note.Date, note.DateIndex, note.Name, sorted(note.Tags),
+                          note.mayHaveTodos(), locations])
+        index = json.dumps({"instance" : instance_id, "generation" : snapshot.Generation,
+                            "changes" : snapshot._changes, "changes_start" : snapshot._changesStart,
+                            "notes" : notes}).encode("utf-8")
+
+        tmp_filename = self.Filename + ".tmp"
+        with open(tmp_filename, "wb") as file:
+            file.write(STORE_HEADER)
+            file.write(STORE_LENGTH.pack(len(index)))
+            file.write(index)
+            for fragment in data:
+                file.write(fragment)
+        os.replace(tmp_filename, self.Filename)
+
+class StoredNote:
+    """ A note in a store file, providing the methods of Note used for serving it """
+
+    def __init__(self, data, date, date_index, name, tags, may_have_todos, locations):
+        self.Date = date
+        self.DateIndex = date_index
+        self.Name = name
+        self.Tags = set(tags)
+        self.SortKey = None
+        self._data = data
+        self._mayHaveTodos = may_have_todos
+        self._locations = locations
+
+    def _fragment(self, i):
+        offset = self._locations[i * 2]
+        return str(self._data[offset : offset + self._locations[i * 2 + 1]], "utf-8")
+
+    @property
+    def Todos(self):
+        return json.loads(self._fragment(FRAGMENT_TODOS))
+
+    @property
+    def Html(self):
+        return json.loads(self._fragment(FRAGMENT_HTML))
+
+    def getFullname(self):
+        date = assembleDate(self.Date, self.DateIndex)
+        if len(self.Name) > 0:
+            return "%s %s" % (date, self.Name)
+        else:
+            return date
+
+    def getSortingName(self):
+        return "%s.%02d %s" % (self.Date, self.DateIndex, self.Name)
+
+    def getFilename(self):
+        return encodeFilename(self.getFullname() + "." + FILE_EXTENSION)
+
+    def mayHaveTodos(self):
+        return self._mayHaveTodos
+
+    def getNoteJson(self, src=False, todos=False, html=False):
+        parts = [self._fragment(FRAGMENT_BASE)]
+        if todos:
+            parts += [', "todos": ', self._fragment(FRAGMENT_TODOS)]
+        if src:
+            parts += [', "src": ', self._fragment(FRAGMENT_SRC),
+                      ', "check_offsets": ', self._fragment(FRAGMENT_CHECK_OFFSETS)]
+        if html:
+            parts += [', "html": ', self._fragment(FRAGMENT_HTML)]
+        parts.append("}")
+        return "".join(parts)
+
+    def getNoteObj(self, src=False, todos=False, html=False):
+        return json.loads(self.getNoteJson(src=src, todos=todos, html=html))
+
+class NoteStore:
+    """ Reads a store file written by StoreWriter, mapping it again whenever it's replaced """
+
+    def __init__(self, filename):
+        self.Filename = filename
+        self.InstanceId = None
+        self._snapshot = None
+        self._fileId = None
+        self._lock = threading.Lock()
+
+    def getSnapshot(self):
+        """ Get NoteSnapshot of the notes in the store file as of now """
+        stat = os.stat(self.Filename)
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_id != self._fileId:
+            with self._lock:
+                if file_id != self._fileId:
+                    self._load()
+        return self._snapshot
+
+    def _load(self):
+        with open(self.Filename, "rb") as file:
+            stat = os.fstat(file.fileno())
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(STORE_HEADER)] != STORE_HEADER:
+            raise ValueError("Not a note store: " + self.Filename)
+        start = len(STORE_HEADER) + STORE_LENGTH.size
+        (index_len,) = STORE_LENGTH.unpack(data[len(STORE_HEADER) : start])
+        index = json.loads(data[start : start + index_len].decode("utf-8"))
+        # Note data is accessed through a view starting at the data
+        view = memoryview(data)[start + index_len:]
+
+        snapshot = NoteSnapshot()
+        for entry in index["notes"]:
+            snapshot._add(StoredNote(view, *entry), ordered=False)
+        snapshot._sort()
+        snapshot.Generation = index["generation"]
+        snapshot._changes = [tuple(change) for change in index["changes"]]
+        snapshot._changesStart = index["changes_start"]
+        self.InstanceId = index["instance"]
+        self._snapshot = snapshot
+        self._fileId = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+# ------
+
+def testNoteStore():
+    import tempfile
+    from .notes import Note, NoteCollection
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(tmp + "/notes")
+        note_col = NoteCollection(tmp + "/notes/", lazy=True)
+        writer = StoreWriter(tmp + "/notes.store")
+        note_col.setPublishCallback(lambda snapshot: writer.write(note_col.InstanceId, snapshot))
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: A/B æ\ntags: x, y\n\n- [ ] Todo\n\n*Hi*"))
+        note_col.addNote(Note.Parse("date: 2021-01-01\nname: C"))
+        note_col.addNote(Note.Parse("date: 2021-01-02"))
+
+        store = NoteStore(tmp + "/notes.store")
+        snapshot = store.getSnapshot()
+        assert(store.InstanceId == note_col.InstanceId)
+        assert(snapshot.Generation == note_col.Generation)
+        assert([n.getFullname() for n in snapshot.Notes] == [n.getFullname() for n in note_col.Notes])
+        assert(snapshot.getAllTags() == ["x", "y"])
+        for (stored, note) in zip(snapshot.Notes, note_col.Notes):
+            assert(stored.getFilename() == note.getFilename())
+            for flags in [(False, False, False), (True, True, True), (False, True, True)]:
+                assert(stored.getNoteJson(*flags) == note.getNoteJson(*flags))
+        assert([(n.getFullname(), text, index) for (n, text, index) in snapshot.getTodos()] ==
+               [("2021-01-01 A/B æ", "Todo", 0)])
+
+        # The store is mapped again when replaced
+        assert(store.getSnapshot() is snapshot)
+        note_col.addNote(None, "2021-01-02")
+        snapshot2 = store.getSnapshot()
+        assert(snapshot2 is not snapshot)
+        assert(len(snapshot2.Notes) == 2 and len(snapshot.Notes) == 3)
+        assert(snapshot2.findFromFullname("2021-01-01.1 C").getNoteObj(src=True) ==
+               note_col.getNote("2021-01-01.1 C").getNoteObj(src=True))
+        (notes, deleted) = snapshot2.getChanges(snapshot.Generation)
+        assert(notes == [] and deleted == ["2021-01-02"])
+
+def testsRun():
+    testNoteStore()
@@ -0,0 +1,189 @@
+"""
+searchindex.py - Inverted index for full-text search in Notes'n'Todos
+
+MIT license - see LICENSE file in Notes'n'Todos project root
+
+The SearchIndex maps each token to a posting list with the token count in each document. Phrases
+are matched in the token sequence of the documents that contain all tokens of the phrase.
+Documents are added and removed one at a time, so the index is kept up to date without rebuilds.
+
+Queries are whitespace separated terms that must all match:
+
+- word      matches documents containing the word
+- wor*      matches documents containing a word starting with "wor"
+- "a word"  matches documents containing the words in sequence
+
+Results are ranked by term frequency and inverse document frequency.
+
+Copyright 2021 - Lars Ole Pontoppidan <contact@larsee.com>
+"""
+
+import re
+import math
+import bisect
+import collections
+
+TokenRe = re.compile(r"\w+")
+QueryRe = re.compile(r'"([^"]*)"?|(\S+)')
+
+# When more tokens than this are pending for the sorted token list, it is rebuilt instead of
+# inserted into
+SORTED_REBUILD_THRESHOLD = 100
+
+def tokenize(text):
+    return TokenRe.findall(text.lower())
+
+class SearchIndex:
+    def __init__(self):
+        self._postings = {} # Map from token to map from document to token count
+        self._docTexts = {} # Map from document to its tokens joined by spaces, for phrase matching
+        self._sortedTokens = [] # Sorted tokens for prefix lookup, may contain removed tokens
+        self._pendingTokens = set() # Tokens not yet in _sortedTokens
+
+    def add(self, doc, text):
+        """ Add document doc with text. doc must be hashable and not already added """
+        tokens = tokenize(text)
+        postings = self._postings
+        for (token, count) in collections.Counter(tokens).items():
+            try:
+                postings[token][doc] = count
+            except KeyError:
+                postings[token] = {doc: count}
+                self._pendingTokens.add(token)
+        self._docTexts[doc] = " %s " % " ".join(tokens)
+
+    def remove(self, doc):
+        text = self._docTexts.pop(doc, "")
+        for token in set(text.split()):
+            posting = self._postings[token]
+            del posting[doc]
+            if len(posting) == 0:
+                # The token is left in _sortedTokens and skipped there until the next rebuild
+                del self._postings[token]
+                self._pendingTokens.discard(token)
+
+    def getDocCount(self):
+        return len(self._docTexts)
+
+    def search(self, query):
+        """ Get list of (score, doc) for documents matching all terms of query, unordered """
+        clauses = []
+        for (phrase, term) in QueryRe.findall(query):
+            if phrase:
+                tokens = tokenize(phrase)
+                if len(tokens) > 0:
+                    clauses.append(self._matchPhrase(tokens))
+            else:
+                tokens = tokenize(term)
+                if len(tokens) == 0:
+                    continue
+                if term.endswith("*"):
+                    last = tokens.pop()
+                    clauses.append(self._matchPrefix(last))
+                for token in tokens:
+                    clauses.append(self._matchToken(token))
+        if len(clauses) == 0:
+            return []
+
+        # Intersect matches starting with the rarest clause
+        clauses.sort(key=len)
+        if len(clauses[0]) == 0:
+            return []
+        doc_count = len(self._docTexts)
+        scores = {}
+        for doc in clauses[0]:
+            if all(doc in clause for clause in clauses[1:]):
+                scores[doc] = 0.0
+        for clause in clauses:
+            idf = math.log(1.0 + doc_count / len(clause))
+            for doc in scores:
+                scores[doc] += (1.0 + math.log(clause[doc])) * idf
+        return [(score, doc) for (doc, score) in scores.items()]
+
+    # Each _match method returns a map from matching document to term frequency
+
+    def _matchToken(self, token):
+        return self._postings.get(token, {})
+
+    def _matchPrefix(self, prefix):
+        ret = {}
+        for token in self._getTokensWithPrefix(prefix):
+            for (doc, count) in self._postings[token].items():
+                ret[doc] = ret.get(doc, 0) + count
+        return ret
+
+    def _matchPhrase(self, tokens):
+        if len(tokens) == 1:
+            return self._matchToken(tokens[0])
+        # Find the phrase in the documents that contain all its tokens
+        postings = [self._postings.get(token, {}) for token in tokens]
+        phrase = " %s " % " ".join(tokens)
+        ret = {}
+        for doc in min(postings, key=len):
+            if all(doc in posting for posting in postings):
+                count = self._docTexts[doc].count(phrase)
+                if count > 0:
+                    ret[doc] = count
+        return ret
+
+    def _getTokensWithPrefix(self, prefix):
+        self._updateSortedTokens()
+        i = bisect.bisect_left(self._sortedTokens, prefix)
+        while i < len(self._sortedTokens) and self._sortedTokens[i].startswith(prefix):
+            token = self._sortedTokens[i]
+            if token in self._postings:
+                yield token
+            i += 1
+
+    def _updateSortedTokens(self):
+        if len(self._pendingTokens) > SORTED_REBUILD_THRESHOLD:
+            self._sortedTokens = sorted(self._postings.keys())
+        else:
+            for token in self._pendingTokens:
+                i = bisect.bisect_left(self._sortedTokens, token)
+                if i == len(self._sortedTokens) or self._sortedTokens[i] != token:
+                    self._sortedTokens.insert(i, token)
+        self._pendingTokens = set()
+
+# ------
+
+def testSearchIndex():
+    index = SearchIndex()
+    index.add("a", "The quick brown fox jumps over the lazy dog")
+    index.add("b", "Quick thinking: the fox is quick, the dog is not")
+    index.add("c", "Brown bread and brownies")
+
+    def docs(query):
+        return sorted(doc for (score, doc) in index.search(query))
+
+    assert(docs("fox") == ["a", "b"])
+    assert(docs("FOX dog") == ["a", "b"])
+    assert(docs("fox bread") == [])
+    assert(docs("missing") == [])
+    assert(docs("") == [])
+    assert(docs("brown*") == ["a", "c"])
+    assert(docs("br*") == ["a", "c"])
+    assert(docs('"quick brown"') == ["a"])
+    assert(docs('"the fox"') == ["b"])
+    assert(docs('"the fox" dog') == ["b"])
+    assert(docs('"lazy dog') == ["a"])
+
+    # Ranking: b has "quick" twice
+    ranked = sorted(index.search("quick"), reverse=True)
+    assert([doc for (score, doc) in ranked] == ["b", "a"])
+
+    # Removal and re-adding updates postings and prefix lookup
+    index.remove("c")
+    assert(docs("brown*") == ["a"])
+    assert(docs("bread") == [])
+    index.add("c", "Breadcrumbs")
+    assert(docs("bread*") == ["c"])
+    assert(index.getDocCount() == 3)
+
+    # Many new tokens rebuild the sorted token list
+    for i in range(SORTED_REBUILD_THRESHOLD + 10):
+        index.add(i, "word%d" % i)
+    assert(docs("word10*") == [10] + list(range(100, SORTED_REBUILD_THRESHOLD + 10)))
+
+def testsRun():
+    testSearchIndex()
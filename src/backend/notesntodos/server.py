@@ -6,26 +6,181 @@ MIT license - see LICENSE file in Notes'n'Todos project root
 Gunicorn is used in a slightly unusual way here because of the NoteCollection 
 object which must stay alive and represent the state of the notebook, thus:
 
-- Exactly one instance of NoteCollection must exist for each notebook
+- Exactly one NoteCollection must make the changes to each notebook
 
 - When the gunicorn worker eventually restarts (it will happen at some point!), 
 the NoteCollection must be able to gracefully stop and correctly reload.
 
-To achieve this, gunicorn is run with just one worker and callback hooks for 
-creation and exit of workers. The single worker does use multiple gthreads, thus
-a lock is used to make sure NoteCollection is only called single threaded.
+To achieve this, gunicorn is run with callback hooks for creation and exit of workers.
+By default there is one worker with multiple gthreads, holding the note collections.
+Reads are served from the published snapshot of a collection without locking, while
+changes and searches take a lock per collection. With one worker, the collections are
+loaded when first requested, or preloaded before forking the worker, see 
+OnDemandNoteCollection.
+
+With more workers, a collection owner process holds the note collections and makes all
+changes, while the workers read the collections from shared store files and forward saves
+and searches to the owner, see runCollectionOwner.
+
+In the "asyncio" server mode, the workers are uvicorn workers running an event loop, 
+which serve the app from threads and stream the api/events of the notebooks, see asgi.py
+and events.py.
 
 Inotify, through DirWatcher, is used for monitoring the files in the notes folder,
-making the NoteCollection automatically reload in case of direct changes to the 
-files.
+making the NoteCollection automatically reload the affected notes in case of direct 
+changes to the files. The DirWatchers of all notebooks share one inotify thread.
 
 Copyright (c) 2021 - Lars Ole Pontoppidan <contact@larsee.com>
 """
 
+import os
+import gc
+import time
+import zlib
+import shutil
+import signal
+import tempfile
+import traceback
+import contextlib
+import multiprocessing.connection
+import gzip
+import json
+import mimetypes
 import threading
-from bottle import Bottle, request, response, redirect, static_file
-from .notes import Note, NoteCollection
-from .dirwatcher import DirWatcher
+import asyncio
+import functools
+from bottle import Bottle, request, response, redirect, static_file, HTTPResponse
+from .notes import Note, NoteCollection, checkDateFormat
+from .notestore import NoteStore, StoreWriter
+from .dirwatcher import DirWatcher, OVERFLOW_OPERATION, IGNORE_END_OPERATION
+from .events import ChangeNotifier, streamEvents
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# API responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+def acceptsEncoding(encoding):
+    accept = request.get_header("Accept-Encoding", "")
+    for item in accept.split(","):
+        params = item.split(";")
+        if params[0].strip() == encoding:
+            # Refused if given with q=0
+            return not any(x.strip() in ("q=0", "q=0.0", "q=0.00", "q=0.000") for x in params[1:])
+    return False
+
+def jsonResponse(obj):
+    """ Make JSON response of obj, compressed with brotli or gzip if the client accepts it """
+    body = json.dumps(obj).encode("utf-8")
+    response.content_type = "application/json"
+    response.set_header("Vary", "Accept-Encoding")
+    if len(body) >= COMPRESS_MIN_SIZE:
+        if brotli is not None and acceptsEncoding("br"):
+            body = brotli.compress(body, quality=5)
+            response.set_header("Content-Encoding", "br")
+        elif acceptsEncoding("gzip"):
+            body = gzip.compress(body, compresslevel=6)
+            response.set_header("Content-Encoding", "gzip")
+    return body
+
+# Streamed responses are sent in chunks of about this size
+STREAM_CHUNK_SIZE = 65536
+
+def streamResponse(fragments):
+    """ Make streamed response of the string fragments, compressed with brotli or gzip if the client
+    accepts it. The fragments are joined into chunks of about STREAM_CHUNK_SIZE """
+    response.set_header("Vary", "Accept-Encoding")
+    if brotli is not None and acceptsEncoding("br"):
+        compressor = brotli.Compressor(quality=5)
+        compress = compressor.process
+        flush = compressor.finish
+        response.set_header("Content-Encoding", "br")
+    elif acceptsEncoding("gzip"):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits 31 makes a gzip container
+        compress = compressor.compress
+        flush = compressor.flush
+        response.set_header("Content-Encoding", "gzip")
+    else:
+        compress = None
+
+    def generate():
+        chunk = []
+        size = 0
+        for fragment in fragments:
+            chunk.append(fragment)
+            size += len(fragment)
+            if size >= STREAM_CHUNK_SIZE:
+                data = "".join(chunk).encode("utf-8")
+                chunk = []
+                size = 0
+                if compress is not None:
+                    data = compress(data)
+                if len(data) > 0:
+                    yield data
+        data = "".join(chunk).encode("utf-8")
+        if compress is not None:
+            data = compress(data) + flush()
+        yield data
+    return generate()
+
+def streamNotes(notes, next_cursor, src, html, todos, extra = None):
+    """ Make streamed response of {"notes": [...], "next": next_cursor} with the items of extra 
+    added
+    
+    Notes are replaced rather than modified on changes, so the list can be serialized outside the
+    lock. Each note caches its JSON, so only new notes are serialized """
+    def fragments():
+        yield '{"notes": ['
+        for i, note in enumerate(notes):
+            if i > 0:
+                yield ", "
+            yield note.getNoteJson(src=src, html=html, todos=todos)
+        yield '], "next": %s' % json.dumps(next_cursor)
+        for (key, value) in (extra or {}).items():
+            yield ', %s: %s' % (json.dumps(key), json.dumps(value))
+        yield '}'
+    response.content_type = "application/json"
+    return streamResponse(fragments())
+
+def streamChanges(instance_id, snapshot, changes, src, html, todos):
+    """ Make streamed response of the (notes, deleted) changes from snapshot.getChanges """
+    (notes, deleted) = changes
+    def fragments():
+        yield '{"instance": %s, "generation": %d, "resync": false, "tags": %s, "deleted": %s' % (
+            json.dumps(instance_id), snapshot.Generation, json.dumps(snapshot.getAllTags()), 
+            json.dumps(deleted))
+        yield ', "notes": ['
+        for i, (index, note) in enumerate(notes):
+            if i > 0:
+                yield ", "
+            yield '{"index": %d, "note": %s}' % (index, note.getNoteJson(src=src, html=html, 
+                                                                          todos=todos))
+        yield ']}'
+    response.content_type = "application/json"
+    return streamResponse(fragments())
+
+def staticFile(filename, root):
+    """ Serve static file, or its precompressed .gz variant if present, up to date and the client
+    accepts it """
+    if acceptsEncoding("gzip"):
+        path = os.path.join(root, filename)
+        try:
+            use_gz = os.stat(path + ".gz").st_mtime >= os.stat(path).st_mtime
+        except OSError:
+            use_gz = False
+        if use_gz:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            ret = static_file(filename + ".gz", root=root, mimetype=mimetype)
+            if isinstance(ret, HTTPResponse) and ret.status_code in (200, 206):
+                ret.set_header("Content-Encoding", "gzip")
+                ret.set_header("Vary", "Accept-Encoding")
+            return ret
+    ret = static_file(filename, root=root)
+    ret.set_header("Vary", "Accept-Encoding")
+    return ret
 
 def serveRootRedirect(app, base_prefix, redirect_to):
     # base_prefix must be "/" or "/base/"
@@ -34,6 +189,33 @@ def serveRootRedirect(app, base_prefix, redirect_to):
     def redirectTo():
         redirect(redirect_to)
     
+def checkNotModified(note_col, snapshot):
+    """ Set ETag for a response from the read API, derived from the snapshot of the note collection
+    and the query. Returns True if the client already has it, and the response is set to 304
+    
+    Responses made from a newer state than the snapshot get an outdated ETag, which is harmless"""
+    # The ETag is weak, since the response may be compressed in different ways
+    etag = 'W/"%s-%d-%08x"' % (note_col.InstanceId, snapshot.Generation, 
+                             zlib.crc32((request.path + "?" + request.query_string).encode("utf-8")))
+    response.set_header("ETag", etag)
+    # Clients may cache the response, but must check if it's still valid:
+    response.set_header("Cache-Control", "no-cache")
+
+    if_none_match = request.get_header("If-None-Match", "")
+    if etag in [x.strip() for x in if_none_match.split(",")]:
+        response.status = 304
+        return True
+    return False
+
+def parseLimit():
+    """ Get the optional limit query parameter. Raises ValueError if it's not a positive number """
+    if len(request.query.limit) == 0:
+        return None
+    limit = int(request.query.limit)
+    if limit < 1:
+        raise ValueError("Invalid limit: %d" % limit)
+    return limit
+
 def serveNoteCollection(app, prefix, frontend_path, note_col, note_col_lock):
     # prefix must be "/" or "/notebook/" or "/base/notebook/"
     if prefix != "/":
@@ -44,17 +226,21 @@ def serveNoteCollection(app, prefix, frontend_path, note_col, note_col_lock):
 
     @app.route(prefix)
     def getIndex():
-        return static_file("index.html", root=frontend_path)
+        return staticFile("index.html", frontend_path)
 
     @app.route(prefix + '<filename>')
     def getFile(filename):
-        return static_file(filename, root=frontend_path)
+        return staticFile(filename, frontend_path)
+
+    # The read API uses the published snapshot of the note collection without taking the lock,
+    # so reads are not held up by changes
 
     @app.get(prefix + "api/gettags")
     def getNotes():
-        with note_col_lock:
-            tags = note_col.getAllTags()
-        return {"tags" : tags}
+        snapshot = note_col.getSnapshot()
+        if checkNotModified(note_col, snapshot):
+            return ""
+        return jsonResponse({"tags" : snapshot.getAllTags()})
 
     @app.get(prefix + "api/getnotes")
     def getNotes():
@@ -65,30 +251,127 @@ def serveNoteCollection(app, prefix, frontend_path, note_col, note_col_lock):
         src = request.query.src == '1'
         html = request.query.html == '1'
         todos = request.query.todos == '1'
-        notes_list = []
+
+        # Optional paging by limit and before/after cursors, and filtering by date range
+        try:
+            limit = parseLimit()
+            before = request.query.before if len(request.query.before) > 0 else None
+            after = request.query.after if len(request.query.after) > 0 else None
+            date_from = request.query.getunicode("from", default="")
+            date_to = request.query.getunicode("to", default="")
+            for date in (date_from, date_to):
+                if len(date) > 0 and not checkDateFormat(date):
+                    raise ValueError("Invalid date format: " + date)
+        except ValueError as e:
+            response.status = 400
+            return str(e)
+
+        snapshot = note_col.getSnapshot()
+        if checkNotModified(note_col, snapshot):
+            return ""
+
+        (notes, next_cursor) = snapshot.getNotesPage(tagsSet, limit, before, after, 
+                                    date_from if len(date_from) > 0 else None,
+                                    date_to if len(date_to) > 0 else None)
+
+        # The state of the notes is included, for getting the changes since with api/changes
+        return streamNotes(notes, next_cursor, src, html, todos, 
+                           {"instance" : note_col.InstanceId, "generation" : snapshot.Generation})
+
+    @app.get(prefix + "api/changes")
+    def getChanges():
+        # Notes changed or deleted since the generation of a previous response. If the changes
+        # are no longer known, or the server restarted, "resync" is true and the client must 
+        # load all notes again
+        src = request.query.src == '1'
+        html = request.query.html == '1'
+        todos = request.query.todos == '1'
+        try:
+            since = int(request.query.since)
+        except ValueError as e:
+            response.status = 400
+            return str(e)
+
+        snapshot = note_col.getSnapshot()
+        if checkNotModified(note_col, snapshot):
+            return ""
+
+        changes = None
+        if request.query.instance == note_col.InstanceId:
+            changes = snapshot.getChanges(since)
+        if changes is None:
+            return jsonResponse({"instance" : note_col.InstanceId, 
+                                 "generation" : snapshot.Generation, "resync" : True})
+        return streamChanges(note_col.InstanceId, snapshot, changes, src, html, todos)
+
+    @app.get(prefix + "api/gettodos")
+    def getTodos():
+        if len(request.query.tags) > 0:
+            tagsSet = set(request.query.tags.split(","))
+        else:
+            tagsSet = None
+        try:
+            limit = parseLimit()
+        except ValueError as e:
+            response.status = 400
+            return str(e)
+
+        snapshot = note_col.getSnapshot()
+        if checkNotModified(note_col, snapshot):
+            return ""
+
+        todos = snapshot.getTodos(tagsSet, limit)
+        return jsonResponse({"todos" : [{"fullname" : note.getFullname(), "date" : note.Date, 
+                                         "name" : note.Name, "tags" : sorted(note.Tags),
+                                         "text" : text, "index" : index}
+                                        for (note, text, index) in todos]})
+
+    @app.get(prefix + "api/search")
+    def searchNotes():
+        query = request.query.getunicode("q", default="")
+        if len(request.query.tags) > 0:
+            tagsSet = set(request.query.tags.split(","))
+        else:
+            tagsSet = None
+        src = request.query.src == '1'
+        html = request.query.html == '1'
+        todos = request.query.todos == '1'
+        try:
+            limit = parseLimit()
+        except ValueError as e:
+            response.status = 400
+            return str(e)
+
+        if checkNotModified(note_col, note_col.getSnapshot()):
+            return ""
+
+        # The search index is changed in place, so searching must hold the lock
         with note_col_lock:
-            notes = note_col.getNotes(tagsSet)
-            for note in notes:
-                notes_list.append(note.getNoteObj(src=src, html=html, todos=todos))
-        return {"notes" : notes_list}
+            notes = note_col.searchNotes(query, tagsSet, limit)
+        return streamNotes(notes, None, src, html, todos)
 
     @app.get(prefix + "api/getnote")
     def getNote():
         src = request.query.src == '1'
         html = request.query.html == '1'
         todos = request.query.todos == '1'
-        with note_col_lock:
-            note = note_col.findFromFullname(request.query.fullname)
-            if note:
-                ret = {"note" : note.getNoteObj(src=src, html=html, todos=todos)}
-            else:
-                ret = None
-        if ret:
-            return ret
+        snapshot = note_col.getSnapshot()
+        if checkNotModified(note_col, snapshot):
+            return ""
+        note = snapshot.findFromFullname(request.query.fullname)
+        if note:
+            return jsonResponse({"note" : note.getNoteObj(src=src, html=html, todos=todos)})
         else:
             response.status = 404
             return "Note not found"
 
+    @app.get(prefix + "api/events")
+    def getEvents():
+        # Event streams are served by AsgiApp in the asyncio server mode, see events.py. Here 
+        # each stream would occupy a thread, so browsers are told not to reconnect instead
+        response.status = 204
+        return ""
+
     @app.post(prefix + "api/savenotes")
     def saveNotes():
         try:
@@ -100,9 +383,9 @@ def serveNoteCollection(app, prefix, frontend_path, note_col, note_col_lock):
                 replace = n.get("replace")
                 add_list.append((note, replace))
             
-            with note_col_lock:
-                for note, replace in add_list:
-                    note_col.addNote(note, replace)
+            # The notes are written without holding the lock, which is taken for updating the
+            # collection with all of them at once
+            note_col.addNotes(add_list, note_col_lock)
 
             return {"status":"ok"}
             
@@ -119,21 +402,38 @@ def serveNoteCollection(app, prefix, frontend_path, note_col, note_col_lock):
             n = Note.Parse(note.get("src"))
             if n is None:
                 raise ValueError("Note is empty. Saving an empty note will delete it.")
-            return {"status":"ok", "note" : n.getNoteObj(html=True,todos=True)}
+            return jsonResponse({"status":"ok", "note" : n.getNoteObj(html=True,todos=True)})
         except Exception as e:
             response.status = 400
             return str(e)
 
+# Changes to the note files are reported when no more changes came for DIR_QUIET_S, or at most
+# DIR_MAX_WAIT_S after the first change during a burst of changes
+DIR_QUIET_S = 0.25
+DIR_MAX_WAIT_S = 2
+
 def setupDirWatcher(notes_path, note_col, note_col_lock):
     # Setup a dir watcher to reload note collection when files in notes_path change
     def dirChanged(changes):
-        # We don't really care about what changed, just reload everything
+        # Reload just the notes affected by the changes, or all notes if changes were missed
         # (while holding the note collection lock!)
         with note_col_lock:
-            notes = note_col.loadAll()
+            if any(operation == OVERFLOW_OPERATION for (operation, filename) in changes):
+                notes = note_col.loadAll()
+            else:
+                # Files changed while ignored were saved by the note collection, but may also 
+                # have been changed by others meanwhile
+                ignored = [filename for (operation, filename) in changes 
+                           if operation == IGNORE_END_OPERATION]
+                changes = [(operation, filename) for (operation, filename) in changes
+                           if operation != IGNORE_END_OPERATION]
+                changes += [("", filename) for filename in note_col.findModifiedFiles(ignored)]
+                if len(changes) == 0:
+                    return
+                notes = note_col.applyFileChanges(changes)
         print("Notes dir: %s changed, reloaded: %d notes" % (notes_path, notes))
         
-    dw = DirWatcher(notes_path[:-1], 3, dirChanged)
+    dw = DirWatcher(notes_path[:-1], DIR_QUIET_S, dirChanged, DIR_MAX_WAIT_S)
 
     # Ignore changes to files the note collection is about to change itself
     def ignoreFileChange(filename):
@@ -143,21 +443,157 @@ def setupDirWatcher(notes_path, note_col, note_col_lock):
 
     return dw
 
+class OnDemandNoteCollection:
+    """ Note collection activated on first use, that is loaded and watched for file changes, and
+    evicted from memory again by evictIfIdle. Provides the NoteCollection methods used by 
+    serveNoteCollection, which must use Lock as the note collection lock 
+    
+    Alternatively the notes are loaded by preload before forking the processes serving them, 
+    which each call resume """
+
+    def __init__(self, notes_path, cache_filename, load_processes, lazy_render, fsync):
+        self.Lock = threading.Lock()
+        self._args = (notes_path, cache_filename, load_processes, lazy_render, fsync)
+        self._activateLock = threading.Lock() # Held while activating or evicting
+        self._noteCol = None
+        self._dirWatcher = None
+        self._publishCallback = None
+        self._lastUsed = time.monotonic()
+        self._streams = 0 # Open event streams, which keep the collection in use
+
+    def activate(self):
+        """ Get the active note collection, loading it if needed """
+        self._lastUsed = time.monotonic()
+        note_col = self._noteCol
+        if note_col is None:
+            with self._activateLock:
+                if self._noteCol is None:
+                    note_col = self._load()
+                    self._dirWatcher = setupDirWatcher(self._args[0], note_col, self.Lock)
+                    self._noteCol = note_col
+                note_col = self._noteCol
+        return note_col
+
+    def _load(self):
+        print("Activating note collection in path: %s" % self._args[0])
+        note_col = NoteCollection(*self._args)
+        note_col.setPublishCallback(self._publishCallback)
+        print("Loaded: %d notes" % note_col.loadAll())
+        return note_col
+
+    def preload(self):
+        """ Load the notes without watching them, as no threads must run before forking """
+        with self._activateLock:
+            if self._noteCol is None:
+                self._noteCol = self._load()
+
+    def resume(self):
+        """ Start watching the preloaded notes in a forked process, bringing them up to date with
+        the changes made since they were loaded """
+        with self._activateLock:
+            if self._noteCol is None or self._dirWatcher is not None:
+                return
+            notes_path = self._args[0]
+            # The forked processes must not share the generations of the changes they make
+            self._noteCol.renewInstance()
+            self._dirWatcher = setupDirWatcher(notes_path, self._noteCol, self.Lock)
+            with self.Lock:
+                notes = self._noteCol.reloadModified()
+            print("Resumed note collection in path: %s, reloaded: %d notes" % (notes_path, notes))
+            self._lastUsed = time.monotonic()
+
+    def isActive(self):
+        return self._noteCol is not None
+
+    def evict(self):
+        """ Stop watching and forget the notes, if active """
+        with self._activateLock:
+            if self._noteCol is None:
+                return
+            print("Evicting note collection in path: %s" % self._args[0])
+            if self._dirWatcher is not None:
+                self._dirWatcher.stop()
+                self._dirWatcher.join()
+            with self.Lock:
+                self._noteCol.saveCache()
+            self._dirWatcher = None
+            self._noteCol = None
+
+    def evictIfIdle(self, idle_s):
+        """ Evict if not used for idle_s seconds. Returns True if evicted """
+        if (self._noteCol is None or self._streams > 0 or 
+            time.monotonic() - self._lastUsed < idle_s):
+            return False
+        self.evict()
+        return True
+
+    @property
+    def InstanceId(self):
+        # A new instance is made when activated again, so clients will load all notes again
+        return self.activate().InstanceId
+
+    def getSnapshot(self):
+        return self.activate().getSnapshot()
+
+    def setPublishCallback(self, publish_callback):
+        self._publishCallback = publish_callback
+
+    def addNotes(self, changes, lock = None):
+        return self.activate().addNotes(changes, lock)
+
+    def searchNotes(self, query, tags_filter = None, limit = None):
+        return self.activate().searchNotes(query, tags_filter, limit)
+
+async def streamOnDemandEvents(note_col, notifier, scope, send):
+    # Activating may load the notes, which must not hold up the event loop
+    note_col._streams += 1
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, note_col.activate)
+        await streamEvents(note_col, notifier, scope, send)
+    finally:
+        note_col._streams -= 1
+        note_col._lastUsed = time.monotonic()
+
 # --- Custom Gunicorn app ---
 
 import gunicorn.app.base
 
+# Server modes: gunicorn with gthread worker, or uvicorn worker running an asyncio event loop
+SERVER_MODES = ["gthread", "asyncio"]
+
 class CustomUnicornApp(gunicorn.app.base.BaseApplication):
     """ 
     This gunicorn app class provides create and exit callbacks for worker exit
-    and creation, and runs gunicorn with a single worker and multiple gthreads
+    and creation, and runs gunicorn with a single worker and multiple gthreads. More workers
+    require that the created apps share their state, see start
+
+    In the "asyncio" server mode, the worker is a uvicorn worker with an event loop, serving
+    the app through AsgiApp with multiple threads for handling requests
+
+    The start callback is called in the worker with the created app, to start its threads. With
+    preload, the app is created once in the gunicorn arbiter, and the workers forked from it 
+    just call the start callback
     """
-    def __init__(self, create_app_callback, exit_app_callback, host_port):
+    def __init__(self, create_app_callback, exit_app_callback, host_port, server_mode = "gthread",
+                 workers = 1, start_app_callback = None, preload = False):
+        if not server_mode in SERVER_MODES:
+            raise ValueError("Unknown server mode: %s" % server_mode)
         self._configBind = host_port
         self._createAppCallback = create_app_callback
+        self._startAppCallback = start_app_callback
         self._exitAppCallback = exit_app_callback
+        self._serverMode = server_mode
+        self._workers = workers
+        self._preload = preload
         super().__init__()
 
+    @staticmethod
+    def forkWorker(arbiter, worker):
+        # With preload, the app created in the arbiter must be started in each forked worker
+        self = worker.app
+        if self._preload and self._startAppCallback is not None:
+            self._startAppCallback(self._createdApp)
+
     @staticmethod
     def exitWorker(arbiter, worker):
         # worker.app provides us with a reference to "self", and we can call the 
@@ -167,15 +603,27 @@ class CustomUnicornApp(gunicorn.app.base.BaseApplication):
 
     def load_config(self):
         self.cfg.set("bind", self._configBind)
-        self.cfg.set("worker_class", "gthread")
-        self.cfg.set("workers", 1)
+        if self._serverMode == "asyncio":
+            self.cfg.set("worker_class", "notesntodos.asgi.AsgiWorker")
+        else:
+            self.cfg.set("worker_class", "gthread")
+        self.cfg.set("workers", self._workers)
         self.cfg.set("threads", 4)
         self.cfg.set("worker_exit", CustomUnicornApp.exitWorker)
+        self.cfg.set("post_fork", CustomUnicornApp.forkWorker)
+        self.cfg.set("preload_app", self._preload)
         # self.cfg.set("max_requests", 30) # Try this to test correct reloading of workers
         
     def load(self):
-        # This function is invoked when a worker is booted
+        # This function is invoked when a worker is booted, or in the arbiter with preload
         self._createdApp = self._createAppCallback()
+        if not self._preload and self._startAppCallback is not None:
+            self._startAppCallback(self._createdApp)
+        if self._serverMode == "asyncio":
+            # Imported here, as uvicorn is only required for this mode
+            from .asgi import AsgiApp
+            return AsgiApp(self._createdApp, self.cfg.threads, 
+                           getattr(self._createdApp, "streamHandlers", None))
         return self._createdApp
 
 # ---
@@ -185,7 +633,179 @@ def ensureNoSlash(s):
         raise ValueError("Path: '%s' must not end with /" % s)
     return s
 
-def start(frontend_path, host_port, notes_root, base_prefix = "/", books = ""):
+# --- Multi-process serving ---
+#
+# With more than one worker, a collection owner process loads the note collections, watches the
+# note dirs and makes all changes. Each published state of a collection is written to a store 
+# file, which the workers map into memory and serve reads from. Saves and searches are 
+# forwarded to the owner process.
+
+def storeFilename(store_dir, prefix):
+    return store_dir + "/notes" + ("" if prefix == "" else "-" + prefix) + ".store"
+
+def ownerAddress(store_dir):
+    return store_dir + "/owner.sock"
+
+def startCollectionOwner(notebooks, store_dir, authkey, load_processes, fsync):
+    """ Start the collection owner process, and wait until it serves the note collections.
+    Returns its pid
+
+    The process is forked directly rather than with multiprocessing, as the gunicorn workers 
+    are forked from this process too, and must not inherit it as a multiprocessing child """
+    (ready_read, ready_write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(ready_read)
+            # Stopping by Ctrl-C or a signal to the whole process group is left to the main
+            # process, which sends "stop" when the workers are done
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            runCollectionOwner(notebooks, store_dir, authkey, ready_write, load_processes, fsync)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(ready_write)
+    ready = os.read(ready_read, 1)
+    os.close(ready_read)
+    if ready != b"1":
+        raise Exception("Note collection owner process failed")
+    return pid
+
+def stopCollectionOwner(pid, store_dir, authkey):
+    try:
+        try:
+            with multiprocessing.connection.Client(ownerAddress(store_dir), authkey=authkey) as conn:
+                conn.send("stop")
+        except (OSError, EOFError) as e:
+            # The owner died, make sure it's gone
+            print("Note collection owner process not reachable: %s" % e)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            # Already reaped by the gunicorn arbiter
+            pass
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+def runCollectionOwner(notebooks, store_dir, authkey, ready_fd, load_processes, fsync):
+    # Runs in the owner process until requested to stop. notebooks is a list of 
+    # (prefix, full_prefix, notes_path, cache_filename). Writes to ready_fd when serving
+    note_cols = {}
+    dir_watchers = []
+    for (prefix, full_prefix, notes_path, cache_filename) in notebooks:
+        print("Owning note collection in path: %s" % notes_path)
+        # All notes are rendered, as the store holds the rendered notes
+        note_col = NoteCollection(notes_path, cache_filename, load_processes, False, fsync)
+        writer = StoreWriter(storeFilename(store_dir, prefix))
+        note_col.setPublishCallback(
+            lambda snapshot, note_col=note_col, writer=writer: writer.write(note_col.InstanceId, snapshot))
+        print("Loaded: %d notes" % note_col.loadAll())
+        lock = threading.Lock()
+        dir_watchers.append(setupDirWatcher(notes_path, note_col, lock))
+        note_cols[prefix] = (note_col, lock)
+
+    def handleRequest(request):
+        if request[0] == "save":
+            (note_col, lock) = note_cols[request[1]]
+            note_col.addNotes([(None if src is None else Note.Parse(src), replace) 
+                               for (src, replace) in request[2]], lock)
+            return None
+        elif request[0] == "search":
+            (note_col, lock) = note_cols[request[1]]
+            with lock:
+                return [note.getFullname() for note in note_col.searchNotes(*request[2:])]
+        raise ValueError("Unknown request: %s" % request[0])
+
+    def serveConnection(conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    conn.send(("ok", handleRequest(request)))
+                except Exception as e:
+                    conn.send(("error", str(e)))
+
+    with multiprocessing.connection.Listener(ownerAddress(store_dir), authkey=authkey) as listener:
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+        while True:
+            conn = listener.accept()
+            if conn.recv() == "stop":
+                conn.close()
+                break
+            threading.Thread(target=serveConnection, args=(conn,), daemon=True).start()
+
+    for dw in dir_watchers:
+        dw.stop()
+    for dw in dir_watchers:
+        dw.join()
+    for (note_col, lock) in note_cols.values():
+        with lock:
+            note_col.saveCache()
+
+class RemoteNoteCollection:
+    """ Note collection of a worker, reading from a store file and forwarding changes and searches
+    to the collection owner process. Provides the NoteCollection methods used by 
+    serveNoteCollection """
+
+    def __init__(self, store_dir, prefix, authkey):
+        self.Store = NoteStore(storeFilename(store_dir, prefix))
+        self._address = ownerAddress(store_dir)
+        self._prefix = prefix
+        self._authkey = authkey
+
+    @property
+    def InstanceId(self):
+        return self.Store.InstanceId
+
+    def getSnapshot(self):
+        return self.Store.getSnapshot()
+
+    def _call(self, *request):
+        with multiprocessing.connection.Client(self._address, authkey=self._authkey) as conn:
+            conn.send("request")
+            conn.send(request)
+            (status, ret) = conn.recv()
+        if status != "ok":
+            raise Exception(ret)
+        return ret
+
+    def addNotes(self, changes, lock = None):
+        self._call("save", self._prefix, 
+                   [(None if note is None else note.FullSrc, replace) for (note, replace) in changes])
+
+    def searchNotes(self, query, tags_filter = None, limit = None):
+        fullnames = self._call("search", self._prefix, query, tags_filter, limit)
+        # The store may be older or newer than the search, leaving out notes not found in it
+        snapshot = self.getSnapshot()
+        return [note for note in map(snapshot.findFromFullname, fullnames) if note is not None]
+
+def makeNotebooks(notes_root, base_prefix, books, cache_dir):
+    # Get list of (prefix, full_prefix, notes_path, cache_filename) of the notebooks to serve
+    notebooks = []
+    for prefix in books.split(","):
+        # In case of a single notebook, we will get here once with prefix=""
+        full_prefix = base_prefix if prefix == "" else base_prefix + prefix + "/"
+        notes_path = notes_root + "/" if prefix == "" else notes_root + "/" + prefix + "/"
+        if len(cache_dir) > 0:
+            cache_filename = cache_dir + "/notes" + ("" if prefix == "" else "-" + prefix) + ".cache"
+        else:
+            cache_filename = None
+        notebooks.append((prefix, full_prefix, notes_path, cache_filename))
+    return notebooks
+
+def start(frontend_path, host_port, notes_root, base_prefix = "/", books = "", cache_dir = "",
+          load_processes = 0, lazy_render = False, fsync = False, server_mode = "gthread",
+          workers = 1, evict_idle = 0, preload = False):
     """Start the notes'n'todos server, hosting both frontend and API
 
     frontend_path   Specifies path of frontend files
@@ -193,48 +813,135 @@ def start(frontend_path, host_port, notes_root, base_prefix = "/", books = ""):
     notes_root      Root path of note files
     base_prefix     URL base prefix
     books           Comma seperated names of notebooks or "" if serving only one notebook
+    cache_dir       Path for storing render caches of the notebooks or "" for no caching
+    load_processes  Number of processes for rendering notes when loading a notebook, 0 or 1 
+                    renders in the worker itself
+    lazy_render     If True, notes are rendered when first requested instead of when loaded
+    fsync           If True, saved notes are flushed to disk before the save is confirmed
+    server_mode     "gthread" for a threaded worker or "asyncio" for a uvicorn worker with an
+                    event loop, see CustomUnicornApp. Event streams (api/events) are only 
+                    served in the "asyncio" mode
+    workers         Number of worker processes. With more than one, the note collections are 
+                    kept by a separate owner process, see runCollectionOwner. lazy_render
+                    and evict_idle don't apply then
+    evict_idle      Seconds a notebook may go unused before it's evicted from memory and no
+                    longer watched, or 0 to keep notebooks once used. Open event streams keep
+                    their notebook in use
+    preload         If True, the notebooks are loaded before starting gunicorn, and the workers 
+                    forked from it share them until changed. Restarted workers only reload the 
+                    notes changed since, see OnDemandNoteCollection.resume
 
-    If serving multiple notebooks, multiple note collections are started where the 
-    notebook name is added to the notes_root file path and to the URL
+    If serving multiple notebooks, multiple note collections are served where the 
+    notebook name is added to the notes_root file path and to the URL. With one worker, a 
+    notebook is loaded when first requested unless preloaded, see OnDemandNoteCollection
     """
 
     frontend_path = ensureNoSlash(frontend_path) + "/"
     notes_root = ensureNoSlash(notes_root)
     if not ":" in host_port:
         raise ValueError("host_port must include :")
+    if len(cache_dir) > 0:
+        cache_dir = ensureNoSlash(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+    notebooks = makeNotebooks(notes_root, base_prefix, books, cache_dir)
+
+    owner = None
+    if workers > 1:
+        # The store files are put in shared memory if available
+        store_dir = tempfile.mkdtemp(prefix="notesntodos-", 
+                                     dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        authkey = os.urandom(16)
+        owner = startCollectionOwner(notebooks, store_dir, authkey, load_processes, fsync)
+    main_pid = os.getpid()
 
     def createApp():
         bottle_app = Bottle()
         bottle_app.dirWatchers = []
-        first = True
-        for prefix in books.split(","):
-            # In case of a single notebook, we will get here once with prefix=""
-            full_prefix = base_prefix if prefix == "" else base_prefix + prefix + "/"
+        bottle_app.noteCollections = []
+        bottle_app.streamHandlers = {}
+        bottle_app.stopEvicting = threading.Event()
+        bottle_app.evictThread = None
+        notifiers = []
+
+        def serveEvents(full_prefix, note_col, stream_events = streamEvents):
+            # Get notifier for the event stream of note_col, see events.py
+            notifier = ChangeNotifier()
+            notifiers.append(notifier)
+            bottle_app.streamHandlers[full_prefix + "api/events"] = functools.partial(
+                stream_events, note_col, notifier)
+            return notifier
 
-            if first and len(prefix) > 0:
+        for (prefix, full_prefix, notes_path, cache_filename) in notebooks:
+            if len(prefix) > 0 and full_prefix == notebooks[0][1]:
                 print("Making redirect from %s to %s" % (base_prefix, full_prefix))
                 serveRootRedirect(bottle_app, base_prefix, full_prefix)
-                first = False
-
-            notes_path = notes_root + "/" if prefix == "" else notes_root + "/" + prefix + "/"
-            print("Starting note collection in path: %s with URL prefix: %s" % (notes_path, full_prefix))
-            note_col = NoteCollection(notes_path)
-            print("Loaded: %d notes" % note_col.loadAll())
-            lock = threading.Lock()
-            dw = setupDirWatcher(notes_path, note_col, lock)
-            bottle_app.dirWatchers.append(dw)
-            serveNoteCollection(bottle_app, full_prefix, frontend_path, note_col, lock)
-            
+
+            if owner is not None:
+                # Locking is done by the owner process
+                note_col = RemoteNoteCollection(store_dir, prefix, authkey)
+                serveNoteCollection(bottle_app, full_prefix, frontend_path, note_col, 
+                                    contextlib.nullcontext())
+                if server_mode == "asyncio":
+                    serveEvents(full_prefix, note_col)
+                continue
+
+            print("Serving note collection in path: %s with URL prefix: %s" % (notes_path, full_prefix))
+            note_col = OnDemandNoteCollection(notes_path, cache_filename, load_processes, 
+                                              lazy_render, fsync)
+            bottle_app.noteCollections.append(note_col)
+            serveNoteCollection(bottle_app, full_prefix, frontend_path, note_col, note_col.Lock)
+            if server_mode == "asyncio":
+                notifier = serveEvents(full_prefix, note_col, streamOnDemandEvents)
+                # Saves and changes picked up by the dir watcher are all published
+                note_col.setPublishCallback(lambda snapshot, notifier=notifier: notifier.notify())
+            if preload:
+                note_col.preload()
+
+        bottle_app.notifiers = notifiers
+        if preload:
+            # Keep the loaded notes out of garbage collection, which would otherwise touch them
+            # and make the workers copy the memory they share
+            gc.freeze()
         return bottle_app
 
+    def startApp(bottle_app):
+        # Start the threads of the app, in the worker
+        for note_col in bottle_app.noteCollections:
+            note_col.resume()
+
+        if owner is not None and len(bottle_app.notifiers) > 0:
+            # Changes are seen by the store files being replaced
+            def storeChanged(changes):
+                for notifier in bottle_app.notifiers:
+                    notifier.notify()
+            bottle_app.dirWatchers.append(DirWatcher(store_dir, 0, storeChanged))
+
+        if evict_idle > 0 and owner is None:
+            def evictIdle():
+                while not bottle_app.stopEvicting.wait(min(evict_idle / 4, 60)):
+                    for note_col in bottle_app.noteCollections:
+                        note_col.evictIfIdle(evict_idle)
+            bottle_app.evictThread = threading.Thread(target=evictIdle, daemon=False)
+            bottle_app.evictThread.start()
+
     def exitApp(bottle_app):
-        # Stopping first, then joining is a lot faster in case of many note collections
+        bottle_app.stopEvicting.set()
+        if bottle_app.evictThread is not None:
+            bottle_app.evictThread.join()
         for dw in bottle_app.dirWatchers:
             dw.stop()
         for dw in bottle_app.dirWatchers:
             dw.join()
+        for note_col in bottle_app.noteCollections:
+            note_col.evict()
 
-    CustomUnicornApp(createApp, exitApp, host_port).run()
+    try:
+        CustomUnicornApp(createApp, exitApp, host_port, server_mode, workers, startApp, 
+                         preload).run()
+    finally:
+        # Workers exit through here too
+        if owner is not None and os.getpid() == main_pid:
+            stopCollectionOwner(owner, store_dir, authkey)
 
 
 
@@ -277,5 +984,51 @@ def _testCustomUnicornApp():
     print("Test passed if gunicorn started and shut down without errors")
     
     
+def _testOnDemandNoteCollection():
+    import time
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(tmp + "/2021-01-01 A.md", "w") as f:
+            f.write("date: 2021-01-01\nname: A\n\nA")
+        note_col = OnDemandNoteCollection(tmp + "/", None, 0, False, False)
+        published = []
+        note_col.setPublishCallback(published.append)
+
+        # Not loaded until used
+        assert(not note_col.isActive())
+        assert(len(note_col.getSnapshot().Notes) == 1)
+        assert(note_col.isActive() and len(published) == 1)
+        instance_id = note_col.InstanceId
+
+        # Watched while active
+        with open(tmp + "/2021-01-02 B.md", "w") as f:
+            f.write("date: 2021-01-02\nname: B\n\nB")
+        time.sleep(DIR_QUIET_S + 0.3)
+        assert(len(note_col.getSnapshot().Notes) == 2)
+
+        # Evicted when idle, and loaded again as a new instance when used
+        assert(not note_col.evictIfIdle(10))
+        time.sleep(0.1)
+        assert(note_col.evictIfIdle(0.1))
+        assert(not note_col.isActive())
+        os.unlink(tmp + "/2021-01-01 A.md")
+        assert([note.Name for note in note_col.getSnapshot().Notes] == ["B"])
+        assert(note_col.InstanceId != instance_id)
+        note_col.evict()
+
+        # Preloaded without watching, and brought up to date when resumed
+        note_col.preload()
+        instance_id = note_col.InstanceId
+        with open(tmp + "/2021-01-03 C.md", "w") as f:
+            f.write("date: 2021-01-03\nname: C\n\nC")
+        assert(len(note_col.getSnapshot().Notes) == 1)
+        note_col.resume()
+        assert([note.Name for note in note_col.getSnapshot().Notes] == ["C", "B"])
+        assert(note_col.InstanceId != instance_id)
+        os.unlink(tmp + "/2021-01-03 C.md")
+        time.sleep(DIR_QUIET_S + 0.3)
+        assert(len(note_col.getSnapshot().Notes) == 1)
+        note_col.evict()
+
 def testsRun():
+    _testOnDemandNoteCollection()
     _testCustomUnicornApp()
@@ -0,0 +1,205 @@
+"""
+run_benchmarks.py - Script for timing Notes'n'Todos backend operations
+
+Creates a temporary notebook with generated notes and times loading and rendering it.
+
+Usage: python run_benchmarks.py [number of notes]
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import tempfile
+import markdown
+
+import notesntodos.notes as notes
+from playground import projectNote, loremMarkdownum
+
+def timeIt(name, func, repeat=3):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    print("%-45s %8.1f ms" % (name, best * 1000))
+    return best
+
+def makeNotebook(path, note_count):
+    for i in range(note_count):
+        src = projectNote if i % 2 == 0 else loremMarkdownum
+        filename = "%04d-%02d-%02d Note %d.%s" % (2000 + i // 336, 1 + (i // 28) % 12, 1 + i % 28, 
+                                                   i, notes.FILE_EXTENSION)
+        with open(path + filename, "w") as file:
+            file.write(src)
+
+def benchMarkdownEngine(note_count):
+    srcs = [projectNote, loremMarkdownum] * (note_count // 2)
+
+    def markdownPerCall():
+        for src in srcs:
+            markdown.markdown(src, extensions=notes.MARKDOWN_EXTENSIONS, 
+                              extension_configs=notes.MARKDOWN_EXTCONFIG)
+
+    def markdownEngine():
+        for src in srcs:
+            notes.convertMarkdown(src)
+
+    print("Converting %d notes:" % len(srcs))
+    timeIt("  markdown.markdown() per note", markdownPerCall)
+    timeIt("  Reused per-thread Markdown engine", markdownEngine)
+
+def benchLoadAll(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/"
+        makeNotebook(path, note_count)
+        note_col = notes.NoteCollection(path)
+        print("Loading notebook with %d notes:" % note_count)
+        timeIt("  NoteCollection.loadAll()", note_col.loadAll)
+
+        cache_filename = tmp + "/render.cache"
+        def loadColdCache():
+            if os.path.isfile(cache_filename):
+                os.unlink(cache_filename)
+            notes.NoteCollection(path, cache_filename).loadAll()
+
+        timeIt("  NoteCollection.loadAll(), cold render cache", loadColdCache)
+        timeIt("  NoteCollection.loadAll(), warm render cache", 
+               notes.NoteCollection(path, cache_filename).loadAll)
+
+        timeIt("  NoteCollection.loadAll(), lazy rendering",
+               notes.NoteCollection(path, lazy=True).loadAll)
+
+        processes = max(os.cpu_count(), 2)
+        timeIt("  NoteCollection.loadAll(), %d processes" % processes,
+               notes.NoteCollection(path, load_processes=processes).loadAll)
+
+def benchOrderedInsertion(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        note_col = notes.NoteCollection(tmp + "/")
+        note_list = []
+        for i in range(note_count):
+            note = notes.Note.Parse("date: %04d-%02d-%02d\nname: Note %d" % (2000 + i // 336, 
+                                    1 + (i // 28) % 12, 1 + i % 28, i))
+            note_col._add(note, ordered=False)
+            note_list.append(note)
+        note_col.sortNotes()
+
+        def replaceOrdered():
+            for note in note_list[:1000]:
+                note_col._remove(note)
+                note_col._add(note)
+
+        def replaceAndSort():
+            # As done before ordered insertion: remove by scan, append and sort all
+            for note in note_list[:1000]:
+                note_col.Notes.remove(note)
+                note_col.Notes.append(note)
+                note_col.Notes.sort(key=lambda e: e.getSortingName(), reverse=True)
+
+        print("Replacing 1000 notes in collection of %d notes:" % note_count)
+        timeIt("  Bisect removal and insertion", replaceOrdered)
+        timeIt("  Scan removal, append and sort", replaceAndSort)
+
+def benchSnapshotReads(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        makeNotebook(tmp + "/", note_count)
+        note_col = notes.NoteCollection(tmp + "/", lazy=True)
+        note_col.loadAll()
+        lock = threading.Lock()
+        replaced = note_col.Notes[:100]
+
+        def write():
+            # Replace notes while holding the lock, as a save does
+            for note in replaced:
+                with lock:
+                    note_col._remove(note)
+                    note_col._add(note)
+                    note_col._publish()
+                    time.sleep(0.005)
+
+        def readLocked():
+            with lock:
+                note_col.getNotesPage(limit=50)
+
+        def readSnapshot():
+            note_col.getSnapshot().getNotesPage(limit=50)
+
+        print("Reading a page of %d notes during writes:" % note_count)
+        def copyAndPublish():
+            note_col._edit()
+            note_col._publish()
+
+        timeIt("  Copy and publish of snapshot", copyAndPublish)
+        for (name, read) in [("  Slowest read holding lock", readLocked), 
+                             ("  Slowest read from snapshot", readSnapshot)]:
+            writer = threading.Thread(target=write)
+            writer.start()
+            slowest = 0
+            while writer.is_alive():
+                t0 = time.perf_counter()
+                read()
+                slowest = max(slowest, time.perf_counter() - t0)
+            writer.join()
+            print("%-45s %8.1f ms" % (name, slowest * 1000))
+
+def benchNoteJson(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        makeNotebook(tmp + "/", note_count)
+        note_col = notes.NoteCollection(tmp + "/")
+        note_col.loadAll()
+
+        def encodeAll():
+            json.dumps({"notes" : [n.getNoteObj(src=True, todos=True, html=True) 
+                                   for n in note_col.Notes]})
+
+        def joinFragments():
+            "".join(n.getNoteJson(src=True, todos=True, html=True) for n in note_col.Notes)
+
+        print("Serializing %d notes with src, todos and html:" % note_count)
+        timeIt("  Encoding all notes", encodeAll)
+        timeIt("  Joining cached fragments", joinFragments)
+
+def benchTodos(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        makeNotebook(tmp + "/", note_count)
+        note_col = notes.NoteCollection(tmp + "/")
+        note_col.loadAll()
+
+        def todosFromNotes():
+            json.dumps({"notes" : [n.getNoteObj(todos=True) for n in note_col.Notes]})
+
+        def todosFromIndex():
+            json.dumps({"todos" : [{"fullname" : n.getFullname(), "text" : text, "index" : index} 
+                                   for (n, text, index) in note_col.getTodos(limit=100)]})
+
+        print("Getting todos of %d notes:" % note_count)
+        timeIt("  All notes with todos", todosFromNotes)
+        timeIt("  Todo index, limit 100", todosFromIndex)
+
+def benchSearch(note_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        makeNotebook(tmp + "/", note_count)
+        note_col = notes.NoteCollection(tmp + "/", lazy=True)
+        note_col.loadAll()
+        timeIt("Indexing %d notes on first search" % note_count, 
+               lambda: note_col.searchNotes("project"), repeat=1)
+
+        # The generated notes repeat two texts, so the terms match half or all notes
+        print("Searching %d notes:" % note_count)
+        for query in ["project", "note 12*", '"lorem ipsum"', "de*"]:
+            timeIt("  %s" % query, lambda: note_col.searchNotes(query, limit=50))
+
+# Rendering processes import this as the main module, so only run the benchmarks when started
+if __name__ == "__main__":
+    note_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    benchMarkdownEngine(note_count)
+    benchLoadAll(note_count)
+    benchOrderedInsertion(note_count)
+    benchSnapshotReads(note_count)
+    benchNoteJson(note_count)
+    benchTodos(note_count)
+    benchSearch(note_count)
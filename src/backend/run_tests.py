@@ -3,16 +3,34 @@ run_tests.py - Script for running Notes'n'Todos test cases
 
 """
 
-print("Testing notesntodos.notes")
-import notesntodos.notes
-notesntodos.notes.testsRun()
+# Rendering processes import this as the main module, so only run the tests when started
+if __name__ == "__main__":
+    print("Testing notesntodos.notes")
+    import notesntodos.notes
+    notesntodos.notes.testsRun()
 
-print("Testing notesntodos.server")
-import notesntodos.server
-notesntodos.server.testsRun()
+    print("Testing notesntodos.searchindex")
+    import notesntodos.searchindex
+    notesntodos.searchindex.testsRun()
 
-print("Testing notesntodos.dirwatcher")
-import notesntodos.dirwatcher
-notesntodos.dirwatcher.testsRun()
+    print("Testing notesntodos.notestore")
+    import notesntodos.notestore
+    notesntodos.notestore.testsRun()
 
-print("Testing complete")
+    print("Testing notesntodos.asgi")
+    import notesntodos.asgi
+    notesntodos.asgi.testsRun()
+
+    print("Testing notesntodos.events")
+    import notesntodos.events
+    notesntodos.events.testsRun()
+
+    print("Testing notesntodos.server")
+    import notesntodos.server
+    notesntodos.server.testsRun()
+
+    print("Testing notesntodos.dirwatcher")
+    import notesntodos.dirwatcher
+    notesntodos.dirwatcher.testsRun()
+
+    print("Testing complete")
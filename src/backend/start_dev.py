@@ -34,6 +34,7 @@ web_path = sys.argv[1]
 scenario = sys.argv[2]
 host_port = ":8081"
 notes_root = "/tmp/notesntodos"
+cache_dir = "/tmp/notesntodos_cache"
 
 # Scenarios:
 if scenario == "serve":
@@ -64,7 +65,7 @@ for book in books.split(","):
 makeVarsJs(web_path + "/vars.js", books, booknames, base_url)
 
 def startServer():
-    notesntodos.server.start(web_path, host_port, notes_root, base_url, books)
+    notesntodos.server.start(web_path, host_port, notes_root, base_url, books, cache_dir)
 
 if playground:
     from playground import runPlayground
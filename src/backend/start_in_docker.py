@@ -7,6 +7,14 @@ Retrieves configuration from environment variables:
 - BASE_URL
 - NOTEBOOK_NAMES
 - PLAYGROUND
+- CACHE_DIR
+- LOAD_PROCESSES
+- LAZY_RENDER
+- FSYNC
+- SERVER_MODE
+- WORKERS
+- EVICT_IDLE
+- PRELOAD
 
 The script writes vars.js with links to other notebooks and starts the server.
 
@@ -29,45 +37,66 @@ def makeVarsJs(path, books, booknames, base_url):
     with open(path, "w") as file:
         file.write("var HEADER_LINKS=%s;\n" % json.dumps(links, separators=(',', ':')))
 
-# Starting from docker, get config from env. variables:
-base_url = os.environ.get('BASE_URL', '/')
-web_path = "./web"
-host_port = ":5000"
-notes_root = "/notes"
-books = os.environ.get('NOTEBOOKS', '')
-booknames = os.environ.get('NOTEBOOK_NAMES', '')
-try:
-    playground = int(os.environ.get('PLAYGROUND', '0'))
-except:
-    playground = 0
-
-# Set up the header links
-makeVarsJs(web_path + "/vars.js", books, booknames, base_url)
-
-# Change user:group if specified
-if 'GID' in os.environ:
-    print("Setting GID: " + os.environ['GID'])
-    os.setgid(int(os.environ['GID']))
-
-if 'UID' in os.environ:
-    print("Setting UID: " + os.environ['UID'])
-    os.setuid(int(os.environ['UID']))
-
-import notesntodos.server
-
-def startServer():
-    notesntodos.server.start(web_path, host_port, notes_root, base_url, books)
-
-if playground > 0:
-    print("*** Starting in playground mode: %d minutes reset ***" % playground)
-    book_folders = []
-    for book in books.split(","):
-        path = notes_root + "/" + book if len(book) > 0 else notes_root
-        book_folders.append(path)
-
-    from playground import runPlayground
-    # 30 minutes clean up time
-    runPlayground(book_folders, startServer, playground)
-else:
-    print("*** Starting in normal mode ***")
-    startServer()
+# Rendering processes import this as the main module, so only start the server when run
+if __name__ == "__main__":
+    # Starting from docker, get config from env. variables:
+    base_url = os.environ.get('BASE_URL', '/')
+    web_path = "./web"
+    host_port = ":5000"
+    notes_root = "/notes"
+    books = os.environ.get('NOTEBOOKS', '')
+    booknames = os.environ.get('NOTEBOOK_NAMES', '')
+    cache_dir = os.environ.get('CACHE_DIR', '/tmp/notesntodos-cache')
+    try:
+        playground = int(os.environ.get('PLAYGROUND', '0'))
+    except:
+        playground = 0
+    try:
+        load_processes = int(os.environ.get('LOAD_PROCESSES', '0'))
+    except:
+        load_processes = 0
+    lazy_render = os.environ.get('LAZY_RENDER', '0') == '1'
+    fsync = os.environ.get('FSYNC', '0') == '1'
+    server_mode = os.environ.get('SERVER_MODE', 'gthread')
+    try:
+        workers = int(os.environ.get('WORKERS', '1'))
+    except:
+        workers = 1
+    try:
+        evict_idle = int(os.environ.get('EVICT_IDLE', '0'))
+    except:
+        evict_idle = 0
+    preload = os.environ.get('PRELOAD', '0') == '1'
+
+    # Set up the header links
+    makeVarsJs(web_path + "/vars.js", books, booknames, base_url)
+
+    # Change user:group if specified
+    if 'GID' in os.environ:
+        print("Setting GID: " + os.environ['GID'])
+        os.setgid(int(os.environ['GID']))
+
+    if 'UID' in os.environ:
+        print("Setting UID: " + os.environ['UID'])
+        os.setuid(int(os.environ['UID']))
+
+    import notesntodos.server
+
+    def startServer():
+        notesntodos.server.start(web_path, host_port, notes_root, base_url, books, cache_dir, 
+                                 load_processes, lazy_render, fsync, server_mode, workers, evict_idle,
+                                 preload)
+
+    if playground > 0:
+        print("*** Starting in playground mode: %d minutes reset ***" % playground)
+        book_folders = []
+        for book in books.split(","):
+            path = notes_root + "/" + book if len(book) > 0 else notes_root
+            book_folders.append(path)
+
+        from playground import runPlayground
+        # 30 minutes clean up time
+        runPlayground(book_folders, startServer, playground)
+    else:
+        print("*** Starting in normal mode ***")
+        startServer()
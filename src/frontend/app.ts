@@ -95,6 +95,10 @@ class SaveManager {
     return this.pending.size;
   }
 
+  public isPending(save_func: () => any): boolean {
+    return this.pending.has(save_func);
+  }
+
   public addPending(save_func: () => any) {
     if (!this.pending.has(save_func)) {
       this.pending.add(save_func);
@@ -192,8 +196,6 @@ class MainNote {
   
   private index: number;
   private static allIndex: number = 0;
-  
-  private section_todo: TwoPaneSection | undefined;
 
 
   constructor(section: TwoPaneSection, note: INote) {
@@ -213,31 +215,29 @@ class MainNote {
     section.setVisible(false);
   }
 
-  public registerTodoSection(section_todo: TwoPaneSection) {
-    this.section_todo = section_todo;
+  public getTags(): string[] {
+    return this.note.tags;
+  }
 
-    // Initialize todo section, but be invisible to begin with
-    app.sectionSetupTitle(this.section_todo, this.note.date, this.note.name, (evt: Event) => {
-        this.scrollAndFlash();
-    });
-    app.sectionSetupBody(this.section_todo, this.note.tags, 
-      this.makeTodosBody(this.note.todos));
-    this.section_todo.setVisible(false);
+  public getFullname(): string {
+    return this.note.fullname;
   }
 
-  public getTags(): string[] {
-    return this.note.tags;
+  public getSection(): TwoPaneSection {
+    return this.section;
   }
 
-  public getTodoCount() {
-    return this.note.todos.length;
+  public hasPendingChanges(): boolean {
+    return app.saveManager.isPending(this.saveCallback);
   }
 
-  public setVisible(show_note: boolean, show_todo: boolean) {
-    this.section.setVisible(show_note);
-    if (this.section_todo) {
-      this.section_todo.setVisible(show_todo);
-    }
+  public remove() {
+    this.section.remove();
+    app.noteIds.delete("note" + this.index.toString());
+  }
+
+  public setVisible(show: boolean) {
+    this.section.setVisible(show);
   }
 
   public handleNodeCheckedChange(index : number, value: boolean) {
@@ -265,39 +265,32 @@ class MainNote {
     return true
   }
 
-  public setTodoCheckValue(index : number, value: boolean) {
-    if (this.section_todo) {
-      let inputs = this.section_todo.center.getElementsByTagName('input');
-      for (let i = 0; i < inputs.length; i++) {
-        if (Number(inputs[i].getAttribute('idx')) == index) {
-          inputs[i].checked = value;
-          break;
-        }
-      }
+  public checkTodo(index: number, value: boolean): boolean {
+    // Check or uncheck a todo from the todo list. Returns false if it couldn't be done
+    if (!this.setNoteCheckValue(index, value)) {
+      return false;
     }
+    this.handleNodeCheckedChange(index, value);
+    return true;
   }
 
-  private makeTodosBody(todos: [[string,number]]): HTMLElement {
-    let div = util.createDiv("todolist");
-    for (let i = 0; i < todos.length; i++) {
-      let elem = document.createElement("p");
-      let index = todos[i][1];
-      let chk = new CheckBox(todos[i][0], false, (evt: Event) => {
-        let checked = (<HTMLInputElement>evt.target).checked;
-        if (!this.setNoteCheckValue(index, checked)) {
-          // Couldn't update the check status, undo the toggling
-          (<HTMLInputElement>evt.target).checked = !checked;
-        } else {
-          // It worked, handle new status of the check
-          this.handleNodeCheckedChange(index, checked);
-        }
-      });
-      chk.input.setAttribute("idx", index.toString());
-      elem.appendChild(chk.element);
-      div.appendChild(elem);
-    };
+  public isTodoChecked(index: number): boolean {
+    // Checked in the changes pending to be saved
+    if (this.note.src && this.note.check_offsets && this.hasPendingChanges()) {
+      return this.note.src[this.note.check_offsets[index]] != " ";
+    }
+    return false;
+  }
 
-    return div;
+  public adoptChanges(src: string, check_offsets: [number]) {
+    // Take over the changes of the todo list made before this note was loaded
+    this.note.src = src;
+    this.note.check_offsets = check_offsets;
+    for (let i = 0; i < check_offsets.length; i++) {
+      this.setNoteCheckValue(i, src[check_offsets[i]] != " ");
+    }
+    app.saveManager.addPending(this.saveCallback);
+    this.revertButton.setVisible(true);
   }
 
   private initNote() {
@@ -352,13 +345,8 @@ class MainNote {
       this.initNote();
     }
 
-    if (this.section_todo) {
-      // Reverting means all todos go back to unchecked
-      let inputs = this.section_todo.center.getElementsByTagName('input');
-      for (let i = 0; i < inputs.length; i++) {
-        inputs[i].checked = false;        
-      }
-    }
+    // Reverting means all todos go back to unchecked
+    app.uncheckTodos(this.note.fullname);
   }
   
   private handlePreviewClick = (evt: Event) => {
@@ -405,7 +393,7 @@ export function checkClick(obj:HTMLInputElement, index:number) {
       let note = app.noteIds.get(p.id);
       if (note) {
         note.handleNodeCheckedChange(index, obj.checked);
-        note.setTodoCheckValue(index, obj.checked);
+        app.setTodoCheckValue(note.getFullname(), index, obj.checked);
       }
       return;
     }
@@ -413,6 +401,119 @@ export function checkClick(obj:HTMLInputElement, index:number) {
   }
 }
 
+// ---- Todos, as received from api/gettodos for all notes
+
+class TodoNote {
+  private section: TwoPaneSection;
+  private note: INote;
+
+  private index: number;
+  private static allIndex: number = 0;
+
+  constructor(section: TwoPaneSection, note: INote) {
+    TodoNote.allIndex += 1;
+    this.index = TodoNote.allIndex;
+    this.section = section;
+    this.note = note;
+
+    app.sectionSetupTitle(this.section, this.note.date, this.note.name, (evt: Event) => {
+      app.scrollToNote(this.note.fullname);
+    });
+    app.sectionSetupBody(this.section, this.note.tags, this.makeTodosBody(this.note.todos));
+    this.section.setVisible(false);
+  }
+
+  public getFullname(): string {
+    return this.note.fullname;
+  }
+
+  public getTags(): string[] {
+    return this.note.tags;
+  }
+
+  public getSection(): TwoPaneSection {
+    return this.section;
+  }
+
+  public getTodoCount() {
+    return this.note.todos.length;
+  }
+
+  public getTodoIndexes(): number[] {
+    return this.note.todos.map((todo) => todo[1]);
+  }
+
+  public setVisible(show: boolean) {
+    this.section.setVisible(show);
+  }
+
+  public remove() {
+    this.section.remove();
+  }
+
+  public hasPendingChanges(): boolean {
+    return app.saveManager.isPending(this.saveCallback);
+  }
+
+  public takeChanges(): [string, [number]] | undefined {
+    // Give up the changes pending to be saved, for the note to take over when loaded
+    if (!this.hasPendingChanges()) {
+      return undefined;
+    }
+    app.saveManager.removePending(this.saveCallback);
+    return [this.note.src!, this.note.check_offsets!];
+  }
+
+  public setTodoCheckValue(index : number, value: boolean) {
+    let inputs = this.section.center.getElementsByTagName('input');
+    for (let i = 0; i < inputs.length; i++) {
+      if (Number(inputs[i].getAttribute('idx')) == index) {
+        inputs[i].checked = value;
+        break;
+      }
+    }
+  }
+
+  private makeTodosBody(todos: [[string,number]]): HTMLElement {
+    let div = util.createDiv("todolist");
+    for (let i = 0; i < todos.length; i++) {
+      let elem = document.createElement("p");
+      let index = todos[i][1];
+      let chk = new CheckBox(todos[i][0], false, (evt: Event) => {
+        let checked = (<HTMLInputElement>evt.target).checked;
+        let mainnote = app.findNote(this.note.fullname);
+        if (mainnote === undefined) {
+          // The note isn't loaded, so the check is changed in its source here
+          this.handleCheckedChange(index, checked);
+        }
+        else if (!mainnote.checkTodo(index, checked)) {
+          // Couldn't update the check status, undo the toggling
+          (<HTMLInputElement>evt.target).checked = !checked;
+        }
+      });
+      chk.input.setAttribute("idx", index.toString());
+      elem.appendChild(chk.element);
+      div.appendChild(elem);
+    };
+
+    return div;
+  }
+
+  private handleCheckedChange(index : number, value: boolean) {
+    // Replace the character at the given index
+    app.loadNoteSrc(this.note, () => {
+      let s = this.note.src!;
+      let offset = this.note.check_offsets![index]
+      this.note.src = s.substring(0, offset) + (value ? "x" : " ") + s.substring(offset + 1);
+      app.saveManager.addPending(this.saveCallback);
+    });
+  }
+
+  private saveCallback = (): [number, any] => {
+    return [this.index, { "src": this.note.src, "replace": this.note.fullname }];
+  }
+}
+
 // ---- Tags system
 
 class Tags {
@@ -532,6 +633,9 @@ class EditWidget {
 
 declare var HEADER_LINKS: string[];
 
+// Number of notes to fetch per page, older pages are fetched when scrolling down
+const NOTES_PAGE_SIZE = 50;
+
 export function toggleShowTodos() {
   app.showTodos(!app.todosShown);
 }
@@ -541,6 +645,7 @@ class App {
   private httpClient: HttpClient;
 
   private allNotes: MainNote[] = [];
+  private todoNotes: TodoNote[] = [];
 
   private ScrollTop = 0;
   private groupTags: OnePaneGroup;
@@ -559,6 +664,20 @@ class App {
 
   public noteIds = new Map<string, MainNote>();
 
+  // Cursor for fetching the next page of older notes, null when all are fetched
+  private nextCursor: string | null = null;
+  private loadingPage: boolean = false;
+  private loadGeneration: number = 0;
+  private todosGeneration: number = 0;
+
+  // State of the notebook that allNotes is up to date with, for fetching the changes since
+  private syncInstance: string = "";
+  private syncGeneration: number = 0;
+  private saving: boolean = false;
+  private changesLoading: boolean = false;
+  private changesPending: boolean = false;
+  private events: EventSource | undefined;
+
   constructor(layout: Layout, splash: ModalSplash, http_client: HttpClient) {
 
     this.httpClient = http_client;
@@ -596,6 +715,8 @@ class App {
     this.groupNew.setStickyBottom(new Button("New Note", this.handleNewClick).element);
 
     this.myTags = new Tags(this.tagsChangeHandler);
+
+    window.addEventListener("scroll", this.loadMoreIfNeeded);
   }
 
   public load() {
@@ -624,72 +745,342 @@ class App {
   }
 
   private loadContents(tags_not_checked: Set<string>, first_load:boolean) {
+    // When reloading, fetch at least as many notes as before to restore the scroll position
+    let first_page_size = Math.max(NOTES_PAGE_SIZE, this.allNotes.length);
+    this.loadGeneration += 1;
+    this.nextCursor = null;
+
     this.httpClient.get("api/gettags", {}, (success, response) => {
       if (success) {
-        let elemp = document.createElement("p");
-        elemp.appendChild(this.myTags.getAllTagsCheck());
-        elemp.appendChild(this.myTags.getNoneTagsCheck());
-
-        this.groupTags.clear();
-        this.groupTags.addSection().center.appendChild(elemp);
-
-        elemp = document.createElement("p");
-        let chk = this.myTags.makeTagCheckbox("", !tags_not_checked.has(""), "(No tags)");
-        elemp.appendChild(chk);
-
         let obj = JSON.parse(response);
-        for (let i = 0; i < obj.tags.length; i++) {
-          let checked = !tags_not_checked.has(obj.tags[i]);
-          let chk = this.myTags.makeTagCheckbox(obj.tags[i], checked);          
-          elemp.appendChild(chk);
-          elemp.appendChild(document.createTextNode(" "));
-        }
-
-        this.groupTags.addSection().center.appendChild(elemp);
+        this.showTags(obj.tags, tags_not_checked);
 
         this.groupNotes.clear();
         this.groupTodos.clear();
         
         this.allNotes = [];
+        this.todoNotes = [];
 
-        this.httpClient.get("api/getnotes", { 'html': 1, 'todos': 1 }, (success, response) => {
-          if (success) {
-            let todo_count = 0;
-            let obj = JSON.parse(response);
-            for (let i = 0; i < obj.notes.length; i++) {
-              let note = obj.notes[i];
-              let mainnote: MainNote = new MainNote(this.groupNotes.addSection(), note);
-              if (mainnote.getTodoCount() > 0) {
-                todo_count += mainnote.getTodoCount();
-                mainnote.registerTodoSection(this.groupTodos.addSection());
-              }
-              this.allNotes.push(mainnote);
-            }
+        this.loadNotesPage(null, first_page_size, () => {
+          document.documentElement.scrollTop = this.ScrollTop;
+        });
+        this.loadTodos();
+      }
+      else {
+        this.splash.showMessage("Network error: Couldn't load tags", response);
+      }
+    });
+  }
 
-            this.refilter();
+  private showTags(tags: string[], tags_not_checked: Set<string>) {
+    let elemp = document.createElement("p");
+    elemp.appendChild(this.myTags.getAllTagsCheck());
+    elemp.appendChild(this.myTags.getNoneTagsCheck());
 
-            document.documentElement.scrollTop = this.ScrollTop;
-          }
-          else {
-            this.splash.showMessage("Network error: Couldn't load notes", response);
+    this.groupTags.clear();
+    this.groupTags.addSection().center.appendChild(elemp);
+
+    elemp = document.createElement("p");
+    let chk = this.myTags.makeTagCheckbox("", !tags_not_checked.has(""), "(No tags)");
+    elemp.appendChild(chk);
+
+    for (let i = 0; i < tags.length; i++) {
+      let checked = !tags_not_checked.has(tags[i]);
+      let chk = this.myTags.makeTagCheckbox(tags[i], checked);          
+      elemp.appendChild(chk);
+      elemp.appendChild(document.createTextNode(" "));
+    }
+
+    this.groupTags.addSection().center.appendChild(elemp);
+  }
+
+  private insertNote(index: number, note: INote) {
+    // Insert note in allNotes at index, with its sections before those of the following notes
+    let next = (index < this.allNotes.length) ? this.allNotes[index] : undefined;
+    let mainnote: MainNote = new MainNote(this.groupNotes.insertSection(next?.getSection()), note);
+    this.allNotes.splice(index, 0, mainnote);
+
+    // Todos checked in the todo list before the note was loaded are now changes of the note
+    let changes = this.findTodoNote(note.fullname)?.takeChanges();
+    if (changes) {
+      mainnote.adoptChanges(changes[0], changes[1]);
+    }
+  }
+
+  public findNote(fullname: string): MainNote | undefined {
+    // Find the note if it's loaded
+    for (let i = 0; i < this.allNotes.length; i++) {
+      if (this.allNotes[i].getFullname() == fullname) {
+        return this.allNotes[i];
+      }
+    }
+    return undefined;
+  }
+
+  private findTodoNote(fullname: string): TodoNote | undefined {
+    for (let i = 0; i < this.todoNotes.length; i++) {
+      if (this.todoNotes[i].getFullname() == fullname) {
+        return this.todoNotes[i];
+      }
+    }
+    return undefined;
+  }
+
+  public scrollToNote(fullname: string) {
+    this.findNote(fullname)?.scrollAndFlash();
+  }
+
+  public setTodoCheckValue(fullname: string, index: number, value: boolean) {
+    this.findTodoNote(fullname)?.setTodoCheckValue(index, value);
+  }
+
+  public uncheckTodos(fullname: string) {
+    let todo_note = this.findTodoNote(fullname);
+    if (todo_note) {
+      for (const index of todo_note.getTodoIndexes()) {
+        todo_note.setTodoCheckValue(index, false);
+      }
+    }
+  }
+
+  private loadTodos() {
+    // The todo list shows the todos of all notes, not just of the pages of notes loaded
+    this.todosGeneration += 1;
+    let generation = this.todosGeneration;
+
+    this.httpClient.get("api/gettodos", {}, (success, response) => {
+      if (generation != this.todosGeneration) {
+        // The todos were loaded again while fetching
+        return;
+      }
+      if (success) {
+        let obj = JSON.parse(response);
+        this.showTodoNotes(obj.todos);
+        this.refilter();
+      }
+      else {
+        this.splash.showMessage("Network error: Couldn't load todos", response);
+      }
+    });
+  }
+
+  private showTodoNotes(todos: any[]) {
+    // Group the todos by note, they come grouped with the newest note first
+    let notes: INote[] = [];
+    for (let i = 0; i < todos.length; i++) {
+      let todo = todos[i];
+      if (notes.length > 0 && notes[notes.length - 1].fullname == todo.fullname) {
+        notes[notes.length - 1].todos.push([todo.text, todo.index]);
+      }
+      else {
+        notes.push(<INote>{ fullname: todo.fullname, date: todo.date, name: todo.name, 
+          tags: todo.tags, todos: [[todo.text, todo.index]], html: "", src: undefined, 
+          check_offsets: undefined });
+      }
+    }
+
+    // Todo lists with changes pending to be saved are kept as they are
+    let kept = new Map<string, TodoNote>();
+    for (let i = 0; i < this.todoNotes.length; i++) {
+      if (this.todoNotes[i].hasPendingChanges()) {
+        kept.set(this.todoNotes[i].getFullname(), this.todoNotes[i]);
+      }
+      else {
+        this.todoNotes[i].remove();
+      }
+    }
+
+    // Insert from the oldest note, so each section goes before the one of the following note
+    this.todoNotes = [];
+    let next: TwoPaneSection | undefined = undefined;
+    for (let i = notes.length - 1; i >= 0; i--) {
+      let todo_note = kept.get(notes[i].fullname);
+      if (todo_note) {
+        kept.delete(notes[i].fullname);
+      }
+      else {
+        todo_note = new TodoNote(this.groupTodos.insertSection(next), notes[i]);
+        // Show the checks of changes pending in the loaded note
+        let mainnote = this.findNote(notes[i].fullname);
+        if (mainnote) {
+          for (const index of todo_note.getTodoIndexes()) {
+            todo_note.setTodoCheckValue(index, mainnote.isTodoChecked(index));
           }
-        });
+        }
+      }
+      next = todo_note.getSection();
+      this.todoNotes.unshift(todo_note);
+    }
+    kept.forEach((todo_note) => {
+      this.todoNotes.push(todo_note);
+    });
+  }
+
+  private removeNote(fullname: string): boolean {
+    // Remove note, unless it has changes pending to be saved. Returns false if it has
+    for (let i = 0; i < this.allNotes.length; i++) {
+      if (this.allNotes[i].getFullname() == fullname) {
+        if (this.allNotes[i].hasPendingChanges()) {
+          return false;
+        }
+        this.allNotes[i].remove();
+        this.allNotes.splice(i, 1);
+        break;
+      }
+    }
+    return true;
+  }
+
+  private loadNotesPage(before: string | null, limit: number, done_callback?: () => void) {
+    let params: any = { 'html': 1, 'todos': 1, 'limit': limit };
+    if (before !== null) {
+      params['before'] = before;
+    }
+    let generation = this.loadGeneration;
+    this.loadingPage = true;
+
+    this.httpClient.get("api/getnotes", params, (success, response) => {
+      if (generation != this.loadGeneration) {
+        // Contents were reloaded while fetching, this page is outdated
+        return;
+      }
+      this.loadingPage = false;
+      if (success) {
+        let obj = JSON.parse(response);
+        for (let i = 0; i < obj.notes.length; i++) {
+          this.insertNote(this.allNotes.length, obj.notes[i]);
+        }
+        this.nextCursor = obj.next;
+        if (before === null) {
+          this.syncInstance = obj.instance;
+          this.syncGeneration = obj.generation;
+          this.listenEvents();
+        }
+
+        this.refilter();
+
+        if (done_callback) {
+          done_callback();
+        }
+
+        // The page might not fill the window, for instance if tags filter out most notes
+        this.loadMoreIfNeeded();
       }
       else {
-        this.splash.showMessage("Network error: Couldn't load tags", response);
+        this.splash.showMessage("Network error: Couldn't load notes", response);
       }
     });
   }
 
+  private listenEvents() {
+    // Load the changes whenever the server tells that notes changed. The server only sends
+    // events in its asyncio mode, otherwise the event source is closed
+    if (this.events || !window.EventSource) {
+      return;
+    }
+    let params = { 'since': this.syncGeneration, 'instance': this.syncInstance };
+    this.events = new EventSource(this.httpClient.makeUrl("api/events", params));
+    let handler = (evt: Event) => {
+      let obj = JSON.parse((<MessageEvent>evt).data);
+      if (obj.instance != this.syncInstance || obj.generation > this.syncGeneration) {
+        this.loadChanges();
+      }
+    };
+    for (const name of ["changed", "removed", "tags", "resync"]) {
+      this.events.addEventListener(name, handler);
+    }
+  }
+
+  private loadChanges() {
+    // Fetch the notes changed since the notes were loaded, instead of loading all notes again
+    if (this.changesLoading || this.saving) {
+      this.changesPending = true;
+      return;
+    }
+    let params = { 'since': this.syncGeneration, 'instance': this.syncInstance, 'html': 1, 'todos': 1 };
+    let generation = this.loadGeneration;
+    this.changesLoading = true;
+    this.changesPending = false;
+
+    this.httpClient.get("api/changes", params, (success, response) => {
+      this.changesLoading = false;
+      if (generation != this.loadGeneration) {
+        // Contents were reloaded while fetching
+        return;
+      }
+      if (this.saving || this.changesPending) {
+        // The changes may miss a save, or more changes were made meanwhile, so load them again
+        this.changesPending = false;
+        this.loadChanges();
+        return;
+      }
+      if (success) {
+        let obj = JSON.parse(response);
+        if (obj.resync) {
+          this.reload();
+        }
+        else {
+          this.applyChanges(obj);
+        }
+      }
+      else {
+        this.splash.showMessage("Network error: Couldn't load changes", response);
+      }
+    });
+  }
+
+  private applyChanges(obj: any) {
+    let tags_not_checked = new Set(this.myTags.getChecked(false));
+    this.myTags = new Tags(this.tagsChangeHandler);
+    this.showTags(obj.tags, tags_not_checked);
+
+    for (let i = 0; i < obj.deleted.length; i++) {
+      this.removeNote(obj.deleted[i]);
+    }
+    // The changed notes come newest first with their index among all notes, so the notes 
+    // before the index are in place when inserting. Notes after the loaded pages are skipped,
+    // they are fetched with the next page. Notes with pending changes are kept as they are
+    for (let i = 0; i < obj.notes.length; i++) {
+      let change = obj.notes[i];
+      if (!this.removeNote(change.note.fullname)) {
+        continue;
+      }
+      if (change.index < this.allNotes.length || this.nextCursor === null) {
+        this.insertNote(Math.min(change.index, this.allNotes.length), change.note);
+      }
+    }
+    this.syncGeneration = obj.generation;
+    this.refilter();
+    this.loadTodos();
+  }
+
+  private loadMoreIfNeeded = () => {
+    // Fetch the next page of older notes when scrolled near the bottom
+    if (this.nextCursor !== null && !this.loadingPage) {
+      let bottom = document.documentElement.scrollTop + window.innerHeight;
+      if (bottom > document.documentElement.scrollHeight - window.innerHeight) {
+        this.loadNotesPage(this.nextCursor, NOTES_PAGE_SIZE);
+      }
+    }
+  }
+
   private handleSave = (obj: object) => {
     this.splash.forceHide();
-    // Handle the save function
+    // Handle the save function. Changes are not loaded while saving, as the notes being saved
+    // are only replaced when their changes are no longer pending
+    this.saving = true;
     this.httpClient.postJson("api/savenotes", obj, (success, response) => {
+      this.saving = false;
       if (success) {
-        this.reload();
+        this.saveManager.clear();
+        this.groupNew.clear();
+        this.loadChanges();
       }
       else {
         this.splash.showMessage("Couldn't save note(s)", response);
+        if (this.changesPending) {
+          this.loadChanges();
+        }
       }
     });
   }
@@ -731,16 +1122,25 @@ class App {
   private refilter() {
     let checked = new Set(this.myTags.getChecked(true));
     let include_empty = checked.has("");
+    let isShown = (tags: string[]) => {
+      return (tags.length == 0) ? include_empty : util.arraySetIntersects(tags, checked);
+    };
     this.todoCount = 0;
     this.noteCount = 0;
 
     for (let i = 0; i < this.allNotes.length; i++) {
-      let tags = this.allNotes[i].getTags();
-      let show = (tags.length == 0) ? include_empty : util.arraySetIntersects(tags, checked);
-      this.allNotes[i].setVisible(show, this.todosShown && show);
+      let show = isShown(this.allNotes[i].getTags());
+      this.allNotes[i].setVisible(show);
       if (show) {
         this.noteCount += 1;
-        this.todoCount += this.allNotes[i].getTodoCount();
+      }
+    }
+
+    for (let i = 0; i < this.todoNotes.length; i++) {
+      let show = isShown(this.todoNotes[i].getTags());
+      this.todoNotes[i].setVisible(this.todosShown && show);
+      if (show) {
+        this.todoCount += this.todoNotes[i].getTodoCount();
       }
     }
 
@@ -505,6 +505,16 @@ export class TwoPaneGroup {
         //section.addBorder();
         return section;
     }
+
+    public insertSection(before: TwoPaneSection | undefined): TwoPaneSection {
+        // Insert section before another section, or last if undefined
+        if (!before) {
+            return this.addSection();
+        }
+        let div: HTMLElement = util.createDiv("section");
+        util.insertBefore(before.getElement(), div);
+        return new TwoPaneSection(div, this.updateVisible);
+    }
 }
 
 export class TwoPaneSection {
@@ -554,6 +564,20 @@ export class TwoPaneSection {
         //this.div3.classList.add("border");
     }
 
+    public getElement(): HTMLElement {
+        // The first element of the section
+        return this.div1;
+    }
+
+    public remove() {
+        this.div1.remove();
+        if (this.div2) this.div2.remove();
+        this.div3.remove();
+        if (this.updateVisible) {
+            this.updateVisible(this, false);
+        }
+    }
+
     public render() {
         if (this.rendered) {
             return;
@@ -13,7 +13,7 @@ export default class HttpClient {
       this.baseUrl = base_url;
     }
   
-    public get(url: string, params: object, callback: (success: boolean, response: string) => void) {
+    public makeUrl(url: string, params: object): string {
       url = this.baseUrl + url;
   
       let paramcount = 0;
@@ -22,6 +22,11 @@ export default class HttpClient {
         url += encodeURIComponent(key) + "=" + encodeURIComponent(value);
         paramcount += 1;
       }
+      return url;
+    }
+
+    public get(url: string, params: object, callback: (success: boolean, response: string) => void) {
+      url = this.makeUrl(url, params);
       
       let xmlhttp = new XMLHttpRequest();
       xmlhttp.onreadystatechange = function() { 